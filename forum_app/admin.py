@@ -1,10 +1,87 @@
-from django.contrib import admin
+from django import forms
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ActionForm
 
+from forum_app import moderation
 from forum_app.models import Profile, Category, Thread, Post, Conversation, Pm
 
+
+class ModerationForm(ActionForm):
+    """ Admin action bar with the targets of the move actions.
+    """
+    to_category = forms.ModelChoiceField(Category.objects.all(),
+                                         required=False,
+                                         label='Move to category')
+    to_thread = forms.IntegerField(required=False, label='Move to thread id')
+
+
+def bulk_delete_posts(modeladmin, request, queryset):
+    posts, empty = moderation.delete_posts(queryset)
+    moderation.finish()
+    modeladmin.message_user(request, 'Deleted {} posts ({} empty threads '
+                            'removed); counters updated.'.format(posts, empty))
+bulk_delete_posts.short_description = 'Bulk delete selected posts'
+
+
+def bulk_move_posts(modeladmin, request, queryset):
+    try:
+        thread = Thread.objects.get(pk=request.POST.get('to_thread'))
+    except (Thread.DoesNotExist, ValueError):
+        modeladmin.message_user(request, 'Enter the id of the thread to move '
+                                'the posts to.', messages.ERROR)
+        return
+    posts, empty = moderation.move_posts(queryset, thread)
+    moderation.finish()
+    modeladmin.message_user(request, 'Moved {} posts to "{}" ({} empty '
+                            'threads removed).'.format(posts, thread, empty))
+bulk_move_posts.short_description = 'Bulk move selected posts'
+
+
+def bulk_delete_threads(modeladmin, request, queryset):
+    posts, threads = moderation.delete_threads(queryset)
+    moderation.finish()
+    modeladmin.message_user(request, 'Deleted {} threads and {} posts; '
+                            'counters updated.'.format(threads, posts))
+bulk_delete_threads.short_description = 'Bulk delete selected threads'
+
+
+def bulk_move_threads(modeladmin, request, queryset):
+    try:
+        category = Category.objects.get(pk=request.POST.get('to_category'))
+    except (Category.DoesNotExist, ValueError):
+        modeladmin.message_user(request, 'Choose a category to move the '
+                                'threads to.', messages.ERROR)
+        return
+    threads, unused = moderation.move_threads(queryset, category)
+    moderation.finish()
+    modeladmin.message_user(request, 'Moved {} threads to "{}".'.format(
+        threads, category))
+bulk_move_threads.short_description = 'Bulk move selected threads'
+
+
+class ThreadAdmin(admin.ModelAdmin):
+    list_display = ('name', 'category', 'author', 'num_posts', 'created_date')
+    list_filter = ('category',)
+    list_select_related = ('category', 'author')
+    search_fields = ('name', 'author__username')
+    date_hierarchy = 'created_date'
+    action_form = ModerationForm
+    actions = [bulk_delete_threads, bulk_move_threads]
+
+
+class PostAdmin(admin.ModelAdmin):
+    list_display = ('id', 'thread', 'author', 'likes', 'created_date')
+    list_select_related = ('thread', 'author')
+    search_fields = ('author__username', 'thread__name')
+    date_hierarchy = 'created_date'
+    raw_id_fields = ('thread', 'author', 'liked_by')
+    action_form = ModerationForm
+    actions = [bulk_delete_posts, bulk_move_posts]
+
+
 admin.site.register(Profile)
 admin.site.register(Category)
-admin.site.register(Thread)
-admin.site.register(Post)
+admin.site.register(Thread, ThreadAdmin)
+admin.site.register(Post, PostAdmin)
 admin.site.register(Conversation)
 admin.site.register(Pm)
@@ -0,0 +1,136 @@
+""" Hot/cold split of the post table: archiving inactive threads.
+
+Most posts belong to threads nobody has touched in years, yet they bloat
+every Post index the live pages use. Archiving a thread moves its posts (and
+their likes) into ArchivedPost/ArchivedLike with INSERT ... SELECT and
+DELETE, and flags the Thread. The Thread row itself stays, so thread lists,
+URLs, slugs and the denormalized counters are unaffected; only the places
+that read a thread's posts (the thread page, permalinks, export) look in the
+archive when thread.archived is set.
+
+Archived threads render read-only. A reply restores the thread first (see
+Post.new()), moving its posts back the same way.
+
+Archiving runs in batches of threads, one transaction each. Which threads
+are due is worked out from the data (inactive and not archived yet), so an
+interrupted run simply picks up where it stopped.
+"""
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from forum_app.counters import batches, sql_in
+from forum_app.models import Thread, Post, ArchivedPost, ArchivedLike
+
+ARCHIVE_AFTER_DAYS = getattr(settings, 'ARCHIVE_AFTER_DAYS', 730)
+BATCH_SIZE = 50
+
+POST_COLUMNS = ('id, text, author_id, thread_id, created_date, likes, edits, '
+                'edited_date')
+
+
+def _tables():
+    return {
+        'post': Post._meta.db_table,
+        'like': Post.liked_by.through._meta.db_table,
+        'apost': ArchivedPost._meta.db_table,
+        'alike': ArchivedLike._meta.db_table,
+        'columns': POST_COLUMNS,
+    }
+
+
+def due(days=None):
+    """ Live threads with no post for 'days' (default ARCHIVE_AFTER_DAYS).
+    """
+    if days is None:
+        days = ARCHIVE_AFTER_DAYS
+    cutoff = timezone.now() - timedelta(days=days)
+    return Thread.objects.filter(archived=False, most_recent_post__lt=cutoff)
+
+
+def archive_batch(thread_ids):
+    """ Move the posts of 'thread_ids' into the archive. Call inside a
+    transaction.
+    """
+    params = list(thread_ids)
+    where = 'thread_id IN ' + sql_in(params)
+    posts = 'SELECT id FROM {post} WHERE ' + where
+    with connection.cursor() as cursor:
+        for sql in [
+                'INSERT INTO {apost} ({columns}) SELECT {columns} '
+                'FROM {post} WHERE ' + where,
+                'INSERT INTO {alike} (post_id, user_id) SELECT post_id, '
+                'user_id FROM {like} WHERE post_id IN (' + posts + ')',
+                'DELETE FROM {like} WHERE post_id IN (' + posts + ')',
+                'DELETE FROM {post} WHERE ' + where]:
+            cursor.execute(sql.format(**_tables()), params)
+    Thread.objects.filter(id__in=params).update(archived=True)
+    return
+
+
+def restore_batch(thread_ids):
+    """ Move the posts of 'thread_ids' back out of the archive. Call inside
+    a transaction.
+    """
+    params = list(thread_ids)
+    where = 'thread_id IN ' + sql_in(params)
+    posts = 'SELECT id FROM {apost} WHERE ' + where
+    with connection.cursor() as cursor:
+        for sql in [
+                'INSERT INTO {post} ({columns}) SELECT {columns} '
+                'FROM {apost} WHERE ' + where,
+                'INSERT INTO {like} (post_id, user_id) SELECT post_id, '
+                'user_id FROM {alike} WHERE post_id IN (' + posts + ')',
+                'DELETE FROM {alike} WHERE post_id IN (' + posts + ')',
+                'DELETE FROM {apost} WHERE ' + where]:
+            cursor.execute(sql.format(**_tables()), params)
+    Thread.objects.filter(id__in=params).update(archived=False)
+    return
+
+
+def restore_thread(thread):
+    """ Bring 'thread' back to the live tables, e.g. before a reply.
+    """
+    with transaction.atomic():
+        restore_batch([thread.pk])
+    thread.archived = False
+    thread.mark_clean('archived')
+    return
+
+
+def archive_threads(threads, batch_size=BATCH_SIZE, pause=0, log=None):
+    """ Archive the threads of queryset 'threads', 'batch_size' threads
+    per transaction. Returns the number of threads archived.
+    """
+    done = 0
+    for chunk in batches(threads.filter(archived=False), 'id', batch_size):
+        with transaction.atomic():
+            archive_batch(chunk)
+        done += len(chunk)
+        if log is not None:
+            log('  {} threads archived so far'.format(done))
+        if pause:
+            time.sleep(pause)
+    return done
+
+
+def thread_posts(thread):
+    """ Posts of 'thread' in page order, from wherever they are.
+    """
+    model = ArchivedPost if thread.archived else Post
+    return model.objects.filter(thread=thread).order_by('created_date', 'id')
+
+
+def get_post(post_id):
+    """ The Post or ArchivedPost with 'post_id', thread and category
+    selected, or None.
+    """
+    for model in (Post, ArchivedPost):
+        post = (model.objects.select_related('thread__category')
+                .filter(pk=post_id).first())
+        if post is not None:
+            return post
+    return None
@@ -0,0 +1,178 @@
+""" Invalidation bus for the in-process caches of all workers on a host.
+
+The leaderboards, the similar-titles index and the slug cache live in each
+worker's memory and are patched by the model write paths, which only run
+in the worker that served the write. The bus tells the other workers which
+parts of their caches went stale, with nothing but a small file every
+worker maps into memory:
+
+    slot 0          generation, bumped by every publish
+    slots 1..SLOTS  version counters; a key uses slot crc32(key) % SLOTS + 1
+
+publish(channel, key) bumps the key's counter under an flock. A cache that
+loads something calls watch(channel, key, callback); check() (run by
+InvalidationMiddleware at the start of every request) reads the generation
+and, only when it moved, the counters of the watched keys, calling back the
+ones that changed. So the usual per-request cost is reading one integer.
+Keys that share a slot only cause an extra invalidation, never a missed one.
+
+Caches take part by subclassing LocalCache: they name a channel, watch()
+the keys they load, publish() the keys they change and implement
+invalidate(key), where key None means the whole cache.
+
+Without fcntl (Windows) publishes are not locked against each other, which
+at worst loses a bump when two workers publish the same slot at once.
+"""
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import zlib
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+SLOTS = 4096
+COUNTER = struct.Struct('<Q')
+
+
+def default_path():
+    return getattr(settings, 'INVALIDATION_BUS_PATH', None) or os.path.join(
+        tempfile.gettempdir(), 'forum-bus-{:08x}'.format(
+            zlib.crc32(settings.BASE_DIR.encode('utf-8')) & 0xffffffff))
+
+
+def slot(name):
+    return zlib.crc32(name.encode('utf-8')) % SLOTS + 1
+
+
+def key_name(channel, key=None):
+    return channel if key is None else '{}:{}'.format(channel, key)
+
+
+class Bus(object):
+    """ Version counters in a file shared by every process that opens it.
+    The file is (re)opened lazily in each process, so a bus created before
+    a pre-forking server forks works in every worker.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.pid = None
+        self.lock = threading.Lock()
+        # name -> [slot version seen, [(callback, key), ...]]
+        self.watches = {}
+        self.generation = None
+
+    def open(self, path=None):
+        """ Map the file at 'path' (default: the configured one) in this
+        process, creating it the first time.
+        """
+        if path is not None:
+            self.path = path
+        if self.path is None:
+            self.path = default_path()
+        size = (SLOTS + 1) * COUNTER.size
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self.lockfile = open(self.path, 'rb')
+        self.pid = os.getpid()
+        return self
+
+    def _map(self):
+        if self.pid != os.getpid():
+            self.open()
+        return self.map
+
+    def read(self, index):
+        return COUNTER.unpack_from(self._map(), index * COUNTER.size)[0]
+
+    def publish(self, channel, key=None):
+        """ Mark 'key' of 'channel' (all of it for None) stale in every
+        other process. This process' own watches are not called back.
+        """
+        name = key_name(channel, key)
+        index = slot(name)
+        data = self._map()
+        if fcntl is not None:
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        try:
+            old = COUNTER.unpack_from(data, index * COUNTER.size)[0]
+            COUNTER.pack_into(data, index * COUNTER.size, old + 1)
+            generation = COUNTER.unpack_from(data, 0)[0]
+            COUNTER.pack_into(data, 0, generation + 1)
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        with self.lock:
+            watch = self.watches.get(name)
+            if watch is not None and watch[0] == old:
+                watch[0] = old + 1
+        return
+
+    def watch(self, channel, key, callback):
+        """ Call callback(key) whenever another process publishes 'key' of
+        'channel' (or the whole channel, for key None). Watching the same
+        thing twice has no effect.
+        """
+        name = key_name(channel, key)
+        version = self.read(slot(name))
+        with self.lock:
+            watch = self.watches.setdefault(name, [version, []])
+            if (callback, key) not in watch[1]:
+                watch[1].append((callback, key))
+        return
+
+    def check(self):
+        """ Call back the watches whose keys were published since the last
+        check. Returns how many fired.
+        """
+        generation = self.read(0)
+        if generation == self.generation:
+            return 0
+        self.generation = generation
+        fired = []
+        with self.lock:
+            for name, watch in self.watches.items():
+                version = self.read(slot(name))
+                if version != watch[0]:
+                    watch[0] = version
+                    fired.extend(watch[1])
+        for callback, key in fired:
+            callback(key)
+        return len(fired)
+
+
+bus = Bus()
+
+
+class LocalCache(object):
+    """ Base for in-process caches kept coherent through the bus. With
+    'channel' None the cache stays private to its process (e.g. in the
+    benchmarks).
+    """
+    channel = None
+
+    def watch(self, key=None):
+        if self.channel is not None:
+            bus.watch(self.channel, key, self.invalidate)
+        return
+
+    def publish(self, key=None):
+        if self.channel is not None:
+            bus.publish(self.channel, key)
+        return
+
+    def invalidate(self, key=None):
+        """ Drop what is cached for 'key', or everything for None.
+        """
+        raise NotImplementedError
@@ -0,0 +1,259 @@
+""" Set-based recomputation of the denormalized counters.
+
+Category.num_threads, Category.num_posts, Category.most_recent_post,
+Thread.num_posts, Thread.most_recent_post, Thread.last_post_id,
+Conversation.most_recent_pm, Profile.rank, UserStats and CategoryRank are
+normally kept up to date by the model write paths. Anything that writes in
+bulk (imports, moderation, ...) bypasses those, and calls these functions
+afterwards instead. Each function is a handful of UPDATE ... SELECT
+statements; none of them loads rows into Python.
+
+Every function takes an optional list of ids to limit the work to. Keep those
+lists short (a few hundred) so each statement stays small.
+
+Archived threads (see archive.py) keep the thread counters they had when
+they were archived; their posts still count towards their authors.
+"""
+from django.db import connection
+
+from forum_app.models import Category, Thread, Post, Profile, UserStats
+from forum_app.models import CategoryRank, Conversation, Pm, ArchivedPost
+
+
+def sql_in(ids):
+    """ '(%s, %s, ...)', one placeholder per id, for an IN clause.
+    """
+    return '({})'.format(', '.join(['%s'] * len(ids)))
+
+
+def _where_in(column, ids):
+    """ SQL fragment and params limiting 'column' to 'ids' (all if None).
+    """
+    if ids is None:
+        return '', []
+    ids = list(ids)
+    if not ids:
+        return ' WHERE 0 = 1', []
+    return ' WHERE {} IN {}'.format(column, sql_in(ids)), ids
+
+
+def _live(where, params):
+    """ 'where' (from _where_in) further limited to threads that are not
+    archived.
+    """
+    clause = ' AND archived = %s' if where else ' WHERE archived = %s'
+    return where + clause, params + [False]
+
+
+def _tables():
+    return {
+        'category': Category._meta.db_table,
+        'thread': Thread._meta.db_table,
+        'post': Post._meta.db_table,
+        'apost': ArchivedPost._meta.db_table,
+        'profile': Profile._meta.db_table,
+        'stats': UserStats._meta.db_table,
+        'catrank': CategoryRank._meta.db_table,
+        'conversation': Conversation._meta.db_table,
+        'pm': Pm._meta.db_table,
+    }
+
+
+def batches(rows, key, size):
+    """ Yield lists of up to 'size' values of 'key' from queryset 'rows', in
+    key order. Each batch is a fresh query starting after the previous one,
+    so no cursor stays open while we write.
+    """
+    last = None
+    while True:
+        page = rows if last is None else rows.filter(**{key + '__gt': last})
+        chunk = list(page.order_by(key).values_list(key, flat=True)[:size])
+        if not chunk:
+            return
+        yield chunk
+        last = chunk[-1]
+
+
+def recompute_threads(thread_ids=None):
+    """ Thread.num_posts, most_recent_post and last_post_id from Post.
+    """
+    where, params = _live(*_where_in('id', thread_ids))
+    sql = ("UPDATE {thread} SET "
+           "num_posts = (SELECT COUNT(*) FROM {post} p "
+           "WHERE p.thread_id = {thread}.id), "
+           "most_recent_post = (SELECT MAX(p.created_date) FROM {post} p "
+           "WHERE p.thread_id = {thread}.id), "
+           "last_post_id = (SELECT COALESCE(MAX(p.id), 0) FROM {post} p "
+           "WHERE p.thread_id = {thread}.id)").format(**_tables())
+    with connection.cursor() as cursor:
+        cursor.execute(sql + where, params)
+        return cursor.rowcount
+
+
+def recompute_categories(category_ids=None):
+    """ Category.num_threads, num_posts and most_recent_post from Thread.
+    Run recompute_threads() first if the thread counters may be off too.
+    """
+    where, params = _where_in('id', category_ids)
+    sql = ("UPDATE {category} SET "
+           "num_threads = (SELECT COUNT(*) FROM {thread} t "
+           "WHERE t.category_id = {category}.id), "
+           "num_posts = (SELECT COALESCE(SUM(t.num_posts), 0) FROM {thread} t "
+           "WHERE t.category_id = {category}.id), "
+           "most_recent_post = (SELECT MAX(t.most_recent_post) FROM {thread} t "
+           "WHERE t.category_id = {category}.id)").format(**_tables())
+    with connection.cursor() as cursor:
+        cursor.execute(sql + where, params)
+        return cursor.rowcount
+
+
+def recompute_users(user_ids=None):
+    """ UserStats, Profile.rank and CategoryRank from Thread and Post. Rank
+    scoring matches the write paths: thread +5, post +1, net likes.
+    """
+    tables = _tables()
+    where, params = _where_in('user_id', user_ids)
+    stats_sql = ("UPDATE {stats} SET "
+                 "num_posts = (SELECT COUNT(*) FROM {post} p "
+                 "WHERE p.author_id = {stats}.user_id) + "
+                 "(SELECT COUNT(*) FROM {apost} p "
+                 "WHERE p.author_id = {stats}.user_id), "
+                 "num_threads = (SELECT COUNT(*) FROM {thread} t "
+                 "WHERE t.author_id = {stats}.user_id), "
+                 "likes_received = (SELECT COALESCE(SUM(p.likes), 0) "
+                 "FROM {post} p WHERE p.author_id = {stats}.user_id) + "
+                 "(SELECT COALESCE(SUM(p.likes), 0) "
+                 "FROM {apost} p WHERE p.author_id = {stats}.user_id)"
+                 ).format(**tables)
+    rank_sql = ("UPDATE {profile} SET rank = COALESCE((SELECT "
+                "5 * s.num_threads + s.num_posts + s.likes_received "
+                "FROM {stats} s WHERE s.user_id = {profile}.user_id), 0)"
+                ).format(**tables)
+    # the ids are bound once, on the union (the database pushes the IN down
+    # into each part), so a batch may be as large as the parameter limit
+    author_where, author_params = _where_in('author_id', user_ids)
+    catrank_sql = ("INSERT INTO {catrank} (user_id, category_id, rank) "
+                   "SELECT author_id, category_id, SUM(score) FROM ("
+                   "SELECT t.author_id AS author_id, t.category_id AS "
+                   "category_id, 5 AS score FROM {thread} t"
+                   " UNION ALL "
+                   "SELECT p.author_id, t.category_id, 1 + p.likes "
+                   "FROM {post} p INNER JOIN {thread} t ON t.id = p.thread_id"
+                   " UNION ALL "
+                   "SELECT p.author_id, t.category_id, 1 + p.likes "
+                   "FROM {apost} p INNER JOIN {thread} t ON t.id = p.thread_id"
+                   ") scores" + author_where +
+                   " GROUP BY author_id, category_id").format(**tables)
+    with connection.cursor() as cursor:
+        cursor.execute(stats_sql + where, params)
+        rows = cursor.rowcount
+        cursor.execute(rank_sql + where, params)
+        cursor.execute("DELETE FROM {catrank}".format(**tables) + where,
+                       params)
+        cursor.execute(catrank_sql, author_params)
+    return rows
+
+
+def recompute_conversations(conversation_ids=None):
+    """ Conversation.most_recent_pm from Pm.
+    """
+    where, params = _where_in('id', conversation_ids)
+    sql = ("UPDATE {conversation} SET "
+           "most_recent_pm = (SELECT MAX(m.created_date) FROM {pm} m "
+           "WHERE m.conversation_id = {conversation}.id)").format(**_tables())
+    with connection.cursor() as cursor:
+        cursor.execute(sql + where, params)
+        return cursor.rowcount
+
+
+def _drift(sql, ids, columns, live=False):
+    """ Run a SELECT returning (id, stored1, actual1, stored2, actual2, ...)
+    and return (id, column, stored, actual) for every value that is off.
+    With 'live', archived threads are left out.
+    """
+    where, params = _where_in('id', ids)
+    if live:
+        where, params = _live(where, params)
+    drift = []
+    with connection.cursor() as cursor:
+        cursor.execute(sql.format(where=where, **_tables()), params)
+        for row in cursor.fetchall():
+            for i, column in enumerate(columns):
+                stored, actual = row[1 + 2 * i], row[2 + 2 * i]
+                # SQLite hands back MAX() of a datetime column as text in
+                # the same format the column is stored in
+                if stored != actual and str(stored) != str(actual):
+                    drift.append((row[0], column, stored, actual))
+    return drift
+
+
+def thread_drift(thread_ids=None):
+    """ Threads whose num_posts/most_recent_post/last_post_id disagree with
+    Post.
+    """
+    return _drift("SELECT id, num_posts, (SELECT COUNT(*) FROM {post} p "
+                  "WHERE p.thread_id = {thread}.id), most_recent_post, "
+                  "(SELECT MAX(p.created_date) FROM {post} p "
+                  "WHERE p.thread_id = {thread}.id), last_post_id, "
+                  "(SELECT COALESCE(MAX(p.id), 0) FROM {post} p "
+                  "WHERE p.thread_id = {thread}.id) FROM {thread}{where}",
+                  thread_ids,
+                  ['num_posts', 'most_recent_post', 'last_post_id'],
+                  live=True)
+
+
+def category_drift(category_ids=None):
+    """ Categories whose counters disagree with their threads' counters.
+    """
+    return _drift("SELECT id, num_threads, (SELECT COUNT(*) FROM {thread} t "
+                  "WHERE t.category_id = {category}.id), num_posts, "
+                  "(SELECT COALESCE(SUM(t.num_posts), 0) FROM {thread} t "
+                  "WHERE t.category_id = {category}.id), most_recent_post, "
+                  "(SELECT MAX(t.most_recent_post) FROM {thread} t "
+                  "WHERE t.category_id = {category}.id) "
+                  "FROM {category}{where}",
+                  category_ids,
+                  ['num_threads', 'num_posts', 'most_recent_post'])
+
+
+def user_drift(user_ids=None):
+    """ Users whose UserStats or Profile.rank disagree with Thread and Post.
+    """
+    return _drift("SELECT id, num_posts, posts, num_threads, threads, "
+                  "likes_received, likes, rank, 5 * threads + posts + likes "
+                  "FROM (SELECT s.user_id AS id, s.num_posts, s.num_threads, "
+                  "s.likes_received, pr.rank, "
+                  "(SELECT COUNT(*) FROM {post} p "
+                  "WHERE p.author_id = s.user_id) + "
+                  "(SELECT COUNT(*) FROM {apost} p "
+                  "WHERE p.author_id = s.user_id) AS posts, "
+                  "(SELECT COUNT(*) FROM {thread} t "
+                  "WHERE t.author_id = s.user_id) AS threads, "
+                  "(SELECT COALESCE(SUM(p.likes), 0) FROM {post} p "
+                  "WHERE p.author_id = s.user_id) + "
+                  "(SELECT COALESCE(SUM(p.likes), 0) FROM {apost} p "
+                  "WHERE p.author_id = s.user_id) AS likes "
+                  "FROM {stats} s INNER JOIN {profile} pr "
+                  "ON pr.user_id = s.user_id) counts{where}",
+                  user_ids,
+                  ['num_posts', 'num_threads', 'likes_received', 'rank'])
+
+
+def conversation_drift(conversation_ids=None):
+    """ Conversations whose most_recent_pm disagrees with Pm.
+    """
+    return _drift("SELECT id, most_recent_pm, (SELECT MAX(m.created_date) "
+                  "FROM {pm} m WHERE m.conversation_id = {conversation}.id) "
+                  "FROM {conversation}{where}",
+                  conversation_ids, ['most_recent_pm'])
+
+
+def recompute_all():
+    """ Recompute every counter in the right order. Callers should clear the
+    in-process leaderboards afterwards.
+    """
+    recompute_threads()
+    recompute_categories()
+    recompute_users()
+    recompute_conversations()
+    return
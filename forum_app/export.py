@@ -0,0 +1,231 @@
+""" Streaming export of threads and categories, for archiving.
+
+Two formats, both compressed on the fly:
+    jsonl - gzipped JSONL in the same record format import_forum reads
+            (post text is exported as stored HTML, so re-import it with
+            --no-render). Each author and liker gets a user record before
+            their first post or like; ids are kept, so import it into an
+            empty database. Passwords and email addresses are left out,
+            so imported accounts need a password reset to log in.
+    html  - a .tar.gz with one self-contained HTML page per thread
+
+Exports are generators of compressed byte chunks, so the same code writes a
+file from the management command and streams a response from the view.
+Threads and posts are read with QuerySet.iterator(), which uses a server-side
+cursor where the database has one and fetches in chunks elsewhere, so memory
+use doesn't grow with the size of the export (bar the set of user ids
+already exported). For html, one thread page is
+held in memory at a time (tar needs each member's size up front).
+"""
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import io
+import json
+import tarfile
+import time
+
+from django.template.loader import render_to_string
+
+from forum_app import archive
+from forum_app.models import Thread, Post, ArchivedLike
+
+FORMATS = ('jsonl', 'html')
+
+
+class Sink(object):
+    """ Write-only file object that collects what gzip/tarfile write so a
+    generator can hand it out chunk by chunk.
+    """
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def select_threads(category=None, thread=None):
+    """ Threads to export: one thread, one category (Category objects or
+    None), or everything. Ordered so each category's threads come together.
+    """
+    threads = Thread.objects.select_related('category', 'author')
+    if thread is not None:
+        threads = threads.filter(pk=thread.pk)
+    elif category is not None:
+        threads = threads.filter(category=category)
+    return threads.order_by('category_id', 'id')
+
+
+def thread_posts(thread):
+    return (archive.thread_posts(thread).select_related('author')
+            .iterator())
+
+
+def thread_likes(thread):
+    """ (post id, user id, username, date joined) of every like in
+    'thread', from wherever its posts are. One query.
+    """
+    model = ArchivedLike if thread.archived else Post.liked_by.through
+    return (model.objects.filter(post__thread=thread).order_by('post_id', 'id')
+            .values_list('post_id', 'user_id', 'user__username',
+                         'user__date_joined'))
+
+
+def user_record(seen, user_id, username, date_joined):
+    """ The user record for 'user_id' the first time it comes up, else
+    None.
+    """
+    if user_id in seen:
+        return None
+    seen.add(user_id)
+    return {'type': 'user', 'id': user_id, 'username': username,
+            'date_joined': date_joined.isoformat()}
+
+
+def jsonl_records(threads):
+    """ Records for 'threads' in import_forum's format, parents first.
+    """
+    category_id = None
+    users = set()
+    for thread in threads.iterator():
+        if thread.category_id != category_id:
+            category_id = thread.category_id
+            yield {'type': 'category', 'id': category_id,
+                   'name': thread.category.name,
+                   'slug': thread.category.slug}
+        author = thread.author
+        record = user_record(users, author.pk, author.username,
+                             author.date_joined)
+        if record is not None:
+            yield record
+        yield {'type': 'thread', 'id': thread.pk, 'name': thread.name,
+               'slug': thread.slug, 'category': category_id,
+               'author': thread.author_id,
+               'author_name': thread.author.username,
+               'created_date': thread.created_date.isoformat()}
+        for post in thread_posts(thread):
+            author = post.author
+            record = user_record(users, author.pk, author.username,
+                                 author.date_joined)
+            if record is not None:
+                yield record
+            yield {'type': 'post', 'id': post.pk, 'thread': thread.pk,
+                   'author': post.author_id,
+                   'author_name': post.author.username,
+                   'text': post.text, 'likes': post.likes,
+                   'created_date': post.created_date.isoformat()}
+        for post_id, user_id, username, date_joined in thread_likes(thread):
+            record = user_record(users, user_id, username, date_joined)
+            if record is not None:
+                yield record
+            yield {'type': 'like', 'post': post_id, 'user': user_id}
+
+
+def export_jsonl(threads):
+    """ Gzipped JSONL, yielded in chunks of roughly 64KB.
+    """
+    sink = Sink()
+    out = gzip.GzipFile(fileobj=sink, mode='wb')
+    pending = 0
+    for record in jsonl_records(threads):
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        out.write(line)
+        pending += len(line)
+        if pending >= 65536:
+            out.flush()
+            pending = 0
+            yield sink.take()
+    out.close()
+    yield sink.take()
+
+
+def render_thread(thread_id):
+    """ (archive member name, page bytes) for one thread. Runs in pool
+    workers, so it takes an id and does its own queries.
+    """
+    thread = Thread.objects.select_related('category', 'author').get(
+        pk=thread_id)
+    html = render_to_string('forum/export_thread.html', {
+        'thread': thread, 'category': thread.category,
+        'posts': thread_posts(thread)})
+    name = '{}/{}.html'.format(thread.category.slug, thread.slug)
+    return name, html.encode('utf-8')
+
+
+def init_worker():
+    """ Pool workers start from a fork of a process that may hold open
+    database connections; make sure each opens its own.
+    """
+    import django
+    from django.db import connections
+    django.setup()
+    for conn in connections.all():
+        conn.close()
+
+
+def ordered_map(pool, func, items, window):
+    """ Like pool.map(), but never more than 'window' tasks in flight, so
+    results of a slow consumer don't pile up in memory.
+    """
+    pending = []
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def export_html(threads, workers=1):
+    """ A .tar.gz of thread pages, yielded member by member. With workers > 1
+    the pages are rendered in a process pool.
+    """
+    thread_ids = threads.values_list('id', flat=True).iterator()
+    pool = None
+    if workers > 1:
+        from django.db import connections
+        connections.close_all()
+        pool = ProcessPoolExecutor(max_workers=workers,
+                                   initializer=init_worker)
+        pages = ordered_map(pool, render_thread, thread_ids, workers * 4)
+    else:
+        pages = (render_thread(pk) for pk in thread_ids)
+    sink = Sink()
+    archive = tarfile.open(fileobj=sink, mode='w|gz')
+    try:
+        for name, page in pages:
+            info = tarfile.TarInfo(name)
+            info.size = len(page)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(page))
+            yield sink.take()
+        archive.close()
+        yield sink.take()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def export(threads, fmt='jsonl', workers=1):
+    """ Compressed chunks of 'threads' exported as 'fmt'.
+    """
+    if fmt == 'html':
+        return export_html(threads, workers)
+    return export_jsonl(threads)
+
+
+def filename(fmt, category=None, thread=None):
+    name = 'forum'
+    if thread is not None:
+        name = '{}-{}'.format(thread.category.slug, thread.slug)
+    elif category is not None:
+        name = category.slug
+    return name + ('.tar.gz' if fmt == 'html' else '.jsonl.gz')
@@ -0,0 +1,101 @@
+""" Cached per-post HTML for the thread page.
+
+Everything about a post that looks the same to every viewer (text, author,
+rank, date, like count) is rendered once into a fragment and kept in the
+cache. The key holds every value the fragment depends on, so a like, an
+edit or a rank change simply produces a new key and stale entries age out; nothing
+has to be invalidated.
+
+The few viewer-dependent bits (like buttons, PM and edit links) and the thread title
+on the opening post are left as marker comments in the fragment and filled
+in per request with plain string replacement.
+"""
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.template.loader import render_to_string
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+FRAGMENT_TIMEOUT = 60 * 60 * 24
+
+HEADER_MARK = '<!--header-->'
+PM_MARK = '<!--pm-->'
+LIKE_MARK = '<!--like-->'
+EDIT_MARK = '<!--edit-->'
+
+LIKE_BUTTONS = (
+    '<span id="{0}-like">'
+    '<a href="#" onclick="like_post({0}, \'like\')">'
+    '<span class="glyphicon glyphicon-thumbs-up"></span></a> '
+    '<a style="margin-left:10px;" href="#" '
+    'onclick="like_post({0},\'dislike\')">'
+    '<span class="glyphicon glyphicon-thumbs-down"></span></a></span>')
+
+
+def fragment_key(post):
+    """ Cache key for a post's fragment. Needs post.author.profile loaded.
+    """
+    return 'post:{}:{}:{}:{}'.format(post.pk, post.likes, post.edits,
+                                     post.author.profile.rank)
+
+
+def render_fragment(post):
+    return render_to_string('forum/post_fragment.html', {'post': post})
+
+
+def fragments(posts):
+    """ {post pk: fragment html} for 'posts', from the cache where possible.
+    Missing fragments are rendered and stored with one set_many().
+    """
+    keys = dict((fragment_key(post), post) for post in posts)
+    found = cache.get_many(list(keys))
+    missing = {}
+    for key, post in keys.items():
+        if key not in found:
+            missing[key] = render_fragment(post)
+    if missing:
+        cache.set_many(missing, FRAGMENT_TIMEOUT)
+        found.update(missing)
+    return dict((post.pk, found[key]) for key, post in keys.items())
+
+
+def render_posts(posts, viewer, thread, initial_post_id, liked_ids):
+    """ Finished HTML for each post on a thread page, in order.
+    ARGs:
+        posts - Post objects, with author__profile selected
+        viewer - request.user
+        thread - the Thread, for the title on the opening post
+        initial_post_id - pk of the thread's first post
+        liked_ids - pks of the posts on this page 'viewer' already rated
+    """
+    html = fragments(posts)
+    logged_in = viewer.is_authenticated
+    can_edit = logged_in and not thread.archived
+    pm_links = {}
+    rendered = []
+    for position, post in enumerate(posts):
+        fragment = html[post.pk]
+        header = ''
+        if position == 0 and post.pk == initial_post_id:
+            header = format_html('<h2 class="thread-header">{}</h2>',
+                                 thread.name)
+        pm_link = like = edit = ''
+        if can_edit and (viewer.is_staff or viewer.pk == post.author_id):
+            edit = format_html(' | <a href="{}">edit</a>',
+                               reverse('post_edit', args=[post.pk]))
+        if logged_in and viewer.pk != post.author_id:
+            if post.author_id not in pm_links:
+                pm_links[post.author_id] = format_html(
+                    ' | <a href="{}"><i class="fa fa-envelope-o" '
+                    'aria-hidden="true"></i></a>',
+                    reverse('conversation', args=[viewer.username,
+                                                  post.author.username]))
+            pm_link = pm_links[post.author_id]
+            if post.pk not in liked_ids:
+                like = LIKE_BUTTONS.format(post.pk)
+        fragment = (fragment.replace(HEADER_MARK, header, 1)
+                    .replace(PM_MARK, pm_link, 1)
+                    .replace(EDIT_MARK, edit, 1)
+                    .replace(LIKE_MARK, like, 1))
+        rendered.append(mark_safe(fragment))
+    return rendered
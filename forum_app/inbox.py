@@ -0,0 +1,132 @@
+""" Deleting conversations and purging private messages.
+
+Every user has their own Conversation and their own copy of each Pm, so
+deleting a conversation only ever concerns the user's copies. Rather than
+cascading over all of them inside the request, hide() just records when the
+conversation was cleared: messages up to Conversation.cleared_before no
+longer show, and the conversation is hidden until a new message arrives.
+
+purge() (run by the purge_pms command) deletes those cleared messages, and
+any older than PM_RETENTION_DAYS when that is set, in batches of BATCH_SIZE
+ids, one short transaction each, then drops conversations left empty.
+Which rows are due is worked out from the data every time, so a purge can
+be stopped at any point and run again.
+"""
+from datetime import timedelta
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, Count, F, Q, Sum, When
+from django.db.models.functions import Length
+from django.utils import timezone
+
+from forum_app import counters
+from forum_app.counters import batches, sql_in
+from forum_app.models import Conversation, Pm
+
+PM_RETENTION_DAYS = getattr(settings, 'PM_RETENTION_DAYS', None)
+# ids per batch; stays under the 999 variables SQLite binds per statement
+BATCH_SIZE = 900
+
+
+def visible(conversations):
+    """ 'conversations' without the cleared ones that had no message since.
+    """
+    return conversations.filter(
+        Q(cleared_before__isnull=True) |
+        Q(most_recent_pm__gt=F('cleared_before')))
+
+
+def conversations(user):
+    """ The visible conversations of 'user', each with 'num_pms', the number
+    of messages it shows.
+    """
+    shown = When(Q(cleared_before__isnull=True) |
+                 Q(pm__created_date__gt=F('cleared_before')), then=1)
+    return (visible(Conversation.objects.filter(belongs_to=user))
+            .annotate(num_pms=Count(Case(shown))))
+
+
+def messages(conversation):
+    """ The Pms of 'conversation' that haven't been cleared.
+    """
+    pms = Pm.objects.filter(conversation=conversation)
+    if conversation.cleared_before is not None:
+        pms = pms.filter(created_date__gt=conversation.cleared_before)
+    return pms
+
+
+def hide(conversation):
+    """ Clear 'conversation' for its owner. Its messages are deleted later
+    by purge().
+    """
+    now = timezone.now()
+    Conversation.objects.filter(pk=conversation.pk).update(cleared_before=now)
+    conversation.cleared_before = now
+    conversation.mark_clean('cleared_before')
+    return
+
+
+def cutoff(days=None):
+    """ Messages created before this have expired; None if they never do.
+    """
+    if days is None:
+        days = PM_RETENTION_DAYS
+    if days is None:
+        return None
+    return timezone.now() - timedelta(days=days)
+
+
+def due(days=None):
+    """ Pms that purge() would delete: cleared or expired.
+    """
+    condition = Q(created_date__lte=F('conversation__cleared_before'))
+    expired = cutoff(days)
+    if expired is not None:
+        condition |= Q(created_date__lt=expired)
+    return Pm.objects.filter(condition)
+
+
+def purge_batch(pm_ids):
+    """ Delete 'pm_ids' and fix the most_recent_pm of their conversations.
+    Call inside a transaction. Returns the characters of text reclaimed.
+    """
+    pms = Pm.objects.filter(id__in=pm_ids)
+    size = pms.aggregate(size=Sum(Length('text')))['size'] or 0
+    conversation_ids = list(pms.order_by().values_list('conversation_id',
+                                                       flat=True).distinct())
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE id IN {}'.format(
+            Pm._meta.db_table, sql_in(pm_ids)), pm_ids)
+    counters.recompute_conversations(conversation_ids)
+    return size
+
+
+def empty_conversations():
+    """ Conversations without any message left.
+    """
+    return Conversation.objects.filter(most_recent_pm__isnull=True).exclude(
+        id__in=Pm.objects.values('conversation_id'))
+
+
+def purge(days=None, batch_size=BATCH_SIZE, pause=0, log=None):
+    """ Delete cleared and expired messages, then the conversations left
+    empty. Returns (messages deleted, characters of text reclaimed,
+    conversations deleted).
+    """
+    deleted = reclaimed = 0
+    for chunk in batches(due(days), 'id', batch_size):
+        with transaction.atomic():
+            reclaimed += purge_batch(chunk)
+        deleted += len(chunk)
+        if log is not None:
+            log('  {} messages deleted so far'.format(deleted))
+        if pause:
+            time.sleep(pause)
+    conversations = 0
+    for chunk in batches(empty_conversations(), 'id', batch_size):
+        with transaction.atomic():
+            conversations += Conversation.objects.filter(
+                id__in=chunk, most_recent_pm__isnull=True).delete()[0]
+    return deleted, reclaimed, conversations
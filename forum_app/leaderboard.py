@@ -0,0 +1,197 @@
+""" In-process top-K rank leaderboards.
+
+Reading "top users" from the database on every page would be an index scan
+per request. Instead each worker keeps the top LEADERBOARD_SIZE entries of
+every leaderboard it has shown in memory. A board is loaded from the index on
+first use and then patched in place whenever a rank changes (see
+rank_changed(), called from the model write paths), so a warm board costs no
+queries at all.
+
+Boards are keyed by None for the site-wide leaderboard and by category id for
+per-category leaderboards. A change patches the boards of the worker that
+made it; the other workers drop the board through the invalidation bus and
+reload it on next use. Most changes (a post or like by someone far from the
+top) leave a board as it is and publish nothing. A user entering or leaving
+the top K is published straight away; new ranks of users already listed,
+and changes to boards this worker hasn't loaded, at most once per
+LEADERBOARD_PUBLISH_INTERVAL seconds per board, so other workers may show
+those up to that long late.
+"""
+import threading
+import time
+
+from django.conf import settings
+
+from forum_app.bus import LocalCache
+
+LEADERBOARD_SIZE = 50
+LEADERBOARD_PUBLISH_INTERVAL = getattr(settings,
+                                       'LEADERBOARD_PUBLISH_INTERVAL', 30)
+
+
+class Entry(object):
+    """ One row of a leaderboard. 'row_id' is the id of the ranked row
+    (Profile or CategoryRank) and only breaks ties the same way the database
+    ordering ('-rank', '-id') does.
+    """
+    __slots__ = ('rank', 'row_id', 'user_id', 'username')
+
+    def __init__(self, rank, row_id, user_id, username):
+        self.rank = rank
+        self.row_id = row_id
+        self.user_id = user_id
+        self.username = username
+
+    def sort_key(self):
+        return (self.rank, self.row_id)
+
+
+class TopK(LocalCache):
+    """ Keeps the top 'size' entries for any number of boards. 'loader' is a
+    callable (key, size) -> list of Entry, used to (re)load a board.
+    """
+    def __init__(self, loader, size=LEADERBOARD_SIZE, channel=None,
+                 publish_interval=LEADERBOARD_PUBLISH_INTERVAL):
+        self.loader = loader
+        self.size = size
+        self.channel = channel
+        self.publish_interval = publish_interval
+        self.boards = {}
+        # board key: time of the last publish, and the keys owed one
+        self.published = {}
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        if self.pending:
+            self.publish_pending()
+        with self.lock:
+            board = self.boards.get(key)
+        if board is None:
+            # watch before loading, so a change made meanwhile isn't missed
+            self.watch()
+            self.watch(key)
+            board = self.loader(key, self.size)
+            with self.lock:
+                self.boards[key] = board
+        return board
+
+    def publish_now(self, key, now):
+        self.publish(key)
+        with self.lock:
+            self.published[key] = now
+            self.pending.discard(key)
+        return
+
+    def publish_soon(self, key, now):
+        """ Publish 'key' unless it was published within the interval; then
+        it is owed a publish once the interval is up.
+        """
+        if now - self.published.get(key, 0) >= self.publish_interval:
+            self.publish_now(key, now)
+        else:
+            with self.lock:
+                self.pending.add(key)
+        return
+
+    def publish_pending(self, now=None):
+        if now is None:
+            now = time.time()
+        for key in list(self.pending):
+            if now - self.published.get(key, 0) >= self.publish_interval:
+                self.publish_now(key, now)
+        return
+
+    def offer(self, key, entry, now=None):
+        """ Record that 'entry.user_id' now has 'entry.rank' on board 'key'.
+        Boards that were never loaded are left alone; other workers drop
+        theirs when the change can show on them.
+        """
+        if now is None:
+            now = time.time()
+        if self.pending:
+            self.publish_pending(now)
+        with self.lock:
+            board = self.boards.get(key)
+            if board is None:
+                changed = 'unknown'
+            else:
+                changed = self.patch(key, board, entry)
+        if changed == 'members':
+            self.publish_now(key, now)
+        elif changed in ('ranks', 'unknown'):
+            self.publish_soon(key, now)
+        return
+
+    def patch(self, key, board, entry):
+        """ Apply 'entry' to the loaded 'board'. Returns what changed:
+        'members' if a user entered or left the top K, 'ranks' if only
+        listed users moved, None if nothing did. Call with the lock held.
+        """
+        was_listed = False
+        kept = []
+        for old in board:
+            if old.user_id == entry.user_id:
+                was_listed = True
+            else:
+                kept.append(old)
+        full = len(board) >= self.size
+        if full and entry.sort_key() < board[-1].sort_key():
+            if was_listed:
+                # dropped off the bottom; whoever replaces it is only
+                # known to the database, so reload on next use.
+                del self.boards[key]
+                return 'members'
+            return None
+        kept.append(entry)
+        kept.sort(key=Entry.sort_key, reverse=True)
+        # copy-on-write so readers iterating the old list are unaffected
+        self.boards[key] = kept[:self.size]
+        return 'ranks' if was_listed else 'members'
+
+    def discard(self, key=None):
+        with self.lock:
+            self.boards.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.boards.clear()
+
+    def invalidate(self, key=None):
+        if key is None:
+            self.clear()
+        else:
+            self.discard(key)
+
+
+def load_board(key, size):
+    from forum_app.models import Profile, CategoryRank
+    if key is None:
+        rows = Profile.objects.select_related('user').order_by('-rank', '-id')
+    else:
+        rows = (CategoryRank.objects.filter(category_id=key)
+                .select_related('user').order_by('-rank', '-id'))
+    return [Entry(row.rank, row.id, row.user_id, row.user.username)
+            for row in rows[:size]]
+
+
+boards = TopK(load_board, channel='leaderboard')
+
+
+def top(category_id=None, n=LEADERBOARD_SIZE):
+    """ Top 'n' entries, highest rank first, site-wide or for one category.
+    """
+    return boards.get(category_id)[:n]
+
+
+def rank_changed(user, profile, category_rank=None):
+    """ Called after a user's rank was written. 'profile' is the user's
+    Profile with its new rank, 'category_rank' the CategoryRank row that
+    changed alongside it (if any).
+    """
+    boards.offer(None, Entry(profile.rank, profile.id, user.pk, user.username))
+    if category_rank is not None:
+        boards.offer(category_rank.category_id,
+                     Entry(category_rank.rank, category_rank.id, user.pk,
+                           user.username))
+    return
@@ -0,0 +1,430 @@
+""" Concurrent load test against a real local WSGI server.
+
+The bench_* commands time one code path in one process. This runs the whole
+app the way it is deployed: forum_project's WSGI application in several
+pre-forked worker processes sharing one listening socket (wsgiref servers,
+one request at a time each, like gunicorn's sync workers), driven over HTTP
+by many concurrent clients. That is where SQLite's single writer shows: a
+Post.new holding the write lock while other workers' readers and writers
+wait on it.
+
+Every client logs in as one of the load test users and then runs journeys
+until the time is up, picking a write journey with probability
+'write_ratio':
+
+    reads   browse (category list, then a thread list), read (a thread's
+            last page, sometimes its first), search (search-as-you-type:
+            one request per typed letter)
+    writes  post, like, pm
+
+Each request is recorded as (URL name, status, seconds), with the method
+added to the name for anything but GET ('thread POST'). The report gives
+requests per second overall, how often each journey ran and, per URL name,
+the request count, the error rate (status 0 for a failed connection, or 400
+and up; 429s counted separately) and p50/p95/p99 latency. Errors on the
+write endpoints are the finding, not a failure of the run: a write that
+reads first and then upgrades to the write lock gets "database is locked"
+straight away when another worker holds it. Runs can be saved as JSON and
+compared with a later run.
+
+By default the server uses a fresh SQLite database in a temporary
+directory, migrated and seeded here, so a run never writes to the real
+one. Rate limits are off unless asked for, since the clients post far
+faster than people do.
+"""
+from collections import defaultdict
+import http.client
+import json
+import math
+import multiprocessing
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer
+
+from django.conf import settings
+from django.urls import resolve, reverse
+
+LOADTEST_PASSWORD = 'load-test-password'
+SEARCH_WORDS = ('pizza', 'python', 'garden', 'guitar', 'travel', 'coffee')
+
+READ_JOURNEYS = ('browse', 'read', 'search')
+WRITE_JOURNEYS = ('post', 'like', 'pm')
+
+
+class QuietHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(sock, rate_limits):
+    """ Worker process: serve the app on the inherited socket forever.
+    """
+    # some views print debugging output
+    sys.stdout = open(os.devnull, 'w')
+    settings.DEBUG = False
+    if not rate_limits:
+        settings.RATE_LIMITS = {}
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    server = WSGIServer(sock.getsockname(), QuietHandler,
+                        bind_and_activate=False)
+    server.socket.close()
+    server.socket = sock
+    server.server_name = 'localhost'
+    server.server_port = sock.getsockname()[1]
+    server.setup_environ()
+    server.set_app(application)
+    server.serve_forever()
+
+
+class Server(object):
+    """ 'workers' processes serving the app on a free local port.
+    """
+    def __init__(self, workers=4, rate_limits=False):
+        self.workers = workers
+        self.rate_limits = rate_limits
+        self.processes = []
+
+    def start(self):
+        from django.db import connections
+        # the workers must not share this process' database connection
+        connections.close_all()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(128)
+        self.host, self.port = self.sock.getsockname()
+        context = multiprocessing.get_context('fork')
+        for i in range(self.workers):
+            process = context.Process(target=serve,
+                                      args=(self.sock, self.rate_limits))
+            process.daemon = True
+            process.start()
+            self.processes.append(process)
+        return self
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(5)
+        self.sock.close()
+        return
+
+
+class Client(object):
+    """ One browser: keeps cookies, sends the CSRF token with POSTs and
+    records every request in 'results'.
+    """
+    def __init__(self, host, port, results):
+        self.host = host
+        self.port = port
+        self.results = results
+        self.cookies = {}
+
+    def request(self, method, path, data=None):
+        headers = {'Host': '127.0.0.1'}
+        body = None
+        if method == 'POST':
+            token = self.cookies.get('csrftoken', '')
+            data = dict(data or {}, csrfmiddlewaretoken=token)
+            body = urlencode(data)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            headers['X-CSRFToken'] = token
+        if self.cookies:
+            headers['Cookie'] = '; '.join('{}={}'.format(name, value) for
+                                          name, value in self.cookies.items())
+        name = resolve(path.split('?')[0]).url_name
+        if method != 'GET':
+            name += ' ' + method
+        started = time.time()
+        try:
+            connection = http.client.HTTPConnection(self.host, self.port,
+                                                    timeout=60)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            status = response.status
+            for header, value in response.getheaders():
+                if header.lower() == 'set-cookie':
+                    cookie = value.split(';')[0]
+                    self.cookies[cookie.split('=')[0]] = \
+                        cookie.partition('=')[2]
+            connection.close()
+        except (IOError, http.client.HTTPException):
+            status = 0
+        self.results.append((name, status, time.time() - started))
+        return status
+
+    def get(self, path):
+        return self.request('GET', path)
+
+    def post(self, path, data):
+        return self.request('POST', path, data)
+
+
+def seed(users=20, categories=4, threads=10):
+    """ Create the load test users, categories and threads (each with a
+    post) that are missing. Returns the data the journeys pick from.
+    """
+    from forum_app.models import Category, Thread, Post, User
+    accounts = []
+    for i in range(users):
+        username = 'loadtest{}'.format(i)
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            user = User.objects.create_user(username=username,
+                                            password=LOADTEST_PASSWORD)
+        accounts.append((user.pk, username))
+    for c in range(categories):
+        name = 'Load test {}'.format(c)
+        category = Category.objects.filter(name=name).first()
+        if category is None:
+            category = Category(name=name)
+            category.new()
+        for t in range(threads):
+            thread_name = 'Load test {} {} {}'.format(
+                c, t, SEARCH_WORDS[t % len(SEARCH_WORDS)])
+            if Thread.objects.filter(name=thread_name).exists():
+                continue
+            author = User.objects.get(pk=accounts[t % users][0])
+            thread = Thread(name=thread_name, category=category,
+                            author=author)
+            thread.new()
+            Post(text='<p>First post of {}</p>'.format(thread_name),
+                 thread=thread, author=author).new()
+    rows = list(Thread.objects.filter(name__startswith='Load test ')
+                .values_list('id', 'name', 'slug', 'category__slug'))
+    return {'users': accounts,
+            'categories': sorted(set(row[3] for row in rows)),
+            'threads': [{'id': row[0], 'name': row[1], 'slug': row[2],
+                         'category': row[3]} for row in rows],
+            'posts': list(Post.objects.filter(thread_id__in=[
+                row[0] for row in rows]).values_list('id', flat=True))}
+
+
+def fresh_database(directory):
+    """ Point the default database at a new SQLite file in 'directory' and
+    migrate it. Only for a SQLite configuration.
+    """
+    from django.core.management import call_command
+    from django.db import connections
+    connection = connections['default']
+    if connection.vendor != 'sqlite':
+        raise ValueError('a fresh database needs SQLite; run against the '
+                         'configured database instead')
+    connections.close_all()
+    connection.settings_dict['NAME'] = os.path.join(directory, 'load.sqlite3')
+    call_command('migrate', verbosity=0, interactive=False)
+    return
+
+
+def login(client, username):
+    # the category list sets the CSRF cookie the login form needs
+    client.get(reverse('categories'))
+    return client.post(reverse('ajax_login'),
+                       {'username': username, 'password': LOADTEST_PASSWORD})
+
+
+def browse(client, data, rand, me):
+    client.get(reverse('categories'))
+    client.get(reverse('threads', args=[rand.choice(data['categories'])]))
+
+
+def read(client, data, rand, me):
+    thread = rand.choice(data['threads'])
+    path = reverse('thread', args=[thread['category'], thread['slug']])
+    client.get(path)
+    if rand.random() < 0.3:
+        client.get(path + '?page=1')
+
+
+def search(client, data, rand, me):
+    thread = rand.choice(data['threads'])
+    word = thread['name'].split()[-1]
+    for n in range(1, len(word) + 1):
+        client.post(reverse('search'),
+                    {'search_type': 'thread', 'search_text': word[:n],
+                     'search_category': thread['category']})
+
+
+def post(client, data, rand, me):
+    thread = rand.choice(data['threads'])
+    client.post(reverse('thread', args=[thread['category'], thread['slug']]),
+                {'text': 'Load test reply {}'.format(rand.random())})
+
+
+def like(client, data, rand, me):
+    client.post(reverse('like_post'),
+                {'user_pk': me[0], 'post_pk': rand.choice(data['posts']),
+                 'type': 'like'})
+
+
+def pm(client, data, rand, me):
+    other = rand.choice([user for user in data['users'] if user != me])
+    client.post(reverse('conversation', args=[me[1], other[1]]),
+                {'text': 'Load test message {}'.format(rand.random())})
+
+
+JOURNEYS = {'browse': browse, 'read': read, 'search': search,
+            'post': post, 'like': like, 'pm': pm}
+
+
+def client_loop(server, data, n, write_ratio, deadline, results,
+                journeys):
+    rand = random.Random(n)
+    me = data['users'][n % len(data['users'])]
+    client = Client(server.host, server.port, [])
+    login(client, me[1])
+    client.results = results
+    while time.time() < deadline:
+        names = WRITE_JOURNEYS if rand.random() < write_ratio \
+            else READ_JOURNEYS
+        name = rand.choice(names)
+        JOURNEYS[name](client, data, rand, me)
+        journeys.append(name)
+    return
+
+
+def percentile(values, p):
+    """ Nearest-rank percentile 'p' (0-100) of sorted 'values'.
+    """
+    if not values:
+        return 0.0
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def summarize(results, seconds, journeys=()):
+    """ The report of a run: results are (URL name, status, seconds),
+    'journeys' the names of the journeys run.
+    """
+    by_name = defaultdict(list)
+    for name, status, elapsed in results:
+        by_name[name].append((status, elapsed))
+    urls = {}
+    for name, rows in by_name.items():
+        times = sorted(elapsed for status, elapsed in rows)
+        limited = sum(1 for status, elapsed in rows if status == 429)
+        errors = sum(1 for status, elapsed in rows
+                     if status == 0 or (status >= 400 and status != 429))
+        urls[name] = {'requests': len(rows), 'errors': errors,
+                      'rate_limited': limited,
+                      'p50': percentile(times, 50) * 1000,
+                      'p95': percentile(times, 95) * 1000,
+                      'p99': percentile(times, 99) * 1000}
+    counts = defaultdict(int)
+    for name in journeys:
+        counts[name] += 1
+    return {'seconds': seconds, 'requests': len(results),
+            'throughput': len(results) / seconds if seconds else 0.0,
+            'journeys': dict(counts), 'urls': urls}
+
+
+def run(clients=20, workers=4, duration=30, write_ratio=0.2,
+        users=20, categories=4, threads=10, fresh=True, rate_limits=False,
+        log=None):
+    """ Seed, start the server, drive it with 'clients' concurrent clients
+    for 'duration' seconds and return the summary.
+    """
+    directory = tempfile.mkdtemp() if fresh else None
+    try:
+        if fresh:
+            fresh_database(directory)
+        data = seed(users, categories, threads)
+        server = Server(workers, rate_limits).start()
+        try:
+            if log is not None:
+                log('{} workers on port {}, {} clients for {} s'.format(
+                    workers, server.port, clients, duration))
+            results = []
+            journeys = []
+            deadline = time.time() + duration
+            started = time.time()
+            pool = [threading.Thread(target=client_loop,
+                                     args=(server, data, n, write_ratio,
+                                           deadline, results, journeys))
+                    for n in range(clients)]
+            for thread in pool:
+                thread.start()
+            for thread in pool:
+                thread.join()
+            seconds = time.time() - started
+        finally:
+            server.stop()
+    finally:
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+    summary = summarize(results, seconds, journeys)
+    summary['config'] = {'clients': clients, 'workers': workers,
+                         'duration': duration, 'write_ratio': write_ratio,
+                         'fresh': fresh, 'rate_limits': rate_limits}
+    return summary
+
+
+def report(summary):
+    """ Lines of text for a summary.
+    """
+    lines = ['{:.1f} requests/s ({} requests in {:.1f} s)'.format(
+        summary['throughput'], summary['requests'], summary['seconds']),
+        'journeys: ' + ', '.join('{} {}'.format(name, n) for name, n in
+                                 sorted(summary.get('journeys', {}).items())),
+        '{:<22} {:>8} {:>7} {:>5} {:>8} {:>8} {:>8}'.format(
+            'url name', 'requests', 'errors', '429', 'p50 ms', 'p95 ms',
+            'p99 ms')]
+    for name, row in sorted(summary['urls'].items()):
+        lines.append('{:<22} {:>8} {:>6.1f}% {:>5} {:>8.1f} {:>8.1f} '
+                     '{:>8.1f}'.format(
+                         name, row['requests'],
+                         100.0 * row['errors'] / row['requests'],
+                         row['rate_limited'], row['p50'], row['p95'],
+                         row['p99']))
+    return lines
+
+
+def compare(old, new):
+    """ Lines of text comparing two summaries: throughput and, per URL
+    name, p95 latency and error counts, with the change in percent.
+    """
+    def change(before, after):
+        if not before:
+            return '     n/a'
+        return '{:+7.1f}%'.format(100.0 * (after - before) / before)
+
+    lines = ['throughput {:.1f} -> {:.1f} requests/s {}'.format(
+        old['throughput'], new['throughput'],
+        change(old['throughput'], new['throughput'])),
+        '{:<22} {:>10} {:>10} {:>8} {:>14}'.format(
+            'url name', 'old p95', 'new p95', 'change', 'errors')]
+    for name in sorted(set(old['urls']) | set(new['urls'])):
+        before = old['urls'].get(name)
+        after = new['urls'].get(name)
+        if before is None or after is None:
+            lines.append('{:<22} {}'.format(
+                name, 'only in the new run' if before is None
+                else 'only in the old run'))
+            continue
+        lines.append('{:<22} {:>10.1f} {:>10.1f} {} {:>6} -> {:<5}'.format(
+            name, before['p95'], after['p95'],
+            change(before['p95'], after['p95']), before['errors'],
+            after['errors']))
+    return lines
+
+
+def save(summary, path):
+    with open(path, 'w') as f:
+        json.dump(summary, f, indent=1, sort_keys=True)
+    return
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
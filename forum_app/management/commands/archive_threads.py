@@ -0,0 +1,38 @@
+""" Move the posts of long-inactive threads into the archive tables.
+
+Meant to run from cron. Each batch of threads is its own transaction and
+the threads due are selected from the data every time, so the command can
+be stopped at any point and simply run again.
+"""
+from django.core.management.base import BaseCommand
+
+from forum_app import archive
+
+
+class Command(BaseCommand):
+    help = ("Archive threads with no posts for --days days (default "
+            "settings.ARCHIVE_AFTER_DAYS), in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='inactivity before a thread is archived '
+                                 '(default {})'.format(
+                                     archive.ARCHIVE_AFTER_DAYS))
+        parser.add_argument('--batch-size', type=int,
+                            default=archive.BATCH_SIZE,
+                            help='threads per transaction (default {})'
+                                 .format(archive.BATCH_SIZE))
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count the threads that are due')
+
+    def handle(self, *args, **options):
+        threads = archive.due(options['days'])
+        self.stdout.write('{} threads due'.format(threads.count()))
+        if options['dry_run']:
+            return
+        done = archive.archive_threads(threads, options['batch_size'],
+                                       options['pause'], self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            'Archived {} threads'.format(done)))
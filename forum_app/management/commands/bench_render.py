@@ -0,0 +1,75 @@
+""" Render-only benchmark for thread pages.
+
+Builds in-memory posts (nothing touches the database) and times
+fragments.render_posts() for a 50-post page, with a cold fragment cache and
+with a warm one, next to the old way of rendering every post through the
+template on every request.
+"""
+import time
+
+from django.contrib.auth.models import User, AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.template.loader import render_to_string
+from django.utils import timezone
+
+from forum_app import fragments
+from forum_app.models import Category, Thread, Post, Profile
+
+POST_TEXT = ('<p>Lorem ipsum <strong>dolor</strong> sit amet, consectetur '
+             'adipiscing elit.</p><blockquote><p>sed do eiusmod</p>'
+             '</blockquote><ul><li>tempor</li><li>incididunt</li></ul>')
+
+
+def fake_posts(count):
+    category = Category(pk=1, name='Bench', slug='bench')
+    thread = Thread(pk=1, name='Bench thread', slug='bench-thread',
+                    category=category)
+    posts = []
+    for i in range(count):
+        author = User(pk=100 + i % 7, username='author{}'.format(i % 7))
+        author.profile = Profile(pk=author.pk, user=author, rank=i)
+        posts.append(Post(pk=i + 1, text=POST_TEXT, author=author,
+                          thread=thread, likes=i % 5,
+                          created_date=timezone.now()))
+    return thread, posts
+
+
+class Command(BaseCommand):
+    help = "Report microseconds per post for rendering a thread page."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--pages', type=int, default=200,
+                            help='pages of 50 posts to render per run')
+
+    def handle(self, *args, **options):
+        pages = options['pages']
+        thread, posts = fake_posts(50)
+        viewer = User(pk=1, username='viewer')
+        anonymous = AnonymousUser()
+
+        def template_only():
+            for post in posts:
+                render_to_string('forum/post_fragment.html', {'post': post})
+
+        def cold():
+            cache.clear()
+            fragments.render_posts(posts, viewer, thread, 1, set())
+
+        def warm():
+            fragments.render_posts(posts, viewer, thread, 1, set())
+
+        def warm_anonymous():
+            fragments.render_posts(posts, anonymous, thread, 1, set())
+
+        for label, run in [('template, no cache', template_only),
+                           ('fragments, cold cache', cold),
+                           ('fragments, warm cache', warm),
+                           ('fragments, warm, anonymous', warm_anonymous)]:
+            run() # compile templates, fill caches
+            started = time.time()
+            for i in range(pages):
+                run()
+            elapsed = time.time() - started
+            self.stdout.write('{:<28} {:8.1f} us/post'.format(
+                label, elapsed / (pages * len(posts)) * 1e6))
@@ -0,0 +1,89 @@
+""" Storage benchmark for the post revision store.
+
+Generates posts and a series of small edits to each (nothing touches the
+database) and compares the bytes revisions.py stores with keeping a full
+copy of every revision, plain and zlib compressed. Also times rebuilding
+the revision furthest from a snapshot.
+"""
+import random
+import time
+import zlib
+
+from django.core.management.base import BaseCommand
+
+from forum_app import revisions
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua ut enim '
+         'ad minim veniam quis nostrud exercitation ullamco laboris nisi '
+         'aliquip ex ea commodo consequat').split()
+
+
+def fake_post(rand, paragraphs):
+    return '\n'.join('<p>{}</p>'.format(' '.join(
+        rand.choice(WORDS) for i in range(rand.randint(20, 80))))
+        for j in range(paragraphs))
+
+
+def fake_edit(rand, text):
+    """ A typical correction: a few words changed, sometimes a sentence
+    added at the end.
+    """
+    words = text.split(' ')
+    for i in range(rand.randint(1, 4)):
+        words[rand.randrange(len(words))] = rand.choice(WORDS)
+    text = ' '.join(words)
+    if rand.random() < 0.3:
+        text += '\n<p>Edit: {}.</p>'.format(' '.join(
+            rand.choice(WORDS) for i in range(rand.randint(5, 15))))
+    return text
+
+
+class Command(BaseCommand):
+    help = "Compare revision storage with full copies of every revision."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=200)
+        parser.add_argument('--edits', type=int, default=20,
+                            help='edits per post')
+        parser.add_argument('--paragraphs', type=int, default=6,
+                            help='paragraphs per post')
+
+    def handle(self, *args, **options):
+        rand = random.Random(1)
+        stored = full = compressed = 0
+        worst = None
+        for i in range(options['posts']):
+            versions = [fake_post(rand, options['paragraphs'])]
+            for j in range(options['edits']):
+                versions.append(fake_edit(rand, versions[-1]))
+            rows = [(True, revisions.snapshot(versions[0]))]
+            for number in range(1, len(versions)):
+                rows.append(revisions.encode(number, versions[number - 1],
+                                             versions[number]))
+            for text, (flag, data) in zip(versions, rows):
+                stored += len(data)
+                full += len(text.encode('utf-8'))
+                compressed += len(zlib.compress(text.encode('utf-8')))
+            worst = (versions, rows)
+
+        versions, rows = worst
+        number = min(len(rows), revisions.SNAPSHOT_EVERY) - 1
+        base = number - number % revisions.SNAPSHOT_EVERY
+        runs = 200
+        started = time.time()
+        for i in range(runs):
+            text = revisions.rebuild(rows[base:number + 1])
+        elapsed = (time.time() - started) / runs
+        assert text == versions[number]
+
+        count = options['posts'] * (options['edits'] + 1)
+        self.stdout.write('{} revisions of {} posts'.format(
+            count, options['posts']))
+        for label, size in [('full copies', full),
+                            ('full copies, compressed', compressed),
+                            ('deltas + snapshots', stored)]:
+            self.stdout.write('{:<26} {:10.1f} KB {:6.1f}%'.format(
+                label, size / 1024.0, 100.0 * size / full))
+        self.stdout.write('rebuild revision {} ({} deltas): {:.0f} us'.format(
+            number, number - base, elapsed * 1e6))
@@ -0,0 +1,69 @@
+""" Benchmark for the similar-titles index.
+
+Builds an index over generated titles (nothing touches the database) and
+reports the build time and the average time of a similar_threads() lookup
+for partial titles, the way they arrive while someone is typing.
+"""
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from forum_app.similar import TitleIndex
+
+COMMON_WORDS = ['the', 'how', 'to', 'best', 'is', 'a', 'in', 'for', 'with',
+                'my', 'what', 'why', 'and', 'of']
+LETTERS = 'etaoinshrdlucmfwypvbgkqjxz'
+
+
+def fake_titles(count, seed=1):
+    """ 'count' titles mixing common words with a long tail of made-up ones
+    picked with a skewed (Pareto) frequency, like real titles.
+    """
+    rand = random.Random(seed)
+    vocabulary = [''.join(rand.choice(LETTERS[:rand.randint(8, 26)])
+                          for i in range(rand.randint(3, 9)))
+                  for j in range(30000)]
+    titles = []
+    for i in range(count):
+        words = []
+        for j in range(rand.randint(3, 9)):
+            if rand.random() < 0.4:
+                words.append(rand.choice(COMMON_WORDS))
+            else:
+                rank = min(int(rand.paretovariate(0.8)), len(vocabulary))
+                words.append(vocabulary[rank - 1])
+        titles.append(' '.join(words))
+    return titles
+
+
+class Command(BaseCommand):
+    help = ("Report build time and microseconds per lookup for the "
+            "similar-titles index.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=100000,
+                            help='titles in the index (default 100000)')
+        parser.add_argument('--queries', type=int, default=1000,
+                            help='lookups to time (default 1000)')
+
+    def handle(self, *args, **options):
+        titles = fake_titles(options['threads'])
+        rows = [(i, title, 'thread-{}'.format(i))
+                for i, title in enumerate(titles)]
+        index = TitleIndex(lambda category_id: rows)
+        started = time.time()
+        index.get(1)
+        self.stdout.write('build  {:8.2f} s for {} titles'.format(
+            time.time() - started, len(rows)))
+        rand = random.Random(2)
+        queries = []
+        for i in range(options['queries']):
+            title = rand.choice(titles)
+            queries.append(title[:rand.randint(5, len(title))])
+        started = time.time()
+        for query in queries:
+            index.search(1, query)
+        elapsed = time.time() - started
+        self.stdout.write('lookup {:8.1f} us'.format(
+            elapsed / len(queries) * 1e6))
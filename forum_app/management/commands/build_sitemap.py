@@ -0,0 +1,38 @@
+""" Bring the sitemap files up to date.
+
+Meant to run from cron (hourly, say). Only rewrites the shards with threads
+touched since the last run; --full rewrites everything, e.g. after bulk
+moderation. See forum_app/sitemap.py.
+"""
+from django.core.management.base import BaseCommand
+
+from forum_app import sitemap
+
+
+class Command(BaseCommand):
+    help = ("Rewrite the sitemap shards changed since the last run, and "
+            "the sitemap index.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--root', default=None,
+                            help='directory to write to (default '
+                                 'settings.SITEMAP_ROOT: {})'.format(
+                                     sitemap.SITEMAP_ROOT))
+        parser.add_argument('--base-url', default=None,
+                            help='scheme and host the URLs start with '
+                                 '(default settings.SITEMAP_BASE_URL)')
+        parser.add_argument('--shard-size', type=int,
+                            default=sitemap.SHARD_SIZE,
+                            help='threads per file (default {})'.format(
+                                sitemap.SHARD_SIZE))
+        parser.add_argument('--full', action='store_true',
+                            help='rewrite every file')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between files')
+
+    def handle(self, *args, **options):
+        written = sitemap.build(options['root'], options['base_url'],
+                                options['shard_size'], options['full'],
+                                options['pause'], self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote {} sitemap files'.format(len(written))))
@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from forum_app import export
+from forum_app.models import Category, Thread
+
+
+class Command(BaseCommand):
+    help = ("Export a thread, a category or the whole forum to gzipped JSONL "
+            "or a .tar.gz of self-contained HTML pages.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--category', help='category slug')
+        parser.add_argument('--thread', help='thread slug (needs --category)')
+        parser.add_argument('--format', choices=export.FORMATS,
+                            default='jsonl')
+        parser.add_argument('--output', help='file to write (default: named '
+                            'after what is exported)')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='processes rendering HTML pages')
+
+    def handle(self, *args, **options):
+        category = thread = None
+        try:
+            if options['category']:
+                category = Category.objects.get(slug=options['category'])
+            if options['thread']:
+                if category is None:
+                    raise CommandError('--thread needs --category')
+                thread = Thread.objects.get(slug=options['thread'],
+                                            category=category)
+        except (Category.DoesNotExist, Thread.DoesNotExist) as e:
+            raise CommandError(e)
+        fmt = options['format']
+        path = options['output'] or export.filename(fmt, category, thread)
+        threads = export.select_threads(category, thread)
+        written = 0
+        with open(path, 'wb') as out:
+            for chunk in export.export(threads, fmt, options['workers']):
+                out.write(chunk)
+                written += len(chunk)
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote {} ({} bytes)'.format(path, written)))
@@ -0,0 +1,287 @@
+""" Bulk import of a legacy forum dump.
+
+The dump is a JSONL file, one object per line, with a "type" key and the
+fields of that record. Legacy ids are kept as primary keys, so references
+between records need no lookup table and memory use does not grow with the
+size of the dump. Parents must appear before their children (users before
+anything they wrote, threads before their posts, ...).
+
+    {"type": "user", "id": 1, "username": "jack", "email": "...",
+     "password": "<django password hash, optional>", "date_joined": "..."}
+    {"type": "category", "id": 1, "name": "General", "slug": "general"}
+    {"type": "thread", "id": 1, "category": 1, "author": 1, "name": "Hi",
+     "created_date": "2017-06-01T20:54:00+00:00"}
+    {"type": "post", "id": 1, "thread": 1, "author": 1, "text": "*markdown*",
+     "created_date": "...", "likes": 0}
+    {"type": "like", "post": 1, "user": 2}
+    {"type": "conversation", "id": 1, "belongs_to": 1, "is_with": 2}
+    {"type": "pm", "id": 1, "conversation": 1, "author": 1, "text": "...",
+     "created_date": "..."}
+
+Slugs default to slugify(name). Denormalized counters in the dump are
+ignored; they are recomputed with set-based SQL once everything is loaded.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import json
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from forum_app import counters, leaderboard, similar
+from forum_app.markup import render_markdown
+from forum_app.models import User, Profile, UserStats, Category, Thread, Post
+from forum_app.models import Conversation, Pm, get_watermark, set_watermark
+
+# order in which buffered rows are written, parents first
+RECORD_TYPES = ['user', 'category', 'thread', 'post', 'like', 'conversation',
+                'pm']
+
+
+def parse_date(value):
+    if not value:
+        return timezone.now()
+    date = parse_datetime(value)
+    if date is None:
+        raise ValueError('bad date {!r}'.format(value))
+    if settings.USE_TZ and timezone.is_naive(date):
+        date = timezone.make_aware(date, timezone.utc)
+    return date
+
+
+def build_user(record):
+    return {'id': record['id'], 'username': record['username'],
+            'email': record.get('email', ''),
+            'password': record.get('password') or '!',
+            'date_joined': parse_date(record.get('date_joined'))}
+
+
+def build_category(record):
+    return {'id': record['id'], 'name': record['name'],
+            'slug': record.get('slug') or slugify(record['name']),
+            'image': record.get('image')}
+
+
+def build_thread(record):
+    return {'id': record['id'], 'name': record['name'],
+            'slug': record.get('slug') or slugify(record['name']),
+            'category_id': record['category'], 'author_id': record['author'],
+            'created_date': parse_date(record.get('created_date'))}
+
+
+def build_post(record):
+    return {'id': record['id'], 'thread_id': record['thread'],
+            'author_id': record['author'], 'text': record['text'],
+            'created_date': parse_date(record.get('created_date')),
+            'likes': record.get('likes', 0)}
+
+
+def build_like(record):
+    return {'post_id': record['post'], 'user_id': record['user']}
+
+
+def build_conversation(record):
+    return {'id': record['id'], 'belongs_to_id': record['belongs_to'],
+            'is_with_id': record['is_with']}
+
+
+def build_pm(record):
+    return {'id': record['id'], 'conversation_id': record['conversation'],
+            'author_id': record['author'], 'text': record['text'],
+            'created_date': parse_date(record.get('created_date'))}
+
+
+BUILDERS = {
+    'user': (User, build_user),
+    'category': (Category, build_category),
+    'thread': (Thread, build_thread),
+    'post': (Post, build_post),
+    'like': (Post.liked_by.through, build_like),
+    'conversation': (Conversation, build_conversation),
+    'pm': (Pm, build_pm),
+}
+
+
+class RowWriter(object):
+    """ Inserts rows of one model with a single executemany() per batch.
+
+    This does the job of bulk_create(), without building a model instance
+    and preparing every field of every row: bulk_create() tops out at a few
+    thousand rows a second on SQLite, most of it in that per-field work.
+    Columns the dump doesn't supply get the model field's default, prepared
+    once. Datetimes are the only values that need adapting per row.
+    """
+    def __init__(self, model, attnames):
+        self.columns = []
+        self.defaults = {}
+        self.dates = set()
+        for field in model._meta.concrete_fields:
+            if field.attname not in attnames:
+                if field.primary_key:
+                    continue
+                self.defaults[field.attname] = field.get_db_prep_save(
+                    field.get_default(), connection)
+            if field.get_internal_type() == 'DateTimeField':
+                self.dates.add(field.attname)
+            self.columns.append(field)
+        self.sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            connection.ops.quote_name(model._meta.db_table),
+            ', '.join(connection.ops.quote_name(f.column)
+                      for f in self.columns),
+            ', '.join(['%s'] * len(self.columns)))
+
+    def row(self, values):
+        adapt = connection.ops.adapt_datetimefield_value
+        row = []
+        for field in self.columns:
+            name = field.attname
+            if name in values:
+                value = values[name]
+                if name in self.dates:
+                    value = adapt(value)
+            else:
+                value = self.defaults[name]
+            row.append(value)
+        return row
+
+    def insert(self, rows):
+        with connection.cursor() as cursor:
+            cursor.executemany(self.sql, [self.row(values) for values in rows])
+        return
+
+
+class Command(BaseCommand):
+    help = ("Stream a JSONL forum dump into the database with bulk inserts. "
+            "Safe to re-run after an interruption: it resumes after the last "
+            "committed batch.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('dump', help='path to the JSONL dump')
+        parser.add_argument('--batch-size', type=int, default=20000,
+                            help='records per transaction (default 20000)')
+        parser.add_argument('--workers', type=int, default=None,
+                            help='processes for markdown rendering '
+                                 '(default: one per CPU)')
+        parser.add_argument('--no-render', action='store_true',
+                            help='post/pm text is already HTML, store as is')
+        parser.add_argument('--restart', action='store_true',
+                            help='ignore the saved position and start over')
+        parser.add_argument('--no-sync', action='store_true',
+                            help='SQLite only: skip fsync while importing. '
+                                 'Much faster; a crash can corrupt the DB.')
+
+    def handle(self, *args, **options):
+        self.checkpoint = 'import:{}'.format(options['dump'])
+        offset = 0
+        if not options['restart']:
+            offset = int(get_watermark(self.checkpoint, 0))
+        if offset:
+            self.stdout.write('Resuming at byte {}'.format(offset))
+        if options['no_sync'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous = OFF')
+        self.render = not options['no_render']
+        self.pool = None
+        if self.render:
+            self.pool = ProcessPoolExecutor(max_workers=options['workers'])
+        started = time.time()
+        self.totals = dict((name, 0) for name in RECORD_TYPES)
+        self.writers = {}
+        try:
+            self.import_stream(options['dump'], offset, options['batch_size'])
+        finally:
+            if self.pool is not None:
+                self.pool.shutdown()
+        self.stdout.write('Recomputing counters...')
+        with transaction.atomic():
+            counters.recompute_all()
+            # explicit ids leave sequences behind on databases that have them
+            with connection.cursor() as cursor:
+                for sql in connection.ops.sequence_reset_sql(no_style(), [
+                        User, Profile, Category, Thread, Post, Conversation,
+                        Pm]):
+                    cursor.execute(sql)
+        leaderboard.boards.clear()
+        similar.titles.clear()
+        elapsed = max(time.time() - started, 1e-6)
+        for name in RECORD_TYPES:
+            if self.totals[name]:
+                self.stdout.write('{:>12} {:>10} ({:.0f}/s)'.format(
+                    name, self.totals[name], self.totals[name] / elapsed))
+        self.stdout.write(self.style.SUCCESS(
+            'Imported in {:.1f}s'.format(elapsed)))
+
+    def import_stream(self, path, offset, batch_size):
+        """ Read the dump line by line, buffering up to 'batch_size' records
+        before writing them in one transaction.
+        """
+        buffers = dict((name, []) for name in RECORD_TYPES)
+        pending = 0
+        # binary mode so tell()/seek() are byte offsets we can resume from
+        with open(path, 'rb') as dump:
+            dump.seek(offset)
+            line_no = 0
+            while True:
+                line = dump.readline()
+                if not line:
+                    break
+                line_no += 1
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                    buffers[record['type']].append(record)
+                except (ValueError, KeyError) as e:
+                    raise CommandError('byte {} (+{} lines): {}'.format(
+                        offset, line_no, e))
+                pending += 1
+                if pending >= batch_size:
+                    self.flush(buffers, dump.tell())
+                    pending = 0
+            if pending:
+                self.flush(buffers, dump.tell())
+        return
+
+    def writer(self, model, sample):
+        """ RowWriter for 'model', built once per set of supplied columns.
+        """
+        key = (model, frozenset(sample))
+        if key not in self.writers:
+            self.writers[key] = RowWriter(model, sample)
+        return self.writers[key]
+
+    def flush(self, buffers, position):
+        """ Write every buffered record and the resume position atomically.
+        """
+        if self.render:
+            for name in ('post', 'pm'):
+                records = buffers[name]
+                texts = self.pool.map(render_markdown,
+                                      [r['text'] for r in records],
+                                      chunksize=256)
+                for record, text in zip(records, texts):
+                    record['text'] = text
+        with transaction.atomic():
+            for name in RECORD_TYPES:
+                records = buffers[name]
+                if not records:
+                    continue
+                model, build = BUILDERS[name]
+                rows = [build(record) for record in records]
+                self.writer(model, rows[0]).insert(rows)
+                if name == 'user':
+                    # signals don't fire for bulk inserts
+                    ids = [{'user_id': row['id']} for row in rows]
+                    self.writer(Profile, ids[0]).insert(ids)
+                    self.writer(UserStats, ids[0]).insert(ids)
+                self.totals[name] += len(rows)
+                del records[:]
+            set_watermark(self.checkpoint, position)
+        self.stdout.write('  committed through byte {}'.format(position))
+        return
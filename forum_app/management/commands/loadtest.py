@@ -0,0 +1,70 @@
+""" Concurrent load test of the whole app over HTTP.
+
+    manage.py loadtest                          # 30 s, 20 clients, 4 workers
+    manage.py loadtest --save before.json
+    manage.py loadtest --compare before.json    # after a change
+
+Runs against a fresh, seeded SQLite database unless --use-database is
+given; see forum_app/loadtest.py.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from forum_app import loadtest
+
+
+class Command(BaseCommand):
+    help = ("Serve the app from a local multi-worker WSGI server and drive "
+            "it with concurrent scripted users; report throughput, latency "
+            "percentiles and errors per URL name.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=20,
+                            help='concurrent clients (default 20)')
+        parser.add_argument('--workers', type=int, default=4,
+                            help='server processes (default 4)')
+        parser.add_argument('--duration', type=float, default=30,
+                            help='seconds to run (default 30)')
+        parser.add_argument('--write-ratio', type=float, default=0.2,
+                            help='share of journeys that write (default '
+                                 '0.2)')
+        parser.add_argument('--users', type=int, default=20,
+                            help='load test accounts (default 20)')
+        parser.add_argument('--categories', type=int, default=4)
+        parser.add_argument('--threads', type=int, default=10,
+                            help='threads per category (default 10)')
+        parser.add_argument('--use-database', action='store_true',
+                            help='run against the configured database '
+                                 '(adds load test users, threads and '
+                                 'posts to it) instead of a fresh one')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='keep settings.RATE_LIMITS on')
+        parser.add_argument('--save', metavar='PATH',
+                            help='write the results as JSON')
+        parser.add_argument('--compare', metavar='PATH',
+                            help='compare with results saved earlier')
+
+    def handle(self, *args, **options):
+        if options['users'] < 2:
+            raise CommandError('--users must be at least 2')
+        if not 0 <= options['write_ratio'] <= 1:
+            raise CommandError('--write-ratio must be between 0 and 1')
+        try:
+            summary = loadtest.run(
+                options['clients'], options['workers'], options['duration'],
+                options['write_ratio'], options['users'],
+                options['categories'], options['threads'],
+                not options['use_database'], options['rate_limits'],
+                self.stdout.write)
+        except ValueError as e:
+            raise CommandError(str(e))
+        for line in loadtest.report(summary):
+            self.stdout.write(line)
+        if options['compare']:
+            self.stdout.write('')
+            for line in loadtest.compare(loadtest.load(options['compare']),
+                                         summary):
+                self.stdout.write(line)
+        if options['save']:
+            loadtest.save(summary, options['save'])
+            self.stdout.write(self.style.SUCCESS(
+                'Saved to {}'.format(options['save'])))
@@ -0,0 +1,102 @@
+""" Bulk delete or move posts and threads, keeping the counters right.
+
+    manage.py moderate delete-posts --author spammer
+    manage.py moderate delete-threads --category old-news --until 2016-01-01
+    manage.py moderate move-posts --thread off-topic --to on-topic
+    manage.py moderate move-threads --category misc --since 2017-06-01 \\
+        --to general
+
+Filters combine. Posts are matched on their own author and date, threads on
+the thread's. See forum_app/moderation.py for how the work is batched.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from forum_app import moderation
+from forum_app.models import User, Category, Thread
+
+ACTIONS = ('delete-posts', 'delete-threads', 'move-posts', 'move-threads')
+
+
+class Command(BaseCommand):
+    help = ("Delete or move posts/threads by author, thread, category or "
+            "date range with set-based SQL, fixing counters as it goes.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=ACTIONS)
+        parser.add_argument('--author', help='username')
+        parser.add_argument('--category', help='category slug')
+        parser.add_argument('--thread', help='thread slug (posts only)')
+        parser.add_argument('--since', help='created on or after, ISO date')
+        parser.add_argument('--until', help='created before, ISO date')
+        parser.add_argument('--to', help='target thread slug (move-posts) '
+                                         'or category slug (move-threads)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count what would be changed')
+        parser.add_argument('--batch-size', type=int,
+                            default=moderation.BATCH_SIZE,
+                            help='rows per transaction (default {})'.format(
+                                moderation.BATCH_SIZE))
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+
+    def lookup(self, model, **kwargs):
+        try:
+            return model.objects.get(**kwargs)
+        except model.DoesNotExist:
+            raise CommandError('No {} with {}'.format(
+                model.__name__, kwargs))
+
+    def handle(self, *args, **options):
+        action = options['action']
+        filters = {}
+        try:
+            filters['since'] = moderation.parse_bound(options['since'])
+            filters['until'] = moderation.parse_bound(options['until'])
+        except ValueError as e:
+            raise CommandError(e)
+        if options['author']:
+            filters['author'] = self.lookup(User, username=options['author'])
+        if options['category']:
+            filters['category'] = self.lookup(Category,
+                                              slug=options['category'])
+        if action.endswith('posts'):
+            if options['thread']:
+                filters['thread'] = self.lookup(Thread,
+                                                slug=options['thread'])
+            rows = moderation.select_posts(**filters)
+        else:
+            if options['thread']:
+                raise CommandError('--thread only applies to posts')
+            rows = moderation.select_threads(**filters)
+        if not any(value is not None for value in filters.values()):
+            raise CommandError('Refusing to {} without any filter'.format(
+                action))
+        if action.startswith('move'):
+            if not options['to']:
+                raise CommandError('{} needs --to'.format(action))
+            if action == 'move-posts':
+                target = self.lookup(Thread, slug=options['to'])
+            else:
+                target = self.lookup(Category, slug=options['to'])
+
+        self.stdout.write('{} rows match'.format(rows.count()))
+        if options['dry_run']:
+            return
+        kwargs = {'batch_size': options['batch_size'],
+                  'pause': options['pause'], 'log': self.stdout.write}
+        if action == 'delete-posts':
+            done, empty = moderation.delete_posts(rows, **kwargs)
+            self.stdout.write('Deleted {} posts ({} threads left empty '
+                              'deleted)'.format(done, empty))
+        elif action == 'delete-threads':
+            posts, threads = moderation.delete_threads(rows, **kwargs)
+            self.stdout.write('Deleted {} threads and {} posts'.format(
+                threads, posts))
+        elif action == 'move-posts':
+            done, empty = moderation.move_posts(rows, target, **kwargs)
+            self.stdout.write('Moved {} posts ({} threads left empty '
+                              'deleted)'.format(done, empty))
+        else:
+            done, empty = moderation.move_threads(rows, target, **kwargs)
+            self.stdout.write('Moved {} threads'.format(done))
+        moderation.finish()
@@ -0,0 +1,41 @@
+""" Delete private messages nobody can see any more.
+
+Meant to run from cron. Deletes the messages of deleted (cleared)
+conversations and, with a retention period, every message older than it,
+in batches of one short transaction each; see forum_app/inbox.py.
+"""
+from django.core.management.base import BaseCommand
+
+from forum_app import inbox
+
+
+class Command(BaseCommand):
+    help = ("Delete messages of deleted conversations and messages past "
+            "the retention period, in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help='delete messages older than this (default '
+                                 'settings.PM_RETENTION_DAYS: {})'.format(
+                                     inbox.PM_RETENTION_DAYS))
+        parser.add_argument('--batch-size', type=int,
+                            default=inbox.BATCH_SIZE,
+                            help='messages per transaction (default {})'
+                                 .format(inbox.BATCH_SIZE))
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only count the messages that are due')
+
+    def handle(self, *args, **options):
+        self.stdout.write('{} messages due'.format(
+            inbox.due(options['days']).count()))
+        if options['dry_run']:
+            return
+        deleted, reclaimed, conversations = inbox.purge(
+            options['days'], options['batch_size'], options['pause'],
+            self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            'Deleted {} messages ({:.1f} KB of text) and {} empty '
+            'conversations'.format(deleted, reclaimed / 1024.0,
+                                   conversations)))
@@ -0,0 +1,103 @@
+""" Recompute drifted denormalized counters.
+
+Counters are bumped atomically by the write paths, but deletes (and anything
+else that bypasses Post.new() and friends) leave them off. Deletes mark the
+affected rows as 'touched' (see post_deleted() in models.py), so the
+incremental mode only has to revisit rows touched since its last run.
+
+Every batch is its own short transaction, so writers are only ever held up
+for the length of one batch. Conversations aren't marked touched, so only a
+full run revisits them.
+"""
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from forum_app import counters, leaderboard
+from forum_app.counters import batches
+from forum_app.models import Category, Thread, UserStats, Conversation
+from forum_app.models import get_watermark, set_watermark
+
+WATERMARK = 'reconcile_counters'
+
+
+class Command(BaseCommand):
+    help = ("Recompute Thread, Category, UserStats, rank and Conversation "
+            "counters with set-based SQL, in batches.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--incremental', action='store_true',
+                            help='only rows touched since the last run')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='report drift without writing anything')
+        # each statement binds a batch's ids once; keep it under the 999
+        # variables SQLite allows
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='rows per transaction (default 500)')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between batches')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        self.batch_size = options['batch_size']
+        self.pause = options['pause']
+        started = timezone.now()
+        since = None
+        if options['incremental']:
+            since = parse_datetime(get_watermark(WATERMARK, '') or '')
+        threads = Thread.objects.all()
+        categories = Category.objects.all()
+        users = UserStats.objects.all()
+        if since is not None:
+            self.stdout.write('Rows touched since {}'.format(since))
+            threads = threads.filter(touched__gte=since)
+            # categories of touched threads need their totals redone too
+            categories = categories.filter(
+                Q(touched__gte=since) |
+                Q(id__in=threads.values('category_id')))
+            users = users.filter(touched__gte=since)
+        self.run('threads', batches(threads, 'id', self.batch_size),
+                 counters.recompute_threads, counters.thread_drift)
+        self.run('categories', batches(categories, 'id', self.batch_size),
+                 counters.recompute_categories, counters.category_drift)
+        self.run('users', batches(users, 'user_id', self.batch_size),
+                 counters.recompute_users, counters.user_drift)
+        if since is None:
+            self.run('conversations',
+                     batches(Conversation.objects.all(), 'id',
+                             self.batch_size),
+                     counters.recompute_conversations,
+                     counters.conversation_drift)
+        if not self.dry_run:
+            # anything touched while we ran is picked up next time
+            set_watermark(WATERMARK, started.isoformat())
+            leaderboard.boards.clear()
+
+    def run(self, label, id_batches, recompute, drift):
+        """ Recompute (or with --dry-run, report) the rows in each batch of
+        ids, one transaction per batch.
+        """
+        checked = 0
+        found = 0
+        for chunk in id_batches:
+            checked += len(chunk)
+            if self.dry_run:
+                for pk, column, stored, actual in drift(chunk):
+                    found += 1
+                    self.stdout.write('  {} {} {}: {} should be {}'.format(
+                        label, pk, column, stored, actual))
+            else:
+                with transaction.atomic():
+                    recompute(chunk)
+            if self.pause:
+                time.sleep(self.pause)
+        if self.dry_run:
+            self.stdout.write('{}: {} checked, {} values off'.format(
+                label, checked, found))
+        else:
+            self.stdout.write('{}: {} recomputed'.format(label, checked))
+        return
@@ -0,0 +1,34 @@
+""" Recount the daily activity rollups from the raw tables.
+
+Meant to run from cron (daily is enough) and after imports or bulk
+moderation. Starts at the day the last run stopped at, so it only recounts
+recent days; --since recounts from an earlier day. See forum_app/rollups.py.
+"""
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from forum_app import rollups
+
+
+class Command(BaseCommand):
+    help = ("Recount posts, threads and users per category per day since "
+            "the last run (or --since), one day per transaction.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='first day to recount, '
+                                            'YYYY-MM-DD')
+        parser.add_argument('--pause', type=float, default=0,
+                            help='seconds to sleep between days')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'],
+                                          '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError('bad date {!r}'.format(options['since']))
+        days = rollups.catch_up(since, options['pause'], self.stdout.write)
+        self.stdout.write(self.style.SUCCESS(
+            'Rolled up {} days'.format(days)))
@@ -0,0 +1,48 @@
+""" Startup benchmark and import-time report.
+
+    manage.py startup_report              # time, slowest packages, warm-up
+    manage.py startup_report --check      # fail when over the budget
+
+Importing forum_project.wsgi is timed in a fresh interpreter with
+python -X importtime, so nothing this process already imported skews it.
+The warm-up steps are then timed in this process.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from forum_app import warmup
+
+
+class Command(BaseCommand):
+    help = ("Time importing the WSGI app from scratch, list the slowest "
+            "imports and time each warm-up step.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20,
+                            help='number of imports to list (default 20)')
+        parser.add_argument('--budget', type=float,
+                            default=warmup.STARTUP_BUDGET,
+                            help='seconds allowed (default {})'.format(
+                                warmup.STARTUP_BUDGET))
+        parser.add_argument('--check', action='store_true',
+                            help='exit with an error when over budget')
+        parser.add_argument('--no-warmup', action='store_true',
+                            help="don't run the warm-up steps")
+
+    def handle(self, *args, **options):
+        # untraced run for the time, traced run for the breakdown
+        seconds, unused = warmup.startup_times()
+        unused, lines = warmup.startup_times(importtime=True)
+        self.stdout.write('import forum_project.wsgi: {:.0f} ms (budget '
+                          '{:.0f} ms)'.format(seconds * 1000,
+                                              options['budget'] * 1000))
+        self.stdout.write('\nslowest packages to import')
+        for us, package in warmup.slowest_imports(lines, options['top']):
+            self.stdout.write('  {:<24} {:8.1f} ms'.format(package,
+                                                          us / 1000.0))
+        if not options['no_warmup']:
+            self.stdout.write('')
+            warmup.warm_up(log=self.stdout.write)
+        if options['check'] and seconds > options['budget']:
+            raise CommandError('startup took {:.0f} ms, over the {:.0f} ms '
+                               'budget'.format(seconds * 1000,
+                                               options['budget'] * 1000))
@@ -0,0 +1,56 @@
+import threading
+
+# markdown and bleach take longer to import than the rest of the app's view
+# code together, and only the write paths need them, so they are imported on
+# first use (warmup.py imports them ahead of traffic when enabled).
+#
+# Building a Markdown instance and a bleach Cleaner costs more than rendering
+# a typical post, so each thread keeps its own pair and reuses it.
+_local = threading.local()
+
+
+def _tools():
+    if not hasattr(_local, 'markdown'):
+        import markdown
+        import bleach
+        _local.markdown = markdown.Markdown()
+        _local.cleaner = bleach.sanitizer.Cleaner()
+    return _local.markdown, _local.cleaner
+
+
+def clean(text):
+    """ 'text' with any HTML escaped or stripped, same as bleach.clean().
+    """
+    return _tools()[1].clean(text)
+
+
+def render_markdown(text):
+    """ Turn user submitted markdown into the HTML stored in Post.text and
+    Pm.text. bleach escapes any raw HTML first; '>' is put back so markdown
+    block quotes still work.
+    """
+    md, cleaner = _tools()
+    cleaned = cleaner.clean(text).replace('&gt;', '>')
+    return md.reset().convert(cleaned)
+
+
+# What markdown produces. Posts are stored as rendered HTML, so an edit
+# starts from that HTML and these tags have to survive it.
+MARKDOWN_TAGS = ['a', 'blockquote', 'br', 'code', 'em', 'h1', 'h2', 'h3',
+                 'h4', 'h5', 'h6', 'hr', 'li', 'ol', 'p', 'pre', 'strong',
+                 'ul']
+MARKDOWN_ATTRIBUTES = {'a': ['href', 'title']}
+
+
+def render_edit(text):
+    """ Same as render_markdown() for the text of an edited post: markdown
+    mixed with the HTML the post was stored as. Tags markdown could have
+    produced are kept, any other HTML is escaped as usual.
+    """
+    md = _tools()[0]
+    if not hasattr(_local, 'edit_cleaner'):
+        import bleach
+        _local.edit_cleaner = bleach.sanitizer.Cleaner(
+            tags=MARKDOWN_TAGS, attributes=MARKDOWN_ATTRIBUTES)
+    cleaned = _local.edit_cleaner.clean(text).replace('&gt;', '>')
+    return md.reset().convert(cleaned)
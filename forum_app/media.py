@@ -0,0 +1,212 @@
+""" Serving uploaded media (profile pictures, category images).
+
+Django only decides whether a file may be served and with which headers;
+the bytes should never pass through a worker. With MEDIA_ACCEL set, the
+response is empty and tells the front-end server which file to send:
+
+    'x-accel-redirect'  nginx; MEDIA_ACCEL_PREFIX + path must map to
+                        MEDIA_ROOT in an internal location:
+                            location /protected-media/ {
+                                internal;
+                                alias /path/to/media/;
+                            }
+    'x-sendfile'        Apache mod_xsendfile, lighttpd; absolute path
+
+The front-end server then handles ranges and conditional requests itself.
+Without MEDIA_ACCEL (runserver, a bare WSGI server) the file is returned as
+a FileResponse, which a WSGI server with wsgi.file_wrapper sends with
+sendfile(); ETag/Last-Modified conditionals and single byte ranges are
+handled here.
+
+Uploads are stored under content-hashed names (HashedFileStorage, the
+default storage), so a file's URL changes whenever its content does and
+those URLs can be cached for a year.
+"""
+import hashlib
+import mimetypes
+import os
+import posixpath
+import re
+import stat
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.http import FileResponse, Http404, HttpResponse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe, quote_etag
+from django.utils.six.moves.urllib.parse import quote
+
+# upload_to directories of the media fields; nothing else under MEDIA_ROOT
+# is served
+MEDIA_DIRS = ('profile_pics', 'category_images')
+# Cache-Control max-age of files whose names don't carry a content hash
+MEDIA_MAX_AGE = getattr(settings, 'MEDIA_MAX_AGE', 3600)
+HASHED_MAX_AGE = 365 * 24 * 3600
+
+HASHED_NAME = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+class HashedFileStorage(FileSystemStorage):
+    """ FileSystemStorage that names each upload after its content:
+    'pic.png' is stored as 'pic.<12 hex digits of its SHA-256>.png'.
+    Uploading the same content again reuses the stored file.
+    """
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = hashlib.sha256()
+        content.seek(0)
+        for chunk in content.chunks():
+            digest.update(chunk)
+        root, ext = os.path.splitext(name)
+        suffix = '.{}{}'.format(digest.hexdigest()[:12], ext)
+        if max_length is not None:
+            # shorten the original name, never the hash
+            root = root[:max(max_length - len(suffix), 0)]
+        name = root + suffix
+        if self.exists(name):
+            return name
+        content.seek(0)
+        return super(HashedFileStorage, self).save(name, content, max_length)
+
+
+def resolve(path):
+    """ (normalized path, absolute path, os.stat result) of the media file
+    at 'path', or Http404 for anything that isn't a file in one of
+    MEDIA_DIRS.
+    """
+    path = posixpath.normpath(path).lstrip('/')
+    parts = path.split('/')
+    if (len(parts) < 2 or parts[0] not in MEDIA_DIRS or
+            any(part.startswith('.') for part in parts)):
+        raise Http404('No such file.')
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, path)
+        st = os.stat(full_path)
+    except (OSError, ValueError):
+        raise Http404('No such file.')
+    if not stat.S_ISREG(st.st_mode):
+        raise Http404('No such file.')
+    return path, full_path, st
+
+
+def cache_control(path):
+    if HASHED_NAME.search(path):
+        return 'public, max-age={}, immutable'.format(HASHED_MAX_AGE)
+    return 'public, max-age={}'.format(MEDIA_MAX_AGE)
+
+
+def etag(st):
+    return quote_etag('{:x}-{:x}'.format(int(st.st_mtime), st.st_size))
+
+
+def byte_range(request, size, tag, last_modified):
+    """ (start, end) of the single byte range the request asks for, None
+    for the whole file, or False if the range can't be satisfied. Multiple
+    ranges and ranges made stale by If-Range get the whole file.
+    """
+    match = RANGE.match(request.META.get('HTTP_RANGE', '').strip())
+    if match is None:
+        return None
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if if_range and if_range != tag and \
+            parse_http_date_safe(if_range) != last_modified:
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        # the last 'last' bytes
+        start, end = max(size - int(last), 0), size - 1
+    else:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+class RangeFile(object):
+    """ Read-only view of bytes start..end of an open file. No fileno(), so
+    a WSGI server can't sendfile() past the range.
+    """
+    def __init__(self, f, start, end):
+        self.f = f
+        self.f.seek(start)
+        self.remaining = end - start + 1
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.f.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def content_type(full_path):
+    guessed, encoding = mimetypes.guess_type(full_path)
+    return guessed or 'application/octet-stream', encoding
+
+
+def accel_response(path, full_path, mode):
+    response = HttpResponse(content_type=content_type(full_path)[0])
+    if mode == 'x-accel-redirect':
+        prefix = getattr(settings, 'MEDIA_ACCEL_PREFIX', '/protected-media/')
+        response['X-Accel-Redirect'] = quote(prefix + path)
+    else:
+        response['X-Sendfile'] = full_path
+    return response
+
+
+def serve(request, path):
+    """ Response for the media file at 'path' (relative to MEDIA_URL).
+    """
+    path, full_path, st = resolve(path)
+    mode = getattr(settings, 'MEDIA_ACCEL', None)
+    if mode:
+        response = accel_response(path, full_path, mode)
+        response['Cache-Control'] = cache_control(path)
+        return response
+
+    tag = etag(st)
+    last_modified = int(st.st_mtime)
+    headers = {'ETag': tag, 'Last-Modified': http_date(last_modified),
+               'Cache-Control': cache_control(path)}
+    base = HttpResponse()
+    for name, value in headers.items():
+        base[name] = value
+    conditional = get_conditional_response(request, tag, last_modified, base)
+    if conditional is not base:
+        return conditional
+
+    size = st.st_size
+    selected = byte_range(request, size, tag, last_modified)
+    if selected is False:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */{}'.format(size)
+        return response
+    mime, encoding = content_type(full_path)
+    f = open(full_path, 'rb')
+    if selected is None:
+        response = FileResponse(f, content_type=mime)
+        response['Content-Length'] = size
+    else:
+        start, end = selected
+        response = FileResponse(RangeFile(f, start, end), status=206,
+                                content_type=mime)
+        response['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+        response['Content-Length'] = end - start + 1
+    if encoding:
+        response['Content-Encoding'] = encoding
+    response['Accept-Ranges'] = 'bytes'
+    for name, value in headers.items():
+        response[name] = value
+    return response
@@ -0,0 +1,43 @@
+""" Project middleware.
+"""
+from django.conf import settings
+
+from forum_app import ratelimit
+from forum_app.bus import bus
+
+
+class InvalidationMiddleware(object):
+    """ Drop what other workers made stale in this worker's in-process
+    caches before handling the request (see forum_app/bus.py). Costs one
+    read of shared memory while nothing changed.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        bus.check()
+        return self.get_response(request)
+
+
+class RateLimitMiddleware(object):
+    """ Apply settings.RATE_LIMITS by URL name to everything but GET and
+    HEAD (see forum_app/ratelimit.py). Must come after
+    AuthenticationMiddleware, so buckets can be per user.
+    """
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.limits = getattr(settings, 'RATE_LIMITS', {})
+        for rate in self.limits.values():
+            ratelimit.parse_rate(rate)
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.method in ratelimit.SAFE_METHODS:
+            return None
+        name = request.resolver_match.url_name
+        rate = self.limits.get(name)
+        if rate is None:
+            return None
+        return ratelimit.check(request, name, rate)
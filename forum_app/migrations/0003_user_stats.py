@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 14:59
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+def fill_user_stats(apps, schema_editor):
+    """ Backfill one UserStats row per existing user with three grouped
+    aggregates, rather than counting per user.
+    """
+    User = apps.get_model('auth', 'User')
+    Post = apps.get_model('forum_app', 'Post')
+    Thread = apps.get_model('forum_app', 'Thread')
+    UserStats = apps.get_model('forum_app', 'UserStats')
+    posts = dict(Post.objects.values_list('author').annotate(
+        n=models.Count('id')).order_by())
+    likes = dict(Post.objects.values_list('author').annotate(
+        n=models.Sum('likes')).order_by())
+    threads = dict(Thread.objects.values_list('author').annotate(
+        n=models.Count('id')).order_by())
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=pk, num_posts=posts.get(pk, 0),
+                   num_threads=threads.get(pk, 0),
+                   likes_received=likes.get(pk) or 0)
+         for pk in User.objects.values_list('pk', flat=True)],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0008_alter_user_username_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum_app', '0002_auto_20170601_2054'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('most_recent_pm', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='Pm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('text', models.TextField()),
+                ('created_date', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'ordering': ['created_date'],
+            },
+        ),
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('num_posts', models.IntegerField(default=0)),
+                ('num_threads', models.IntegerField(default=0)),
+                ('likes_received', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'User stats',
+            },
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='liked_by',
+            field=models.ManyToManyField(related_name='liked_by', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='post',
+            name='likes',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='rank',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterIndexTogether(
+            name='post',
+            index_together=set([('author', 'created_date')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='thread',
+            index_together=set([('author', 'created_date')]),
+        ),
+        migrations.AddField(
+            model_name='pm',
+            name='author',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='pm',
+            name='conversation',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.Conversation'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='belongs_to',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_belongs_to', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='is_with',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversation_is_with', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.RunPython(fill_user_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum_app', '0003_user_stats'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='profile',
+            name='rank',
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+    ]
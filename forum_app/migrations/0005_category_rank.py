@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:01
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_category_ranks(apps, schema_editor):
+    """ Backfill CategoryRank from existing threads and posts, using the
+    same scoring as Profile.rank: thread +5, post +1, net likes.
+    """
+    Post = apps.get_model('forum_app', 'Post')
+    Thread = apps.get_model('forum_app', 'Thread')
+    CategoryRank = apps.get_model('forum_app', 'CategoryRank')
+    ranks = {}
+    for user_id, category_id, n in (Thread.objects
+            .values_list('author', 'category')
+            .annotate(n=models.Count('id')).order_by()):
+        ranks[(user_id, category_id)] = 5 * n
+    for user_id, category_id, n, likes in (Post.objects
+            .values_list('author', 'thread__category')
+            .annotate(n=models.Count('id'), likes=models.Sum('likes'))
+            .order_by()):
+        key = (user_id, category_id)
+        ranks[key] = ranks.get(key, 0) + n + (likes or 0)
+    CategoryRank.objects.bulk_create(
+        [CategoryRank(user_id=user_id, category_id=category_id, rank=rank)
+         for (user_id, category_id), rank in ranks.items()],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum_app', '0004_profile_rank_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryRank',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('rank', models.IntegerField(default=0)),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.Category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='categoryrank',
+            unique_together=set([('category', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='categoryrank',
+            index_together=set([('category', 'rank')]),
+        ),
+        migrations.RunPython(fill_category_ranks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:07
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum_app', '0006_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='touched',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='touched',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='touched',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:15
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_last_post_ids(apps, schema_editor):
+    """ Backfill Thread.last_post_id with the id of each thread's newest
+    post.
+    """
+    Post = apps.get_model('forum_app', 'Post')
+    Thread = apps.get_model('forum_app', 'Thread')
+    for thread_id, last_post_id in (Post.objects.values_list('thread')
+            .annotate(last=models.Max('id')).order_by()):
+        Thread.objects.filter(pk=thread_id).update(last_post_id=last_post_id)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum_app', '0007_touched'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryRead',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('read_until', models.DateTimeField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.Category')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ThreadRead',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_post_id', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='last_post_id',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='threadread',
+            name='thread',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.Thread'),
+        ),
+        migrations.AddField(
+            model_name='threadread',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterUniqueTogether(
+            name='threadread',
+            unique_together=set([('user', 'thread')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categoryread',
+            unique_together=set([('user', 'category')]),
+        ),
+        migrations.RunPython(fill_last_post_ids, migrations.RunPython.noop),
+    ]
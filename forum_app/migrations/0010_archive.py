@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:22
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum_app', '0009_post_position_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedLike',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ArchivedPost',
+            fields=[
+                ('id', models.IntegerField(primary_key=True, serialize=False)),
+                ('text', models.TextField()),
+                ('created_date', models.DateTimeField()),
+                ('likes', models.IntegerField(default=0)),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='archived',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='archivedpost',
+            name='thread',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.Thread'),
+        ),
+        migrations.AddField(
+            model_name='archivedlike',
+            name='post',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='forum_app.ArchivedPost'),
+        ),
+        migrations.AddField(
+            model_name='archivedlike',
+            name='user',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterIndexTogether(
+            name='archivedpost',
+            index_together=set([('thread', 'created_date', 'id'), ('author', 'created_date')]),
+        ),
+    ]
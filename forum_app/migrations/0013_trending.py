@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:35
+from __future__ import unicode_literals
+
+from datetime import datetime
+import math
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+# frozen copy of forum_app.trending as of this migration: the trend is
+# log(sum of weight * exp((t - EPOCH) / TAU)), computed here in Python, so
+# no SQL functions are needed
+TAU = getattr(settings, 'TRENDING_HALF_LIFE', 24) * 3600 / math.log(2)
+EPOCH = datetime(2017, 1, 1, tzinfo=timezone.utc)
+EMPTY = -1e9
+POST_WEIGHT = 1.0
+LIKE_WEIGHT = 1.0
+
+
+def term(when, weight):
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.utc)
+    return math.log(weight) + (when - EPOCH).total_seconds() / TAU
+
+
+def add(trend, x):
+    return max(trend, x) + math.log1p(math.exp(-abs(trend - x)))
+
+
+def fill_trends(apps, schema_editor):
+    """ Seed the trends from existing posts. When a like was given isn't
+    recorded, so likes count from the time of their post.
+    """
+    Thread = apps.get_model('forum_app', 'Thread')
+    Category = apps.get_model('forum_app', 'Category')
+    threads = {}
+    categories = {}
+    for model_name in ('Post', 'ArchivedPost'):
+        model = apps.get_model('forum_app', model_name)
+        rows = (model.objects.order_by()
+                .values_list('thread_id', 'thread__category_id',
+                             'created_date', 'likes').iterator())
+        for thread_id, category_id, created_date, likes in rows:
+            x = term(created_date,
+                     POST_WEIGHT + LIKE_WEIGHT * max(likes, 0))
+            threads[thread_id] = add(threads.get(thread_id, EMPTY), x)
+            categories[category_id] = add(
+                categories.get(category_id, EMPTY), x)
+    for thread_id, trend in threads.items():
+        Thread.objects.filter(pk=thread_id).update(trend=trend)
+    for category_id, trend in categories.items():
+        Category.objects.filter(pk=category_id).update(trend=trend)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('forum_app', '0012_pm_retention'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='category',
+            name='trend',
+            field=models.FloatField(db_index=True, default=-1000000000.0),
+        ),
+        migrations.AddField(
+            model_name='thread',
+            name='trend',
+            field=models.FloatField(db_index=True, default=-1000000000.0),
+        ),
+        migrations.RunPython(fill_trends, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='thread',
+            index_together=set([('category', 'trend'), ('author', 'created_date')]),
+        ),
+    ]
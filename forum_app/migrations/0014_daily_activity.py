@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:38
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum_app', '0013_trending'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyActivity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category_id', models.IntegerField()),
+                ('day', models.DateField()),
+                ('posts', models.IntegerField(default=0)),
+                ('threads', models.IntegerField(default=0)),
+                ('users', models.IntegerField(default=0)),
+                ('likes', models.IntegerField(default=0)),
+            ],
+            options={
+                'verbose_name_plural': 'Daily activity',
+            },
+        ),
+        migrations.AlterField(
+            model_name='archivedpost',
+            name='created_date',
+            field=models.DateTimeField(db_index=True),
+        ),
+        migrations.AlterField(
+            model_name='post',
+            name='created_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='thread',
+            name='created_date',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AlterUniqueTogether(
+            name='dailyactivity',
+            unique_together=set([('category_id', 'day')]),
+        ),
+    ]
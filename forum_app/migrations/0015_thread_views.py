@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-19 15:47
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('forum_app', '0014_daily_activity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='thread',
+            name='views',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,81 @@
+from django.db.models.fields.files import FieldFile
+
+
+class DirtyFieldsMixin(object):
+    """ Model mixin that remembers each field's value as loaded from (or last
+    written to) the database. save() on an existing row then passes only the
+    changed fields as update_fields, and skips the UPDATE entirely when
+    nothing changed. A skipped save sends no pre_save/post_save signals.
+
+    Code that changes a field in the database directly (F() updates) and
+    mirrors the new value onto the instance should call mark_clean() for
+    that field, so a later save() doesn't write the mirrored value back.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super(DirtyFieldsMixin, cls).from_db(db, field_names,
+                                                         values)
+        instance.mark_clean()
+        return instance
+
+    def _field_value(self, field):
+        value = getattr(self, field.attname)
+        if isinstance(value, FieldFile):
+            # FieldFile objects are changed in place; compare the file name
+            return value.name
+        return value
+
+    def mark_clean(self, *field_names):
+        """ Record the current value of 'field_names' (default: every loaded
+        field) as what the database holds.
+        """
+        if not hasattr(self, '_clean_values'):
+            self._clean_values = {}
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if field_names and field.name not in field_names and \
+                    field.attname not in field_names:
+                continue
+            self._clean_values[field.attname] = self._field_value(field)
+        return
+
+    def dirty_fields(self):
+        """ attnames of the fields changed since the last load or save, or
+        None if this instance was never loaded (everything must be written).
+        """
+        if not hasattr(self, '_clean_values'):
+            return None
+        dirty = []
+        for field in self._meta.concrete_fields:
+            if field.primary_key:
+                continue
+            if field.attname not in self._clean_values:
+                # deferred when loaded; dirty only if it was assigned since
+                if field.attname in self.__dict__:
+                    dirty.append(field.attname)
+            elif self._field_value(field) != self._clean_values[field.attname]:
+                dirty.append(field.attname)
+        return dirty
+
+    def save(self, *args, **kwargs):
+        if (not self._state.adding and not args and
+                kwargs.get('update_fields') is None and
+                not kwargs.get('force_insert')):
+            dirty = self.dirty_fields()
+            if dirty is not None:
+                if not dirty:
+                    return
+                kwargs['update_fields'] = dirty
+        super(DirtyFieldsMixin, self).save(*args, **kwargs)
+        update_fields = kwargs.get('update_fields')
+        self.mark_clean(*(update_fields or ()))
+        return
+
+    def refresh_from_db(self, using=None, fields=None):
+        super(DirtyFieldsMixin, self).refresh_from_db(using=using,
+                                                      fields=fields)
+        self.mark_clean(*(fields or ()))
+        return
@@ -1,14 +1,18 @@
-from django.db import models
+from django.db import models, IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
 from django.contrib.auth.models import User
 from django.template.defaultfilters import slugify
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
 
 from datetime import datetime
 
+from forum_app import leaderboard, similar, slugs, trending
+from forum_app.mixins import DirtyFieldsMixin
 
-class Profile(models.Model):
+
+class Profile(DirtyFieldsMixin, models.Model):
     """ Custom User model to add additional data on top of the User model
     provided in auth.User. It is better practice to link this Profile to
     auth.User using a OneToOneField() rather than inheriting and overriding
@@ -18,7 +22,7 @@ class Profile(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     # additional attributes we wish to add
     picture = models.ImageField(upload_to='profile_pics', blank=True, null=True)
-    rank = models.IntegerField(default=0)
+    rank = models.IntegerField(default=0, db_index=True)
 
     def get_upload_name(instance, filename):
         """ NOT CURRENTLY IN USE, WILL HAVE THE VIEW HANDLE THIS. 
@@ -39,6 +43,8 @@ def create_user_profile(sender, instance, created, **kwargs):
     print(instance)
     if created:
         Profile.objects.create(user=instance)
+        UserStats.objects.create(user=instance)
+        bump_daily_activity(instance.date_joined, None, users=1)
     return
     
 @receiver(post_save, sender=User)
@@ -50,8 +56,42 @@ def save_user_profile(sender, instance, **kwargs):
     return
 
 
+class UserStats(models.Model):
+    """ Per-user activity totals shown on the profile page. Kept apart from
+    Profile because Profile gets re-saved on every User save (see
+    save_user_profile above); a full-row save of a stale Profile would clobber
+    these counters. They are only ever changed with F() expressions through
+    bump_user_stats(), never by saving an instance.
+    """
+    user = models.OneToOneField(User, on_delete=models.CASCADE,
+                                primary_key=True, related_name='stats')
+    num_posts = models.IntegerField(default=0)
+    num_threads = models.IntegerField(default=0)
+    likes_received = models.IntegerField(default=0)
+    # last time these (or the user's ranks) may have drifted, e.g. because
+    # one of the user's posts was deleted (see reconcile_counters)
+    touched = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        verbose_name_plural = 'User stats'
+
+    def __str__(self):
+        return str(self.user)
+
+
+def bump_user_stats(user, **deltas):
+    """ Atomically add 'deltas' (field=amount) to the UserStats row of
+    'user'. A single UPDATE, so concurrent posts never lose an increment.
+    """
+    changes = {}
+    for field, amount in deltas.items():
+        changes[field] = F(field) + amount
+    UserStats.objects.filter(user=user).update(**changes)
+    return
+
+
         
-class Category(models.Model):
+class Category(DirtyFieldsMixin, models.Model):
     """ Category is a group of 'Threads'.
     """
     # 'recent_post' is a timestamp of most recent post in this category
@@ -62,6 +102,10 @@ class Category(models.Model):
     num_threads = models.IntegerField(default=0)
     num_posts = models.IntegerField(default=0)
     slug = models.SlugField(unique=True)
+    # last time the counters above may have changed (see reconcile_counters)
+    touched = models.DateTimeField(default=timezone.now, db_index=True)
+    # log-space time-decayed activity score (see trending.py)
+    trend = models.FloatField(default=trending.EMPTY, db_index=True)
 
     def new(self, *args, **kwargs):
         # validate some attributes
@@ -91,17 +135,27 @@ class Category(models.Model):
         return self.name
 
 
-class Thread(models.Model):
+class Thread(DirtyFieldsMixin, models.Model):
     """ Thread is a collection of posts in a forum. Usually a Thread is about
     a single topic. 
     """
     name = models.CharField(max_length=200, unique=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE)
     author = models.ForeignKey(User)
-    created_date = models.DateTimeField(default=timezone.now)
+    created_date = models.DateTimeField(default=timezone.now, db_index=True)
     most_recent_post = models.DateTimeField(blank=True, null=True)
     num_posts = models.IntegerField(default=0)
+    # id of the newest post, compared against ThreadRead for unread badges
+    last_post_id = models.IntegerField(default=0)
     slug = models.SlugField(unique=True)
+    # last time the counters above may have changed (see reconcile_counters)
+    touched = models.DateTimeField(default=timezone.now, db_index=True)
+    # posts live in ArchivedPost instead of Post (see archive.py)
+    archived = models.BooleanField(default=False, db_index=True)
+    # log-space time-decayed activity score (see trending.py)
+    trend = models.FloatField(default=trending.EMPTY, db_index=True)
+    # approximate; buffered per worker and added in batches (see viewcounts.py)
+    views = models.PositiveIntegerField(default=0)
 
     def approve(self):
         """ Function to set 'approved' flag. Only approved Threads will be
@@ -112,58 +166,394 @@ class Thread(models.Model):
 
     def new(self, *args, **kwargs):
         self.slug = slugify(self.name)
-        self.category.num_threads += 1
-        self.author.profile.rank += 5
-        self.author.profile.save()
         self.save(*args, **kwargs)
+        # counters are bumped in the database (F() expressions), never
+        # read-modify-written, so concurrent requests can't lose updates.
+        Category.objects.filter(pk=self.category_id).update(
+            num_threads=F('num_threads') + 1, touched=timezone.now())
+        self.category.num_threads += 1
+        self.category.mark_clean('num_threads')
+        bump_user_stats(self.author, num_threads=1)
+        bump_rank(self.author, 5, self.category_id)
+        bump_daily_activity(self.created_date, self.category_id, threads=1)
         return
 
+    class Meta:
+        # threads started by a user, newest first, on the profile page, and
+        # a category's trending threads
+        index_together = [('author', 'created_date'), ('category', 'trend')]
+
     def __str__(self):
         return self.name
 
 
-class Post(models.Model):
+class Post(DirtyFieldsMixin, models.Model):
     """ DB model to store content of a specific Category->Thread->Post. 
     """
     text = models.TextField()
     author = models.ForeignKey(User)
     thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
-    created_date = models.DateTimeField(default=timezone.now)
+    created_date = models.DateTimeField(default=timezone.now, db_index=True)
     likes = models.IntegerField(default=0)
     liked_by = models.ManyToManyField(User,related_name='liked_by')
+    # number of edits; the history is in PostRevision (see revisions.py)
+    edits = models.IntegerField(default=0)
+    edited_date = models.DateTimeField(blank=True, null=True)
 
     def new(self, *args, **kwargs):
-        self.thread.most_recent_post = self.created_date
+        if self.thread.archived:
+            # a reply brings an archived thread back
+            from forum_app import archive
+            archive.restore_thread(self.thread)
+        self.save(*args, **kwargs)
+        # one UPDATE per counter row, done in the database so concurrent
+        # posts can't overwrite each other's increments.
+        now = timezone.now()
+        trend = trending.added(self.created_date, trending.POST_WEIGHT)
+        Thread.objects.filter(pk=self.thread_id).update(
+            num_posts=F('num_posts') + 1, last_post_id=self.pk,
+            most_recent_post=self.created_date, touched=now, trend=trend)
+        Category.objects.filter(pk=self.thread.category_id).update(
+            num_posts=F('num_posts') + 1,
+            most_recent_post=self.created_date, touched=now, trend=trend)
+        # keep the in-memory objects in step for the caller
         self.thread.num_posts += 1
-        self.thread.category.most_recent_post = self.created_date
+        self.thread.most_recent_post = self.created_date
+        self.thread.last_post_id = self.pk
         self.thread.category.num_posts += 1
-        self.author.profile.rank += 1
-        self.thread.save()
-        self.thread.category.save()
-        self.author.profile.save()
-        self.save(*args, **kwargs)
+        self.thread.category.most_recent_post = self.created_date
+        self.thread.mark_clean('num_posts', 'most_recent_post',
+                               'last_post_id')
+        self.thread.category.mark_clean('num_posts', 'most_recent_post')
+        bump_user_stats(self.author, num_posts=1)
+        bump_rank(self.author, 1, self.thread.category_id)
+        bump_daily_activity(self.created_date, self.thread.category_id,
+                            posts=1)
         return
 
     def like(self, user):
-        self.likes += 1
-        self.author.profile.rank += 1
         self.liked_by.add(user)
-        self.author.profile.save()
-        self.save()
+        Post.objects.filter(pk=self.pk).update(likes=F('likes') + 1)
+        self.likes += 1
+        self.mark_clean('likes')
+        bump_user_stats(self.author, likes_received=1)
+        bump_rank(self.author, 1, self.thread.category_id)
+        trending.post_liked(self)
+        bump_daily_activity(timezone.now(), self.thread.category_id, likes=1)
         return
 
     def dislike(self, user):
-        self.likes -= 1
-        self.author.profile.rank -= 1
         self.liked_by.add(user)
-        self.author.profile.save()
-        self.save()
+        Post.objects.filter(pk=self.pk).update(likes=F('likes') - 1)
+        self.likes -= 1
+        self.mark_clean('likes')
+        bump_user_stats(self.author, likes_received=-1)
+        bump_rank(self.author, -1, self.thread.category_id)
+        bump_daily_activity(timezone.now(), self.thread.category_id,
+                            likes=-1)
         return
 
+    def edit(self, text, editor):
+        """ Replace the text of the post, recording the old one as a
+        revision. The row is locked for the edit so concurrent edits are
+        numbered one after the other. created_date stays, so the post keeps
+        its place in the thread; the new 'edits' count changes its fragment
+        cache key.
+        """
+        from forum_app import revisions
+        now = timezone.now()
+        with transaction.atomic():
+            current = (Post.objects.select_for_update()
+                       .only('text', 'edits', 'author', 'created_date')
+                       .get(pk=self.pk))
+            revisions.record(current, text, editor)
+            Post.objects.filter(pk=self.pk).update(
+                text=text, edits=F('edits') + 1, edited_date=now)
+        self.text = text
+        self.edits = current.edits + 1
+        self.edited_date = now
+        self.mark_clean('text', 'edits', 'edited_date')
+        return
+
+    def position(self):
+        """ Number of posts before this one in its thread, in the thread
+        page order (created_date, id). One COUNT over a range of the
+        (thread, created_date, id) index, never touching the table. Written
+        as <= minus the later ties rather than < OR (= AND id <) so the
+        database can use the date as a range bound.
+        """
+        return (Post.objects.filter(thread_id=self.thread_id,
+                                    created_date__lte=self.created_date)
+                .exclude(created_date=self.created_date, id__gte=self.pk)
+                .count())
+
+    class Meta:
+        # a user's recent posts, newest first, on the profile page, and a
+        # thread's posts in page order (for permalinks)
+        index_together = [('author', 'created_date'),
+                          ('thread', 'created_date', 'id')]
+
+    def __str__(self):
+        return self.text
+
+class ArchivedPost(models.Model):
+    """ A Post of an archived Thread, moved out of the Post table so the
+    indexes the live site uses stay small. Keeps the Post's id, so links and
+    cached fragments carry over. Read-only; see archive.py.
+    """
+    id = models.IntegerField(primary_key=True)
+    text = models.TextField()
+    author = models.ForeignKey(User, related_name='+')
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    created_date = models.DateTimeField(db_index=True)
+    likes = models.IntegerField(default=0)
+    edits = models.IntegerField(default=0)
+    edited_date = models.DateTimeField(blank=True, null=True)
+
+    def position(self):
+        """ Same as Post.position(), within the archive.
+        """
+        return (ArchivedPost.objects.filter(
+                    thread_id=self.thread_id,
+                    created_date__lte=self.created_date)
+                .exclude(created_date=self.created_date, id__gte=self.pk)
+                .count())
+
+    class Meta:
+        index_together = [('author', 'created_date'),
+                          ('thread', 'created_date', 'id')]
+
     def __str__(self):
         return self.text
 
-class Conversation(models.Model):
+
+class ArchivedLike(models.Model):
+    """ A Post.liked_by row of an ArchivedPost.
+    """
+    post = models.ForeignKey(ArchivedPost, on_delete=models.CASCADE)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+
+
+class PostRevision(models.Model):
+    """ One revision of an edited Post, stored as a compressed delta
+    against the revision before it or, every few revisions, as a compressed
+    full copy. See revisions.py.
+    """
+    post_id = models.IntegerField()
+    number = models.IntegerField()
+    editor = models.ForeignKey(User, on_delete=models.SET_NULL, null=True,
+                               related_name='+')
+    created_date = models.DateTimeField(default=timezone.now)
+    snapshot = models.BooleanField(default=False)
+    data = models.BinaryField()
+
+    class Meta:
+        unique_together = [('post_id', 'number')]
+
+    def __str__(self):
+        return '{} of post {}'.format(self.number, self.post_id)
+
+
+class DailyActivity(models.Model):
+    """ Posts, new threads, new users and likes in one category on one day
+    (in TIME_ZONE), or site-wide when 'category_id' is 0; new users are only
+    counted site-wide. Kept up to date by the write paths through
+    bump_daily_activity(); see rollups.py for the catch-up and the reads.
+    'category_id' is a plain integer so the site-wide row can be 0 instead
+    of NULL, which a unique constraint wouldn't cover.
+    """
+    category_id = models.IntegerField()
+    day = models.DateField()
+    posts = models.IntegerField(default=0)
+    threads = models.IntegerField(default=0)
+    users = models.IntegerField(default=0)
+    likes = models.IntegerField(default=0)
+
+    class Meta:
+        verbose_name_plural = 'Daily activity'
+        # one category's (or the site's) days, in order
+        unique_together = [('category_id', 'day')]
+
+    def __str__(self):
+        return '{} in {}'.format(self.day, self.category_id)
+
+
+def bump_daily_activity(when, category_id, **deltas):
+    """ Atomically add 'deltas' (field=amount) to the DailyActivity of the
+    day of 'when', for 'category_id' (if not None) and site-wide, creating
+    the rows the first time. One UPDATE when both rows exist.
+    """
+    day = timezone.localdate(when)
+    scopes = [0] if category_id is None else [category_id, 0]
+    changes = dict((field, F(field) + amount)
+                   for field, amount in deltas.items())
+    rows = DailyActivity.objects.filter(day=day, category_id__in=scopes)
+    if rows.update(**changes) == len(scopes):
+        return
+    found = set(rows.values_list('category_id', flat=True))
+    for scope in scopes:
+        if scope in found:
+            continue
+        try:
+            with transaction.atomic():
+                DailyActivity.objects.create(day=day, category_id=scope,
+                                             **deltas)
+        except IntegrityError:
+            # another request created it first
+            DailyActivity.objects.filter(day=day, category_id=scope).update(
+                **changes)
+    return
+
+
+class CategoryRank(models.Model):
+    """ A user's rank earned inside one Category, with the same scoring as
+    Profile.rank (thread +5, post +1, like +/-1). Backs the per-category
+    leaderboards; the (category, rank) index makes their top-N query a short
+    index scan.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    rank = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('category', 'user')]
+        index_together = [('category', 'rank')]
+
+    def __str__(self):
+        return '{} in {}'.format(self.user_id, self.category_id)
+
+
+def bump_category_rank(user, category_id, amount):
+    """ Atomically add 'amount' to the CategoryRank of 'user' in
+    'category_id', creating the row the first time. Returns the row with its
+    new rank so the in-memory leaderboard can be patched.
+    """
+    rows = CategoryRank.objects.filter(user=user, category_id=category_id)
+    if not rows.update(rank=F('rank') + amount):
+        try:
+            with transaction.atomic():
+                return CategoryRank.objects.create(
+                    user=user, category_id=category_id, rank=amount)
+        except IntegrityError:
+            # another request created it first
+            rows.update(rank=F('rank') + amount)
+    return rows.only('id', 'rank', 'category_id').get()
+
+
+def bump_rank(user, amount, category_id):
+    """ Atomically add 'amount' to the rank of 'user', site-wide and in
+    'category_id', then patch the in-process leaderboards.
+    """
+    Profile.objects.filter(user=user).update(rank=F('rank') + amount)
+    profile = user.profile
+    profile.refresh_from_db(fields=['rank'])
+    category_rank = bump_category_rank(user, category_id, amount)
+    leaderboard.rank_changed(user, profile, category_rank)
+    return
+
+
+@receiver(post_delete, sender=Post)
+def post_deleted(sender, instance, **kwargs):
+    """ Deleting a Post doesn't decrement any counters. Instead mark the rows
+    whose counters are now off, so the next incremental reconcile_counters
+    run fixes them. The post's revisions go with it.
+    """
+    now = timezone.now()
+    Thread.objects.filter(pk=instance.thread_id).update(touched=now)
+    UserStats.objects.filter(user_id=instance.author_id).update(touched=now)
+    if instance.edits:
+        PostRevision.objects.filter(post_id=instance.pk).delete()
+    return
+
+@receiver(post_delete, sender=Thread)
+def thread_deleted(sender, instance, **kwargs):
+    """ Same as post_deleted(), for the Category and author of a Thread.
+    Also drops the thread from the similar-titles index.
+    """
+    now = timezone.now()
+    Category.objects.filter(pk=instance.category_id).update(touched=now)
+    UserStats.objects.filter(user_id=instance.author_id).update(touched=now)
+    similar.titles.thread_deleted(instance.pk, instance.category_id)
+    slugs.forget_thread(instance.pk)
+    return
+
+def url_changed(update_fields, url_fields):
+    """ Whether a save that wrote 'update_fields' (None: every field) may
+    have changed one of 'url_fields'. The forms never change slugs; the
+    admin can.
+    """
+    return update_fields is None or bool(set(update_fields) &
+                                         set(url_fields))
+
+@receiver(post_save, sender=Thread)
+def thread_saved(sender, instance, created, **kwargs):
+    """ Keep the similar-titles index and the slug cache in step with
+    created, renamed and moved threads.
+    """
+    similar.titles.thread_saved(instance.pk, instance.category_id,
+                                instance.name, instance.slug)
+    if not created:
+        # may have moved out of a category other workers have loaded
+        similar.titles.publish()
+        slugs.forget_thread(instance.pk)
+        if url_changed(kwargs.get('update_fields'),
+                       ('slug', 'category', 'category_id')):
+            # the sitemap rewrites the shards of touched threads
+            Thread.objects.filter(pk=instance.pk).update(
+                touched=timezone.now())
+    return
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, created, **kwargs):
+    if not created:
+        slugs.forget_category(instance.pk)
+        if url_changed(kwargs.get('update_fields'), ('slug',)):
+            # every thread URL in the category changed with it
+            now = timezone.now()
+            Category.objects.filter(pk=instance.pk).update(touched=now)
+            Thread.objects.filter(category_id=instance.pk).update(
+                touched=now)
+    return
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    slugs.forget_category(instance.pk)
+    return
+
+
+class CategoryRead(models.Model):
+    """ "Mark all read" watermark: every post in 'category' made up to
+    'read_until' counts as read for 'user'. Users without a row count as
+    having read everything posted before they joined.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE)
+    read_until = models.DateTimeField()
+
+    class Meta:
+        unique_together = [('user', 'category')]
+
+    def __str__(self):
+        return '{} in {}'.format(self.user_id, self.category_id)
+
+
+class ThreadRead(models.Model):
+    """ Id of the last post 'user' has seen in 'thread'. Only threads opened
+    since the category watermark have a row; marking the category read drops
+    them again, so the table stays sparse.
+    """
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    thread = models.ForeignKey(Thread, on_delete=models.CASCADE)
+    last_read_post_id = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = [('user', 'thread')]
+
+    def __str__(self):
+        return '{} in {}'.format(self.user_id, self.thread_id)
+
+
+class Conversation(DirtyFieldsMixin, models.Model):
     """ Object to keep track of a group of Pm objects (Private Messages) and 
     associate them with two specific users. We will create two conversation
     objects for each conversation. One belonging to each User participating
@@ -172,6 +562,9 @@ class Conversation(models.Model):
     belongs_to = models.ForeignKey(User, related_name='conversation_belongs_to')
     is_with = models.ForeignKey(User, related_name='conversation_is_with')
     most_recent_pm = models.DateTimeField(blank=True, null=True)
+    # set when the owner deletes the conversation: older messages are gone
+    # for them (and purged later, see inbox.py)
+    cleared_before = models.DateTimeField(blank=True, null=True)
 
     def __str__(self):
         return str(self.is_with)
@@ -185,7 +578,8 @@ class Pm(models.Model):
     """
     text = models.TextField()
     author = models.ForeignKey(User)
-    created_date = models.DateTimeField(default=timezone.now)
+    # indexed for the retention purge
+    created_date = models.DateTimeField(default=timezone.now, db_index=True)
     conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE)
 
     def save(self, *args, **kwargs):
@@ -201,3 +595,32 @@ class Pm(models.Model):
         return self.text
 
 
+class Watermark(models.Model):
+    """ Named progress marker for batch jobs (imports, reconciliation, ...)
+    so that they can resume where the last run stopped. Values are stored as
+    text; get_watermark/set_watermark do the bookkeeping.
+    """
+    name = models.CharField(max_length=100, unique=True)
+    value = models.CharField(max_length=100, blank=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return '{}={}'.format(self.name, self.value)
+
+
+def get_watermark(name, default=None):
+    try:
+        return Watermark.objects.get(name=name).value
+    except Watermark.DoesNotExist:
+        return default
+
+
+def set_watermark(name, value):
+    """ Store 'value' under 'name'. Call inside the transaction that did the
+    work, so the marker and the work are committed together.
+    """
+    if not Watermark.objects.filter(name=name).update(
+            value=str(value), updated=timezone.now()):
+        Watermark.objects.create(name=name, value=str(value))
+    return
+
@@ -0,0 +1,273 @@
+""" Set-based bulk moderation: delete or move posts and threads.
+
+QuerySet.delete() on posts goes through Django's collector, which loads
+every Post and liked_by row into memory to send signals and cascade, and
+the counters it leaves behind are wrong. These functions work on batches of
+ids instead: each batch is a handful of DELETE/UPDATE ... WHERE id IN (...)
+statements followed by recomputing the counters of exactly the threads,
+categories and users it touched, all in one short transaction. On SQLite
+that transaction is the only time the database is write-locked, so readers
+and other writers wait for one batch at most; 'pause' adds a gap between
+batches on a busy site.
+
+Threads left without any posts are deleted along with their last post,
+since a thread page needs its opening post.
+
+Posts of archived threads are not touched by the post functions; deleting
+an archived thread restores it first so its posts go the same way, and so
+does moving posts into one.
+
+Signals are not sent. Callers get the per-worker caches (leaderboards,
+similar titles) cleared by finish().
+"""
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from forum_app import archive, counters, leaderboard, similar
+from forum_app.counters import batches, sql_in
+from forum_app.models import Thread, Post, ArchivedPost, PostRevision
+from forum_app.models import ThreadRead
+
+BATCH_SIZE = 500
+
+
+def select_posts(author=None, thread=None, category=None, since=None,
+                 until=None):
+    """ Posts matching every given filter (User, Thread, Category objects,
+    created_date bounds).
+    """
+    posts = Post.objects.all()
+    if author is not None:
+        posts = posts.filter(author=author)
+    if thread is not None:
+        posts = posts.filter(thread=thread)
+    if category is not None:
+        posts = posts.filter(thread__category=category)
+    if since is not None:
+        posts = posts.filter(created_date__gte=since)
+    if until is not None:
+        posts = posts.filter(created_date__lt=until)
+    return posts
+
+
+def select_threads(author=None, category=None, since=None, until=None):
+    """ Threads matching every given filter, by thread author and
+    created_date.
+    """
+    threads = Thread.objects.all()
+    if author is not None:
+        threads = threads.filter(author=author)
+    if category is not None:
+        threads = threads.filter(category=category)
+    if since is not None:
+        threads = threads.filter(created_date__gte=since)
+    if until is not None:
+        threads = threads.filter(created_date__lt=until)
+    return threads
+
+
+def _affected(post_ids):
+    """ (thread ids, author ids) of 'post_ids'.
+    """
+    rows = (Post.objects.filter(id__in=post_ids).order_by()
+            .values_list('thread_id', 'author_id').distinct())
+    return set(row[0] for row in rows), set(row[1] for row in rows)
+
+
+def _thread_owners(thread_ids):
+    """ (category ids, author ids) of 'thread_ids'.
+    """
+    rows = (Thread.objects.filter(id__in=thread_ids).order_by()
+            .values_list('category_id', 'author_id').distinct())
+    return set(row[0] for row in rows), set(row[1] for row in rows)
+
+
+def _delete_threads(cursor, thread_ids):
+    """ Delete threads that have no posts left (and what points at them).
+    """
+    if not thread_ids:
+        return
+    thread_ids = list(thread_ids)
+    ThreadRead.objects.filter(thread_id__in=thread_ids).delete()
+    cursor.execute(
+        'DELETE FROM {} WHERE id IN {}'.format(Thread._meta.db_table,
+                                                sql_in(thread_ids)),
+        thread_ids)
+    return
+
+
+def _recompute(thread_ids, category_ids, user_ids):
+    counters.recompute_threads(thread_ids)
+    counters.recompute_categories(category_ids)
+    counters.recompute_users(user_ids)
+    return
+
+
+def _empty(thread_ids):
+    nonempty = set(Post.objects.filter(thread_id__in=thread_ids).order_by()
+                   .values_list('thread_id', flat=True).distinct())
+    return set(thread_ids) - nonempty
+
+
+def delete_post_batch(post_ids):
+    """ Delete 'post_ids' and fix every counter they fed. Call inside a
+    transaction. Returns the number of threads deleted for being empty.
+    """
+    thread_ids, user_ids = _affected(post_ids)
+    category_ids, thread_authors = _thread_owners(thread_ids)
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {} WHERE post_id IN {}'.format(
+            Post.liked_by.through._meta.db_table, sql_in(post_ids)), post_ids)
+        cursor.execute('DELETE FROM {} WHERE post_id IN {}'.format(
+            PostRevision._meta.db_table, sql_in(post_ids)), post_ids)
+        cursor.execute('DELETE FROM {} WHERE id IN {}'.format(
+            Post._meta.db_table, sql_in(post_ids)), post_ids)
+        empty = _empty(thread_ids)
+        _delete_threads(cursor, empty)
+    if empty:
+        user_ids |= thread_authors
+    _recompute(thread_ids - empty, category_ids, user_ids)
+    return len(empty)
+
+
+def move_post_batch(post_ids, thread):
+    """ Move 'post_ids' into 'thread' and fix the counters. Call inside a
+    transaction. Returns the number of threads deleted for being empty.
+    """
+    if Thread.objects.filter(pk=thread.pk, archived=True).exists():
+        # an archived thread shows (and counts) only its archived posts;
+        # bring it back first, as a reply would
+        archive.restore_thread(thread)
+    thread_ids, user_ids = _affected(post_ids)
+    category_ids, thread_authors = _thread_owners(thread_ids | {thread.pk})
+    with connection.cursor() as cursor:
+        cursor.execute('UPDATE {} SET thread_id = %s WHERE id IN {}'.format(
+            Post._meta.db_table, sql_in(post_ids)), [thread.pk] + post_ids)
+        empty = _empty(thread_ids - {thread.pk})
+        _delete_threads(cursor, empty)
+    if empty:
+        user_ids |= thread_authors
+    _recompute((thread_ids | {thread.pk}) - empty, category_ids, user_ids)
+    return len(empty)
+
+
+def move_thread_batch(thread_ids, category):
+    """ Move 'thread_ids' into 'category' and fix the counters, including
+    the per-category ranks of everyone who posted in them. Call inside a
+    transaction.
+    """
+    category_ids, user_ids = _thread_owners(thread_ids)
+    for model in (Post, ArchivedPost):
+        user_ids |= set(model.objects.filter(thread_id__in=thread_ids)
+                        .order_by().values_list('author_id', flat=True)
+                        .distinct())
+    # touched: the threads' URLs changed (see sitemap.py)
+    Thread.objects.filter(id__in=thread_ids).update(category=category,
+                                                    touched=timezone.now())
+    counters.recompute_categories(category_ids | {category.pk})
+    counters.recompute_users(user_ids)
+    return
+
+
+def run(label, id_batches, apply, pause=0, log=None):
+    """ apply(batch of ids) for each batch, one transaction per batch.
+    Returns (rows, extra) where 'extra' sums what apply() returned.
+    """
+    rows = 0
+    extra = 0
+    for chunk in id_batches:
+        with transaction.atomic():
+            extra += apply(chunk) or 0
+        rows += len(chunk)
+        if log is not None:
+            log('  {} {} so far'.format(label, rows))
+        if pause:
+            time.sleep(pause)
+    return rows, extra
+
+
+def delete_posts(posts, batch_size=BATCH_SIZE, pause=0, log=None):
+    """ Delete the posts of queryset 'posts'. Returns (posts deleted,
+    threads deleted for being left empty).
+    """
+    return run('posts deleted', batches(posts, 'id', batch_size),
+               delete_post_batch, pause, log)
+
+
+def delete_threads(threads, batch_size=BATCH_SIZE, pause=0, log=None):
+    """ Delete the threads of queryset 'threads' with all their posts, the
+    posts in bounded batches however long the threads are. Returns
+    (posts deleted, threads deleted).
+    """
+    deleted_posts, deleted_threads = 0, 0
+    for chunk in batches(threads, 'id', batch_size):
+        with transaction.atomic():
+            archived = list(Thread.objects.filter(id__in=chunk, archived=True)
+                            .values_list('id', flat=True))
+            if archived:
+                archive.restore_batch(archived)
+        rows, empty = delete_posts(
+            Post.objects.filter(thread_id__in=chunk), batch_size, pause, log)
+        deleted_posts += rows
+        deleted_threads += empty
+        # threads that had no posts to begin with
+        with transaction.atomic():
+            leftover = list(Thread.objects.filter(id__in=chunk)
+                            .values_list('id', flat=True))
+            if leftover:
+                categories, authors = _thread_owners(leftover)
+                with connection.cursor() as cursor:
+                    _delete_threads(cursor, leftover)
+                counters.recompute_categories(categories)
+                counters.recompute_users(authors)
+                deleted_threads += len(leftover)
+    return deleted_posts, deleted_threads
+
+
+def move_posts(posts, thread, batch_size=BATCH_SIZE, pause=0, log=None):
+    """ Move the posts of queryset 'posts' into 'thread'. Returns (posts
+    moved, threads deleted for being left empty).
+    """
+    return run('posts moved', batches(posts.exclude(thread=thread), 'id',
+                                      batch_size),
+               lambda ids: move_post_batch(ids, thread), pause, log)
+
+
+def move_threads(threads, category, batch_size=BATCH_SIZE, pause=0,
+                 log=None):
+    """ Move the threads of queryset 'threads' into 'category'. Returns
+    (threads moved, 0).
+    """
+    return run('threads moved', batches(threads.exclude(category=category),
+                                        'id', batch_size),
+               lambda ids: move_thread_batch(ids, category), pause, log)
+
+
+def finish():
+    """ Drop the per-worker caches the bulk changes made stale, in this
+    worker and (through the invalidation bus) in the others.
+    """
+    leaderboard.boards.clear()
+    similar.titles.clear()
+    leaderboard.boards.publish()
+    similar.titles.publish()
+    return
+
+
+def parse_bound(value):
+    """ Datetime from a --since/--until style argument, or None.
+    """
+    if not value:
+        return None
+    date = parse_datetime(value)
+    if date is None:
+        date = parse_datetime(value + 'T00:00:00')
+    if date is None:
+        raise ValueError('bad date {!r}'.format(value))
+    if settings.USE_TZ and timezone.is_naive(date):
+        date = timezone.make_aware(date)
+    return date
@@ -0,0 +1,78 @@
+from django.core.paginator import Paginator
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+# posts per thread page; also used for ?page=N URLs outside the views
+POSTS_PER_PAGE = 50
+
+
+class CountedPaginator(Paginator):
+    """ Paginator for lists whose length we already keep as a denormalized
+    counter (UserStats.num_posts, Thread.num_posts, ...). Django's Paginator
+    runs a COUNT(*) over object_list to find the number of pages, which grows
+    with the data. Passing 'count' in makes every page cost one LIMIT/OFFSET
+    query against an index.
+    """
+    def __init__(self, object_list, per_page, count, **kwargs):
+        super(CountedPaginator, self).__init__(object_list, per_page, **kwargs)
+        self._known_count = max(count, 0)
+
+    @cached_property
+    def count(self):
+        return self._known_count
+
+
+def decode_cursor(cursor, length):
+    """ Turn a cursor string from the query string ('12_345') back into a
+    tuple of ints. Anything malformed means "start from the first page".
+    """
+    try:
+        values = tuple(int(part) for part in cursor.split('_'))
+    except (AttributeError, ValueError):
+        return None
+    if len(values) != length:
+        return None
+    return values
+
+
+def cursor_page(queryset, keys, cursor, per_page):
+    """ Keyset ("seek") pagination, newest/highest first. Instead of an
+    OFFSET that has to walk past every earlier row, each page starts right
+    after the last row of the previous one, so page 10,000 costs the same
+    index range scan as page 1.
+    ARGs:
+        queryset - rows to page through
+        keys - integer field names to sort on, descending. The last one must
+               be unique (usually 'id') so that ties are broken.
+        cursor - string from a previous page's 'next_cursor', or None
+        per_page - rows per page
+    RET:
+        (rows, next_cursor) - next_cursor is None on the last page
+    """
+    values = decode_cursor(cursor, len(keys)) if cursor else None
+    if values:
+        # (k1, k2, ...) < (v1, v2, ...) spelled out for the ORM
+        after = Q()
+        for i, key in enumerate(keys):
+            step = Q(**{'{}__lt'.format(key): values[i]})
+            for prev_key, prev_value in zip(keys[:i], values[:i]):
+                step &= Q(**{prev_key: prev_value})
+            after |= step
+        queryset = queryset.filter(after)
+    ordering = ['-{}'.format(key) for key in keys]
+    rows = list(queryset.order_by(*ordering)[:per_page + 1])
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        last = rows[-1]
+        next_cursor = '_'.join(str(getattr(last, key)) for key in keys)
+    return rows, next_cursor
+
+
+def prefix_range(field, prefix):
+    """ Filter kwargs matching values of 'field' that start with 'prefix'.
+    SQLite will not use an index for startswith (it is a LIKE with an ESCAPE
+    clause), but it will for a plain range on the column.
+    """
+    return {'{}__gte'.format(field): prefix,
+            '{}__lt'.format(field): prefix + u'\U0010ffff'}
@@ -0,0 +1,138 @@
+""" Token-bucket rate limits for the write and search endpoints.
+
+One script posting, liking or searching in a loop can keep the database
+writer busy for everyone. Each limited endpoint gets a bucket per user (per
+address for visitors) holding up to N tokens and refilling at N per period;
+a request takes a token or is answered 429 with Retry-After saying when the
+next one will be there. So a client gets bursts of up to N requests and N
+per period after that, and only its own bucket runs dry.
+
+Limits are set per URL name in settings.RATE_LIMITS, as 'N/s', 'N/m',
+'N/h' or 'N/d', and apply to everything but GET and HEAD (reads of the
+same pages are not limited):
+
+    RATE_LIMITS = {'thread': '10/m', 'like_post': '60/m', ...}
+
+RateLimitMiddleware (middleware.py) applies them; @rate_limit('N/m')
+limits a view that isn't configured there. Buckets live in the
+RATELIMIT_CACHE cache backend, as (tokens, time) under one key each; a
+check is one cache get and one set. With a per-process backend (locmem)
+every worker has its own buckets, so a host allows up to workers times the
+limit; a shared backend (file, memcached) makes the limit host- or
+site-wide. The get and set aren't atomic, so concurrent requests of one
+client can get a token or two more than they should; the limit is for
+floods, not exact counting.
+
+Behind a reverse proxy every request comes from the proxy's address, which
+would put all visitors in one bucket. List the proxies in
+settings.TRUSTED_PROXIES and a visitor's address is taken from the
+X-Forwarded-For (else X-Real-IP) header they set instead; the header is
+ignored on requests from anywhere else, so clients can't pick a bucket.
+"""
+from functools import wraps
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+RATELIMIT_CACHE = getattr(settings, 'RATELIMIT_CACHE', 'default')
+SAFE_METHODS = ('GET', 'HEAD')
+
+PERIODS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+_parsed = {}
+
+
+def parse_rate(rate):
+    """ (tokens, seconds) for a rate like '10/m'. Raises ValueError.
+    """
+    if rate not in _parsed:
+        count, unit = rate.split('/')
+        if unit not in PERIODS:
+            raise ValueError('bad rate {!r}'.format(rate))
+        _parsed[rate] = (int(count), PERIODS[unit])
+    return _parsed[rate]
+
+
+def client_address(request):
+    """ The address 'request' came from: REMOTE_ADDR, or for a request from
+    one of settings.TRUSTED_PROXIES the address the proxies forwarded.
+    """
+    address = request.META.get('REMOTE_ADDR', '')
+    proxies = getattr(settings, 'TRUSTED_PROXIES', ())
+    if address not in proxies:
+        return address
+    forwarded = [hop.strip() for hop in
+                 request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+    # the last hop not added by a trusted proxy; anything before it could
+    # have been sent by the client
+    for hop in reversed(forwarded):
+        if hop and hop not in proxies:
+            return hop
+    return request.META.get('HTTP_X_REAL_IP', '').strip() or address
+
+
+def client(request):
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return 'u{}'.format(user.pk)
+    return 'a' + client_address(request)
+
+
+def take(name, who, rate, now=None):
+    """ Take a token from the bucket of 'who' for 'name'. Returns 0 if
+    there was one, else the seconds until there will be.
+    """
+    capacity, period = parse_rate(rate)
+    if now is None:
+        now = time.time()
+    cache = caches[RATELIMIT_CACHE]
+    key = 'rl:{}:{}'.format(name, who)
+    state = cache.get(key)
+    if state is None:
+        tokens = capacity
+    else:
+        tokens = min(capacity, state[0] + (now - state[1]) * capacity / period)
+    if tokens < 1:
+        return (1 - tokens) * period / capacity
+    # an untouched bucket is full again after one period
+    cache.set(key, (tokens - 1, now), period)
+    return 0
+
+
+def too_many(retry_after):
+    response = HttpResponse('Too many requests, slow down.', status=429,
+                            content_type='text/plain')
+    response['Retry-After'] = int(math.ceil(retry_after))
+    return response
+
+
+def check(request, name, rate):
+    """ None if 'request' may go ahead, else a 429 response.
+    """
+    wait = take(name, client(request), rate)
+    if wait:
+        return too_many(wait)
+    return None
+
+
+def rate_limit(rate, name=None, methods=None):
+    """ Decorator limiting a view to 'rate' per client, for 'methods'
+    (default: all but GET and HEAD). 'name' (default: the view's) names the
+    buckets.
+    """
+    def decorator(view):
+        bucket = name or view.__name__
+
+        @wraps(view)
+        def limited(request, *args, **kwargs):
+            if (request.method in methods if methods is not None
+                    else request.method not in SAFE_METHODS):
+                response = check(request, bucket, rate)
+                if response is not None:
+                    return response
+            return view(request, *args, **kwargs)
+        return limited
+    return decorator
@@ -0,0 +1,166 @@
+""" Per-user read markers, for unread badges and "jump to first unread".
+
+A user's read state is kept in two small tables:
+    CategoryRead - per category, a time up to which everything counts as read
+                   (set by "mark all read"; defaults to when the user joined)
+    ThreadRead   - per thread opened since then, the id of the last post seen
+
+A thread is unread when it has posts newer than the category watermark and
+its newest post is past the user's ThreadRead marker (or there is none),
+and a category is unread while one of its threads is.
+Markers only ever move forward, and each is written with a single upsert.
+"""
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Exists, OuterRef, Q
+
+from forum_app.models import CategoryRead, Thread, ThreadRead
+
+# INSERT ... ON CONFLICT keeping the larger of the stored and new value
+UPSERT_SQL = {
+    'sqlite': ('INSERT INTO {table} ({columns}) VALUES ({params}) '
+               'ON CONFLICT ({keys}) DO UPDATE SET '
+               '{value} = MAX({value}, excluded.{value})'),
+    'postgresql': ('INSERT INTO {table} ({columns}) VALUES ({params}) '
+                   'ON CONFLICT ({keys}) DO UPDATE SET '
+                   '{value} = GREATEST({table}.{value}, excluded.{value})'),
+    'mysql': ('INSERT INTO {table} ({columns}) VALUES ({params}) '
+              'ON DUPLICATE KEY UPDATE '
+              '{value} = GREATEST({value}, VALUES({value}))'),
+}
+
+
+def _has_upsert():
+    if connection.vendor == 'sqlite':
+        # ON CONFLICT ... DO UPDATE arrived in SQLite 3.24
+        import sqlite3
+        return sqlite3.sqlite_version_info >= (3, 24, 0)
+    return connection.vendor in UPSERT_SQL
+
+
+def advance(model, keys, field, value):
+    """ Set 'field' of the 'model' row identified by 'keys' (attname: value)
+    to 'value', creating the row if needed, unless it already holds a larger
+    value.
+    """
+    model_field = model._meta.get_field(field)
+    if _has_upsert():
+        quote = connection.ops.quote_name
+        columns = list(keys) + [model_field.column]
+        params = list(keys.values()) + [
+            model_field.get_db_prep_save(value, connection)]
+        sql = UPSERT_SQL[connection.vendor].format(
+            table=quote(model._meta.db_table),
+            columns=', '.join(quote(column) for column in columns),
+            params=', '.join(['%s'] * len(columns)),
+            keys=', '.join(quote(column) for column in keys),
+            value=quote(model_field.column))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+        return
+    rows = model.objects.filter(**keys)
+    if rows.filter(**{field + '__lt': value}).update(**{field: value}):
+        return
+    if rows.exists():
+        return
+    try:
+        with transaction.atomic():
+            model.objects.create(**dict(keys, **{field: value}))
+    except IntegrityError:
+        # another request created it first
+        rows.filter(**{field + '__lt': value}).update(**{field: value})
+    return
+
+
+def mark_thread_read(user, thread, post_id):
+    """ Record that 'user' has seen 'thread' up to post 'post_id'.
+    """
+    advance(ThreadRead, {'user_id': user.pk, 'thread_id': thread.pk},
+            'last_read_post_id', post_id)
+    return
+
+
+def mark_category_read(user, category, when):
+    """ Mark everything in 'category' posted up to 'when' as read. The
+    thread markers it supersedes are dropped.
+    """
+    advance(CategoryRead, {'user_id': user.pk, 'category_id': category.pk},
+            'read_until', when)
+    ThreadRead.objects.filter(user=user, thread__category=category,
+                              thread__most_recent_post__lte=when).delete()
+    return
+
+
+def category_watermarks(user, category_ids):
+    """ {category id: read_until} for 'user', defaulting to date_joined.
+    """
+    marks = dict(CategoryRead.objects.filter(
+        user=user, category_id__in=category_ids)
+        .values_list('category_id', 'read_until'))
+    return dict((pk, marks.get(pk, user.date_joined)) for pk in category_ids)
+
+
+def is_unread(thread, since, last_read):
+    """ Whether 'thread' has posts the user hasn't seen, given the category
+    watermark 'since' and the thread marker 'last_read' (None if none).
+    """
+    if thread.most_recent_post is None or thread.most_recent_post <= since:
+        return False
+    return last_read is None or thread.last_post_id > last_read
+
+
+def annotate_categories(user, categories):
+    """ Set .unread on each of 'categories': whether it holds an unread
+    thread. One query for the watermarks and one EXISTS query for the
+    categories with unread threads.
+    """
+    categories = list(categories)
+    if not user.is_authenticated:
+        return categories
+    marks = category_watermarks(user, [c.pk for c in categories])
+    # only categories with posts past their watermark can hold unread threads
+    candidates = [c for c in categories if c.most_recent_post is not None and
+                  c.most_recent_post > marks[c.pk]]
+    unread = set()
+    if candidates:
+        newer = Q()
+        for category in candidates:
+            newer |= Q(category_id=category.pk,
+                       most_recent_post__gt=marks[category.pk])
+        seen = ThreadRead.objects.filter(
+            user=user, thread=OuterRef('pk'),
+            last_read_post_id__gte=OuterRef('last_post_id'))
+        unread = set(Thread.objects.filter(newer)
+                     .annotate(seen=Exists(seen)).filter(seen=False)
+                     .values_list('category_id', flat=True).distinct())
+    for category in categories:
+        category.unread = category.pk in unread
+    return categories
+
+
+def annotate_threads(user, category, threads):
+    """ Set .unread on each of 'threads' (all in 'category'). One query for
+    the page's thread markers and one for the category watermark.
+    """
+    threads = list(threads)
+    if not user.is_authenticated:
+        return threads
+    since = category_watermarks(user, [category.pk])[category.pk]
+    markers = dict(ThreadRead.objects.filter(
+        user=user, thread_id__in=[t.pk for t in threads])
+        .values_list('thread_id', 'last_read_post_id'))
+    for thread in threads:
+        thread.unread = is_unread(thread, since, markers.get(thread.pk))
+    return threads
+
+
+def first_unread(user, thread):
+    """ The first post in 'thread' 'user' hasn't seen, or None.
+    """
+    since = category_watermarks(user, [thread.category_id])
+    posts = thread.post_set.filter(
+        created_date__gt=since[thread.category_id])
+    last_read = (ThreadRead.objects.filter(user=user, thread=thread)
+                 .values_list('last_read_post_id', flat=True).first())
+    if last_read is not None:
+        posts = posts.filter(id__gt=last_read)
+    return posts.order_by('created_date', 'id').first()
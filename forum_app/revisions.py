@@ -0,0 +1,164 @@
+""" Edit history of posts, stored as compressed deltas.
+
+Revision 0 of a post is its original text and revision n its text after the
+n-th edit (Post.edits is the number of the latest one). Keeping a full copy
+of every revision would double the post table for a forum that edits a lot,
+so most revisions are stored as a delta against the revision before it:
+
+    [[start, end], "inserted text", [start, end], ...]
+
+where [start, end] copies tokens start:end of the previous revision
+(tokens being runs of whitespace and runs of everything else), zlib
+compressed. Every SNAPSHOT_EVERY-th revision (and revision 0) is a
+compressed full copy instead, so rebuilding any revision applies at most
+SNAPSHOT_EVERY - 1 deltas to the snapshot before it.
+
+Revisions are keyed by post id rather than a foreign key, so they stay
+attached when a post is archived (ArchivedPost keeps the id).
+"""
+import difflib
+import json
+import re
+import zlib
+
+from django.utils import timezone
+
+from forum_app.models import PostRevision
+
+SNAPSHOT_EVERY = 10
+
+TOKENS = re.compile(r'\s+|\S+')
+
+
+def tokens(text):
+    return TOKENS.findall(text)
+
+
+def snapshot(text):
+    return zlib.compress(text.encode('utf-8'))
+
+
+def delta(old, new):
+    """ Compressed delta turning 'old' into 'new'.
+    """
+    a, b = tokens(old), tokens(new)
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    ops = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return zlib.compress(json.dumps(ops, separators=(',', ':'))
+                         .encode('utf-8'))
+
+
+def patch(old, data):
+    """ Apply the delta 'data' to 'old'.
+    """
+    a = tokens(old)
+    parts = []
+    for op in json.loads(zlib.decompress(data).decode('utf-8')):
+        if isinstance(op, list):
+            parts.extend(a[op[0]:op[1]])
+        else:
+            parts.append(op)
+    return ''.join(parts)
+
+
+def apply(text, flag, data):
+    """ The revision stored as (snapshot flag, data), given 'text', the
+    revision before it.
+    """
+    data = bytes(data)
+    if flag:
+        return zlib.decompress(data).decode('utf-8')
+    return patch(text, data)
+
+
+def rebuild(rows):
+    """ Text of the last of 'rows', (snapshot flag, data) pairs in revision
+    order starting with a snapshot.
+    """
+    text = None
+    for flag, data in rows:
+        text = apply(text, flag, data)
+    return text
+
+
+def snapshot_at(number):
+    return number % SNAPSHOT_EVERY == 0
+
+
+def encode(number, old, new):
+    """ (snapshot flag, data) storing revision 'number', 'new', whose
+    previous revision is 'old'.
+    """
+    if snapshot_at(number):
+        return True, snapshot(new)
+    return False, delta(old, new)
+
+
+def record(post, new_text, editor):
+    """ Store the revision an edit of 'post' to 'new_text' creates; 'post'
+    holds the text and edit count from before the edit. The first edit also
+    stores the original text as revision 0. Call inside the transaction
+    that updates the post.
+    """
+    number = post.edits + 1
+    rows = []
+    if number == 1:
+        rows.append(PostRevision(post_id=post.pk, number=0,
+                                 editor_id=post.author_id,
+                                 created_date=post.created_date,
+                                 snapshot=True, data=snapshot(post.text)))
+    flag, data = encode(number, post.text, new_text)
+    rows.append(PostRevision(post_id=post.pk, number=number, editor=editor,
+                             created_date=timezone.now(), snapshot=flag,
+                             data=data))
+    PostRevision.objects.bulk_create(rows)
+    return number
+
+
+def version(post_id, number):
+    """ Text of revision 'number' of post 'post_id', or None if there is no
+    such revision. Reads at most SNAPSHOT_EVERY rows.
+    """
+    base = number - number % SNAPSHOT_EVERY
+    rows = list(PostRevision.objects
+                .filter(post_id=post_id, number__gte=base,
+                        number__lte=number)
+                .order_by('number').values_list('number', 'snapshot',
+                                                'data'))
+    if not rows or rows[-1][0] != number:
+        return None
+    return rebuild((row[1], row[2]) for row in rows)
+
+
+def history(post_id):
+    """ Every revision of post 'post_id', oldest first, as PostRevision
+    objects with the rebuilt text in 'text'. One pass over the rows, each
+    delta applied once.
+    """
+    revisions = list(PostRevision.objects.filter(post_id=post_id)
+                     .select_related('editor').order_by('number'))
+    text = None
+    for revision in revisions:
+        revision.text = text = apply(text, revision.snapshot, revision.data)
+    return revisions
+
+
+def storage(post_ids=None):
+    """ (bytes stored, bytes full copies would take) for the revisions of
+    'post_ids', or of every post.
+    """
+    revisions = PostRevision.objects.order_by('post_id', 'number')
+    if post_ids is not None:
+        revisions = revisions.filter(post_id__in=post_ids)
+    stored = full = 0
+    text = None
+    for flag, data in revisions.values_list('snapshot', 'data'):
+        text = apply(text, flag, data)
+        stored += len(data)
+        full += len(text.encode('utf-8'))
+    return stored, full
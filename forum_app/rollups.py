@@ -0,0 +1,149 @@
+""" Daily activity rollups for the staff stats.
+
+DailyActivity holds posts, new threads, new users and likes per category
+(and site-wide) per day. The write paths add to it as they go (see
+bump_daily_activity() in models.py), so a month of stats for one category
+is at most 31 rows read through the (category_id, day) unique index, however
+many posts there are.
+
+Anything that writes around those paths (imports, moderation, deleted
+posts) leaves the rows behind. catch_up() recounts posts, threads and users
+day by day from the raw tables, starting at the day stored in the
+'rollups' watermark, and moves the watermark to today: days before that are
+final, so each run only recounts what may have changed since the last one.
+Each day is one short transaction. Likes can't be recounted (when a like
+was given isn't stored), so catch_up() leaves them as they are.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import time
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from forum_app.models import Thread, Post, ArchivedPost, DailyActivity
+from forum_app.models import get_watermark, set_watermark
+
+WATERMARK = 'rollups'
+FIELDS = ('posts', 'threads', 'users', 'likes')
+
+
+def day_range(day):
+    """ Aware datetimes where 'day' (in TIME_ZONE) starts and ends.
+    """
+    midnight = datetime.min.time()
+    start = timezone.make_aware(datetime.combine(day, midnight))
+    end = timezone.make_aware(datetime.combine(day + timedelta(days=1),
+                                               midnight))
+    return start, end
+
+
+def count_day(day):
+    """ {category id or 0: {field: count}} of posts, threads and users
+    created on 'day', from the raw tables.
+    """
+    start, end = day_range(day)
+    counts = defaultdict(lambda: defaultdict(int))
+    for model in (Post, ArchivedPost):
+        rows = (model.objects.filter(created_date__gte=start,
+                                     created_date__lt=end)
+                .values_list('thread__category_id').annotate(n=Count('id'))
+                .order_by())
+        for category_id, n in rows:
+            counts[category_id]['posts'] += n
+            counts[0]['posts'] += n
+    rows = (Thread.objects.filter(created_date__gte=start, created_date__lt=end)
+            .values_list('category_id').annotate(n=Count('id')).order_by())
+    for category_id, n in rows:
+        counts[category_id]['threads'] += n
+        counts[0]['threads'] += n
+    users = User.objects.filter(date_joined__gte=start,
+                                date_joined__lt=end).count()
+    if users:
+        counts[0]['users'] = users
+    return counts
+
+
+def rollup_day(day):
+    """ Replace the post, thread and user counts of 'day' with a recount.
+    Call inside a transaction.
+    """
+    counts = count_day(day)
+    DailyActivity.objects.filter(day=day).update(posts=0, threads=0, users=0)
+    for scope, values in counts.items():
+        rows = DailyActivity.objects.filter(day=day, category_id=scope)
+        if not rows.update(**values):
+            DailyActivity.objects.create(day=day, category_id=scope, **values)
+    return
+
+
+def first_day():
+    """ The day of the oldest post, thread or user, or today.
+    """
+    dates = [timezone.now()]
+    for model, field in [(Post, 'created_date'),
+                         (ArchivedPost, 'created_date'),
+                         (Thread, 'created_date'),
+                         (User, 'date_joined')]:
+        row = model.objects.order_by(field).values_list(field,
+                                                        flat=True).first()
+        if row is not None:
+            dates.append(row)
+    return timezone.localdate(min(dates))
+
+
+def catch_up(since=None, pause=0, log=None):
+    """ Recount every day from 'since' (default: the watermark, or the very
+    first day) up to today. Returns the number of days recounted.
+    """
+    if since is None:
+        mark = get_watermark(WATERMARK)
+        since = (datetime.strptime(mark, '%Y-%m-%d').date() if mark
+                 else first_day())
+    today = timezone.localdate()
+    day = since
+    done = 0
+    while day <= today:
+        with transaction.atomic():
+            rollup_day(day)
+            set_watermark(WATERMARK, day.isoformat())
+        done += 1
+        if log is not None and done % 30 == 0:
+            log('  rolled up to {}'.format(day))
+        if pause:
+            time.sleep(pause)
+        day += timedelta(days=1)
+    return done
+
+
+def activity(category_id, start, end):
+    """ [{'day', 'posts', 'threads', 'users', 'likes'}] for every day from
+    'start' to 'end' inclusive, for 'category_id' (0: site-wide). Days
+    without activity are filled with zeros.
+    """
+    rows = dict((row['day'], row) for row in
+                DailyActivity.objects.filter(category_id=category_id,
+                                             day__gte=start, day__lte=end)
+                .values('day', *FIELDS))
+    days = []
+    day = start
+    while day <= end:
+        row = rows.get(day) or dict((field, 0) for field in FIELDS)
+        row['day'] = day
+        days.append(row)
+        day += timedelta(days=1)
+    return days
+
+
+def month_bounds(value=None):
+    """ First and last day of month 'value' ('YYYY-MM'), default this
+    month. Raises ValueError for a malformed month.
+    """
+    if value:
+        first = datetime.strptime(value, '%Y-%m').date()
+    else:
+        first = timezone.localdate().replace(day=1)
+    following = (first + timedelta(days=32)).replace(day=1)
+    return first, following - timedelta(days=1)
@@ -0,0 +1,198 @@
+""" In-process character-trigram index of thread titles, per category.
+
+Used to suggest existing threads while someone types the title of a new one,
+so near-duplicates ("Best pizza in town?" / "best pizza in town") are caught
+before they split a discussion.
+
+Titles are lowercased, runs of anything but letters and digits become one
+space, and the result is cut into overlapping 3-character grams (with a
+leading and trailing space, so word boundaries count). Each category keeps a
+posting list (gram -> thread ids) and the gram count of every title. A query
+counts, per thread, how many of its grams hit, and scores the candidates with
+the Dice coefficient 2 * shared / (query grams + title grams).
+
+Grams that occur in more than MAX_POSTING titles of a category (" th", "ing",
+...) say little about similarity but would dominate the counting, so they are
+skipped at query time. That bounds a query to a few thousand list entries
+however many threads a category has.
+
+Like the leaderboards, each worker loads a category's index on first use
+(or all at once with load_all()) and then patches it on thread create,
+rename and delete through the model signals. Other workers drop the
+category's index through the invalidation bus and reload it on next use.
+"""
+from collections import Counter
+import re
+import threading
+
+from forum_app.bus import LocalCache
+
+MAX_POSTING = 1000
+MIN_SIMILARITY = 0.4
+
+_separators = re.compile(r'[\W_]+', re.UNICODE)
+
+
+def trigrams(title):
+    """ Set of the character trigrams of 'title', normalized.
+    """
+    text = ' {} '.format(_separators.sub(' ', title.lower()).strip())
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class CategoryIndex(object):
+    """ Trigram index of the thread titles of one category.
+    """
+    def __init__(self):
+        self.postings = {}
+        self.sizes = {}
+        self.titles = {}
+
+    def add(self, thread_id, name, slug):
+        if thread_id in self.titles:
+            self.remove(thread_id)
+        grams = trigrams(name)
+        for gram in grams:
+            self.postings.setdefault(gram, []).append(thread_id)
+        self.sizes[thread_id] = len(grams)
+        self.titles[thread_id] = (name, slug)
+
+    def remove(self, thread_id):
+        if thread_id not in self.titles:
+            return
+        name, slug = self.titles.pop(thread_id)
+        del self.sizes[thread_id]
+        for gram in trigrams(name):
+            ids = self.postings[gram]
+            ids.remove(thread_id)
+            if not ids:
+                del self.postings[gram]
+
+    def search(self, title, n=5, exclude=None):
+        """ Up to 'n' (score, thread id, name, slug), most similar first.
+        """
+        grams = trigrams(title)
+        if not grams:
+            return []
+        hits = Counter()
+        for gram in grams:
+            ids = self.postings.get(gram)
+            if ids is not None and len(ids) <= MAX_POSTING:
+                hits.update(ids)
+        # shared >= MIN_SIMILARITY * len(grams) / 2 is necessary for a Dice
+        # score of at least MIN_SIMILARITY, so most candidates stop here
+        needed = MIN_SIMILARITY * len(grams) / 2
+        results = []
+        for thread_id, shared in hits.items():
+            if shared < needed or thread_id == exclude:
+                continue
+            score = 2.0 * shared / (len(grams) + self.sizes[thread_id])
+            if score >= MIN_SIMILARITY:
+                name, slug = self.titles[thread_id]
+                results.append((score, thread_id, name, slug))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return results[:n]
+
+
+class TitleIndex(LocalCache):
+    """ CategoryIndex per category id, loaded by 'loader' (category id ->
+    iterable of (thread id, name, slug)) on first use.
+    """
+    def __init__(self, loader, channel=None):
+        self.loader = loader
+        self.channel = channel
+        self.indexes = {}
+        # also held while searching: patches mutate the posting lists
+        self.lock = threading.Lock()
+
+    def build(self, rows):
+        index = CategoryIndex()
+        for thread_id, name, slug in rows:
+            index.add(thread_id, name, slug)
+        return index
+
+    def get(self, category_id):
+        with self.lock:
+            index = self.indexes.get(category_id)
+        if index is None:
+            self.watch()
+            self.watch(category_id)
+            index = self.build(self.loader(category_id))
+            with self.lock:
+                index = self.indexes.setdefault(category_id, index)
+        return index
+
+    def search(self, category_id, title, n=5, exclude=None):
+        index = self.get(category_id)
+        with self.lock:
+            return index.search(title, n, exclude)
+
+    def thread_saved(self, thread_id, category_id, name, slug):
+        """ Patch loaded indexes after a thread was created, renamed or
+        moved. Categories that were never loaded are left alone. Other
+        workers drop the category's index; for a move the caller also has
+        to publish() the whole channel, since the old category isn't known.
+        """
+        self.publish(category_id)
+        with self.lock:
+            for key, index in self.indexes.items():
+                if key != category_id:
+                    index.remove(thread_id)
+            if category_id in self.indexes:
+                self.indexes[category_id].add(thread_id, name, slug)
+
+    def thread_deleted(self, thread_id, category_id):
+        self.publish(category_id)
+        with self.lock:
+            if category_id in self.indexes:
+                self.indexes[category_id].remove(thread_id)
+
+    def load_all(self, rows):
+        """ Replace every index from 'rows' of (category id, thread id,
+        name, slug), e.g. one pass over the thread table at worker start.
+        """
+        self.watch()
+        indexes = {}
+        for category_id, thread_id, name, slug in rows:
+            if category_id not in indexes:
+                self.watch(category_id)
+                indexes[category_id] = CategoryIndex()
+            indexes[category_id].add(thread_id, name, slug)
+        with self.lock:
+            self.indexes = indexes
+
+    def clear(self):
+        with self.lock:
+            self.indexes.clear()
+
+    def invalidate(self, category_id=None):
+        if category_id is None:
+            self.clear()
+        else:
+            with self.lock:
+                self.indexes.pop(category_id, None)
+
+
+def load_titles(category_id):
+    from forum_app.models import Thread
+    return (Thread.objects.filter(category_id=category_id)
+            .values_list('id', 'name', 'slug').iterator())
+
+
+titles = TitleIndex(load_titles, channel='similar')
+
+
+def similar_threads(category_id, title, n=5, exclude=None):
+    """ Threads in 'category_id' whose titles look like 'title', as a list
+    of (score, thread id, name, slug), best first.
+    """
+    return titles.search(category_id, title, n, exclude)
+
+
+def load_all():
+    """ Build the index of every category in one query.
+    """
+    from forum_app.models import Thread
+    titles.load_all(Thread.objects.order_by().values_list(
+        'category_id', 'id', 'name', 'slug').iterator())
+    return
@@ -0,0 +1,249 @@
+""" Sitemap for crawlers, rebuilt incrementally as static gzip files.
+
+Without one, crawlers find threads by walking every ?page=N of the category
+and thread lists, which are the deep-OFFSET pages that cost the most. The
+sitemap lists each category and each thread instead, with the date of the
+newest post as lastmod. A thread's URL without ?page shows its last page,
+the one that changes; threads longer than one page also get ?page=1, so the
+opening post is listed without walking down to it.
+
+Files, written to SITEMAP_ROOT and served from the site root:
+
+    sitemap.xml (+ .gz)           index of the files below
+    sitemap-categories.xml.gz     every category
+    sitemap-threads-NNNNN.xml.gz  threads with ids in
+                                  [NNNNN * SHARD_SIZE, (NNNNN + 1) * SHARD_SIZE)
+
+Shards are fixed id ranges, so a thread always stays in the same file. A
+run only rewrites the shards with a thread touched since the last run (a
+new post, a move, or a slug edited in the admin; the site's forms never
+change slugs) and those whose thread count changed (deletions); it finds them with GROUP BY queries that return one
+row per shard. Bulk moderation other than moves recomputes lastmods
+without touching the threads, so run with --full after it. The start time
+of the run and each shard's thread count and lastmod are kept in
+manifest.json next to the files, so a wiped directory is simply rebuilt in
+full.
+
+A shard is streamed from a server-side cursor straight into a gzip file,
+then renamed over the old one, so memory use doesn't depend on the number
+of threads and the web server never sees a half-written file.
+"""
+import gzip
+import json
+import os
+import time
+from xml.sax.saxutils import escape
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db.models import Count, ExpressionWrapper, F, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from forum_app.models import Category, Thread
+from forum_app.paginators import POSTS_PER_PAGE
+
+SITEMAP_ROOT = getattr(settings, 'SITEMAP_ROOT',
+                       os.path.join(settings.BASE_DIR, 'sitemaps'))
+SITEMAP_BASE_URL = getattr(settings, 'SITEMAP_BASE_URL', '')
+# threads per shard; two URLs each stays under the protocol's 50,000 limit
+SHARD_SIZE = 20000
+
+INDEX = 'sitemap.xml'
+CATEGORIES = 'sitemap-categories.xml.gz'
+MANIFEST = 'manifest.json'
+
+URLSET = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+SITEMAPINDEX = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<sitemapindex '
+                'xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n')
+
+
+def shard_name(shard):
+    return 'sitemap-threads-{:05d}.xml.gz'.format(shard)
+
+
+def shard_counts(threads, shard_size):
+    """ {shard: number of threads} for the 'threads' queryset, in one
+    GROUP BY query.
+    """
+    shard = ExpressionWrapper(F('id') / shard_size,
+                              output_field=IntegerField())
+    rows = (threads.annotate(shard=shard)
+            .values_list('shard')
+            .annotate(n=Count('id'))
+            .order_by())
+    return dict(rows)
+
+
+def url_entry(base_url, path, lastmod=None):
+    entry = '<url><loc>{}</loc>'.format(escape(base_url + path))
+    if lastmod is not None:
+        entry += '<lastmod>{}</lastmod>'.format(lastmod.isoformat())
+    return entry + '</url>\n'
+
+
+def category_entries(base_url):
+    for slug, lastmod in (Category.objects.order_by('id')
+                          .values_list('slug', 'most_recent_post')
+                          .iterator()):
+        yield lastmod, url_entry(base_url, reverse('threads', args=[slug]),
+                                 lastmod)
+
+
+def thread_entries(base_url, shard, shard_size):
+    rows = (Thread.objects
+            .filter(id__gte=shard * shard_size,
+                    id__lt=(shard + 1) * shard_size)
+            .order_by('id')
+            .annotate(lastmod=Coalesce('most_recent_post', 'created_date'))
+            .values_list('slug', 'category__slug', 'lastmod', 'num_posts'))
+    for slug, category_slug, lastmod, num_posts in rows.iterator():
+        path = reverse('thread', args=[category_slug, slug])
+        yield lastmod, url_entry(base_url, path, lastmod)
+        if num_posts > POSTS_PER_PAGE:
+            yield None, url_entry(base_url, path + '?page=1')
+
+
+def write_gzip(path, chunks):
+    """ Stream text 'chunks' into a gzip file at 'path', atomically.
+    """
+    partial = path + '.partial'
+    with gzip.GzipFile(partial, 'wb', mtime=0) as out:
+        for chunk in chunks:
+            out.write(chunk.encode('utf-8'))
+    os.replace(partial, path)
+    return
+
+
+def write_urlset(path, entries):
+    """ Write the (lastmod, <url> element) 'entries' as a gzipped urlset;
+    returns (number of URLs, newest lastmod or None).
+    """
+    stats = {'urls': 0, 'lastmod': None}
+
+    def chunks():
+        yield URLSET
+        for lastmod, entry in entries:
+            stats['urls'] += 1
+            if lastmod is not None and (stats['lastmod'] is None or
+                                        lastmod > stats['lastmod']):
+                stats['lastmod'] = lastmod
+            yield entry
+        yield '</urlset>\n'
+
+    write_gzip(path, chunks())
+    return stats['urls'], stats['lastmod']
+
+
+def write_index(root, base_url, manifest):
+    lines = [SITEMAPINDEX]
+    for name in sorted(manifest['files']):
+        lastmod = manifest['files'][name]['lastmod']
+        lines.append('<sitemap><loc>{}</loc>{}</sitemap>\n'.format(
+            escape(base_url + '/' + name),
+            '<lastmod>{}</lastmod>'.format(lastmod) if lastmod else ''))
+    lines.append('</sitemapindex>\n')
+    text = ''.join(lines)
+    path = os.path.join(root, INDEX)
+    with open(path + '.partial', 'w', encoding='utf-8') as out:
+        out.write(text)
+    os.replace(path + '.partial', path)
+    write_gzip(path + '.gz', [text])
+    return
+
+
+def load_manifest(root, shard_size):
+    """ The manifest of the last run, or None if there is none or it was
+    built with another shard size.
+    """
+    try:
+        with open(os.path.join(root, MANIFEST), encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if manifest.get('shard_size') != shard_size:
+        return None
+    return manifest
+
+
+def dirty_shards(manifest, counts, shard_size):
+    """ Shards to rewrite since the run 'manifest' describes, given the
+    current thread 'counts' per shard.
+    """
+    since = parse_datetime(manifest['started'])
+    dirty = set(shard_counts(Thread.objects.filter(touched__gte=since),
+                             shard_size))
+    for shard in set(counts) | set(int(key) for key in manifest['shards']):
+        if manifest['shards'].get(str(shard)) != counts.get(shard):
+            dirty.add(shard)
+    return dirty
+
+
+def build(root=None, base_url=None, shard_size=SHARD_SIZE, full=False,
+          pause=0, log=None):
+    """ Bring the sitemap in 'root' up to date. Returns the names of the
+    files written (the index excluded).
+    """
+    root = root or SITEMAP_ROOT
+    base_url = (base_url if base_url is not None
+                else SITEMAP_BASE_URL).rstrip('/')
+    if not os.path.isdir(root):
+        os.makedirs(root)
+    # taken first, so a change made while this run reads is seen by the next
+    started = timezone.now()
+    previous = load_manifest(root, shard_size)
+    manifest = previous or {'files': {}, 'shards': {}}
+    counts = shard_counts(Thread.objects.all(), shard_size)
+    written = []
+
+    if full or previous is None:
+        dirty = set(counts) | set(int(key) for key in manifest['shards'])
+        stale_categories = True
+    else:
+        dirty = dirty_shards(manifest, counts, shard_size)
+        since = parse_datetime(manifest['started'])
+        stale_categories = (
+            Category.objects.filter(touched__gte=since).exists() or
+            Category.objects.count() != manifest.get('categories'))
+
+    if stale_categories:
+        urls, lastmod = write_urlset(os.path.join(root, CATEGORIES),
+                                     category_entries(base_url))
+        manifest['categories'] = urls
+        manifest['files'][CATEGORIES] = {
+            'lastmod': lastmod.isoformat() if lastmod else None}
+        written.append(CATEGORIES)
+
+    for shard in sorted(dirty):
+        name = shard_name(shard)
+        if not counts.get(shard):
+            # every thread of the shard is gone
+            manifest['shards'].pop(str(shard), None)
+            manifest['files'].pop(name, None)
+            if os.path.exists(os.path.join(root, name)):
+                os.remove(os.path.join(root, name))
+            continue
+        urls, lastmod = write_urlset(
+            os.path.join(root, name),
+            thread_entries(base_url, shard, shard_size))
+        manifest['shards'][str(shard)] = counts[shard]
+        manifest['files'][name] = {
+            'lastmod': lastmod.isoformat() if lastmod else None}
+        written.append(name)
+        if log is not None:
+            log('  {}: {} urls'.format(name, urls))
+        if pause:
+            time.sleep(pause)
+
+    manifest['started'] = started.isoformat()
+    manifest['shard_size'] = shard_size
+    write_index(root, base_url, manifest)
+    with open(os.path.join(root, MANIFEST + '.partial'), 'w',
+              encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(os.path.join(root, MANIFEST + '.partial'),
+               os.path.join(root, MANIFEST))
+    return written
@@ -0,0 +1,124 @@
+""" URL slug resolution for categories and threads.
+
+topic/<category_slug>/<thread_slug>/ is resolved with one query joining
+Thread to Category on both slugs, so a thread under the wrong category is a
+404 instead of rendering anyway.
+
+Each worker also remembers which primary keys a slug pair resolved to, in a
+bounded LRU cache. A hit loads the row by primary key instead, the one query
+the page needs for the thread itself, so routing costs nothing extra. The
+loaded row is checked against the URL, so a stale entry (a rename or delete
+in another worker) only costs falling back to the slug query. Renames and
+deletes in this worker drop entries through the model signals; the other
+workers clear their caches through the invalidation bus.
+"""
+from collections import OrderedDict
+import threading
+
+from django.http import Http404
+
+from forum_app.bus import LocalCache
+
+SLUG_CACHE_SIZE = 10000
+
+
+class SlugCache(LocalCache):
+    """ Least recently used mapping of slug keys to primary keys, holding at
+    most 'size' entries.
+    """
+    def __init__(self, size=SLUG_CACHE_SIZE, channel=None):
+        self.size = size
+        self.channel = channel
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        self.watch()
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def discard_where(self, test):
+        """ Drop every entry whose value passes 'test'.
+        """
+        with self.lock:
+            for key, value in list(self.entries.items()):
+                if test(value):
+                    del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def invalidate(self, key=None):
+        self.clear()
+
+
+# ('thread', category slug, thread slug) -> (category id, thread id)
+# ('category', category slug) -> (category id, None)
+cache = SlugCache(channel='slugs')
+
+
+def get_category_or_404(category_slug):
+    from forum_app.models import Category
+    key = ('category', category_slug)
+    cached = cache.get(key)
+    if cached is not None:
+        category = Category.objects.filter(pk=cached[0]).first()
+        if category is not None and category.slug == category_slug:
+            return category
+        cache.discard(key)
+    category = Category.objects.filter(slug=category_slug).first()
+    if category is None:
+        raise Http404('No Category matches the given query.')
+    cache.set(key, (category.pk, None))
+    return category
+
+
+def get_thread_or_404(category_slug, thread_slug):
+    """ The Thread at topic/<category_slug>/<thread_slug>/, with its
+    category selected, in one query.
+    """
+    from forum_app.models import Thread
+    threads = Thread.objects.select_related('category')
+    key = ('thread', category_slug, thread_slug)
+    cached = cache.get(key)
+    if cached is not None:
+        thread = threads.filter(pk=cached[1]).first()
+        if (thread is not None and thread.slug == thread_slug and
+                thread.category.slug == category_slug):
+            return thread
+        cache.discard(key)
+    thread = threads.filter(slug=thread_slug,
+                            category__slug=category_slug).first()
+    if thread is None:
+        raise Http404('No Thread matches the given query.')
+    cache.set(key, (thread.category_id, thread.pk))
+    return thread
+
+
+def forget_category(category_id):
+    """ Drop the category's entries, and those of every thread in it.
+    """
+    cache.discard_where(lambda value: value[0] == category_id)
+    cache.publish()
+    return
+
+
+def forget_thread(thread_id):
+    cache.discard_where(lambda value: value[1] == thread_id)
+    cache.publish()
+    return
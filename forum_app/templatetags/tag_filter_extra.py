@@ -2,6 +2,8 @@ from django import template
 
 from datetime import datetime
 
+from forum_app import leaderboard
+
 register = template.Library()
 
 @register.filter(expects_localtime=True)
@@ -58,4 +60,15 @@ def category_tiles(context):
 
 @register.inclusion_tag('forum/thread_table_rows.html', takes_context=True)
 def thread_table_rows(context):
-    return context
\ No newline at end of file
+    return context
+
+@register.inclusion_tag('forum/profile_rows.html', takes_context=True)
+def profile_rows(context):
+    return context
+
+@register.inclusion_tag('forum/top_users.html')
+def top_users(n=5):
+    """ Small site-wide leaderboard for base.html. Reads the in-process
+    board, so it adds no queries once the board is warm.
+    """
+    return {'entries': leaderboard.top(n=n)}
@@ -1,9 +1,36 @@
-from django.test import TestCase
+from django.test import TestCase, RequestFactory
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test.utils import CaptureQueriesContext
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.core.cache import cache, caches
+from django.utils import timezone
+from django.http import Http404, HttpResponse
+from django.core.files.base import ContentFile
 
-from forum_app.models import Category, Thread, Post, Profile
+from forum_app.models import Category, Thread, Post, Profile, User, UserStats
+from forum_app.models import CategoryRank, ThreadRead, ArchivedPost
+from forum_app.models import PostRevision, Conversation, Pm, DailyActivity
+from forum_app import leaderboard, fragments, readmarkers, similar, slugs
+from forum_app import archive, counters, moderation, warmup, revisions
+from forum_app import inbox, trending, rollups, bus, sitemap, media
+from forum_app import viewcounts, ratelimit, loadtest
 
-from datetime import datetime
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from io import StringIO
+import gzip
+import json
+import math
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
 
 
 class CategoryMethodtests(TestCase):
@@ -62,4 +89,1662 @@ class HomeViewTests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(len(response.context['categories']), 1)
         self.assertContains(response, "test cat")
-        
\ No newline at end of file
+
+
+def make_thread(user, category_name='test cat', thread_name='test thread'):
+    """ Helper to create a Category and a Thread with its initial Post through
+    the same write paths the views use.
+    """
+    category, created = Category.objects.get_or_create(
+        name=category_name, slug=category_name.replace(' ', '-'))
+    thread = Thread(name=thread_name, category=category, author=user)
+    thread.new()
+    post = Post(text='initial post', thread=thread, author=user)
+    post.new()
+    return thread
+
+
+@contextmanager
+def sqlite_variable_limit(limit=999):
+    """ Make every statement fail the way SQLite builds with the default
+    SQLITE_MAX_VARIABLE_NUMBER do when it binds more than 'limit' values.
+    """
+    from django.db import OperationalError
+    from django.db.backends.sqlite3.base import SQLiteCursorWrapper
+    from unittest import mock
+    execute = SQLiteCursorWrapper.execute
+
+    def checked(self, query, params=None):
+        if params is not None and len(params) > limit:
+            raise OperationalError('too many SQL variables')
+        return execute(self, query, params)
+    with mock.patch.object(SQLiteCursorWrapper, 'execute', checked):
+        yield
+
+
+class UserStatsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.other = User.objects.create_user('liker', password='pass12345')
+
+    def test_stats_follow_write_paths(self):
+        """
+        Thread.new(), Post.new() and Post.like() keep UserStats up to date.
+        """
+        thread = make_thread(self.user)
+        post = Post(text='reply', thread=thread, author=self.user)
+        post.new()
+        post.like(self.other)
+        stats = UserStats.objects.get(user=self.user)
+        self.assertEqual(stats.num_threads, 1)
+        self.assertEqual(stats.num_posts, 2)
+        self.assertEqual(stats.likes_received, 1)
+
+    def test_profile_query_count_is_constant(self):
+        """
+        The profile page costs the same number of queries for a user with a
+        couple of posts as for one with several pages of them.
+        """
+        self.client.login(username='liker', password='pass12345')
+        thread = make_thread(self.user)
+        url = reverse('profile', args=['poster'])
+        self.client.get(url) # warm in-process caches
+        with CaptureQueriesContext(connection) as few:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for i in range(60):
+            Post(text='post {}'.format(i), thread=thread, author=self.user).new()
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url)
+        self.assertEqual(len(few), len(many))
+        self.assertEqual(response.context['paginator'].num_pages, 4)
+        self.assertContains(response, 'post 59')
+
+
+
+class UserDirectoryTests(TestCase):
+    def setUp(self):
+        for i in range(7):
+            user = User.objects.create_user('user{}'.format(i), password='pass12345')
+            Profile.objects.filter(user=user).update(rank=i % 3)
+        self.client.login(username='user0', password='pass12345')
+
+    def test_cursor_pages_cover_every_user_once(self):
+        """
+        Following next_cursor visits every profile exactly once, ordered by
+        rank.
+        """
+        from forum_app import views
+        seen = []
+        cursor = None
+        while True:
+            rows, cursor = views.cursor_page(views.user_directory(),
+                                             views.PROFILE_SORTS['rank'],
+                                             cursor, 3)
+            seen.extend(rows)
+            if cursor is None:
+                break
+        self.assertEqual(len(set(p.pk for p in seen)), 7)
+        ranks = [p.rank for p in seen]
+        self.assertEqual(ranks, sorted(ranks, reverse=True))
+
+    def test_directory_is_one_query_per_page(self):
+        """
+        Usernames come from the join, not from a query per row.
+        """
+        url = reverse('profile_list')
+        self.client.get(url) # warm in-process caches
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(url)
+        for i in range(7, 60):
+            User.objects.create_user('user{}'.format(i), password='pass12345')
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(url, {'sort': 'joined'})
+        self.assertEqual(len(few), len(many))
+        self.assertIsNotNone(response.context['next_cursor'])
+
+    def test_search_bar_username_prefix(self):
+        """
+        The search bar's 'user' type matches on username prefix.
+        """
+        User.objects.create_user('someone', password='pass12345')
+        response = self.client.post(reverse('search'),
+                                    {'search_type': 'user', 'search_text': 'user'})
+        self.assertContains(response, 'user6')
+        self.assertNotContains(response, 'someone')
+
+
+class LeaderboardTests(TestCase):
+    def setUp(self):
+        leaderboard.boards.clear()
+        self.alice = User.objects.create_user('alice', password='pass12345')
+        self.bob = User.objects.create_user('bob', password='pass12345')
+
+    def test_board_follows_rank_changes(self):
+        """
+        A loaded board is patched in place by the write paths, both site-wide
+        and per category, and agrees with the database.
+        """
+        thread = make_thread(self.alice)
+        self.assertEqual(leaderboard.top()[0].username, 'alice')
+        self.assertEqual(leaderboard.top(thread.category_id)[0].rank, 6)
+        for i in range(8):
+            Post(text='reply', thread=thread, author=self.bob).new()
+        top = leaderboard.top()
+        self.assertEqual([e.username for e in top[:2]], ['bob', 'alice'])
+        self.assertEqual(top[0].rank, 8)
+        rank = CategoryRank.objects.get(user=self.bob,
+                                        category_id=thread.category_id).rank
+        self.assertEqual(leaderboard.top(thread.category_id)[0].rank, rank)
+
+    def test_dropping_off_a_full_board_reloads_it(self):
+        """
+        When a listed user falls below the last entry of a full board, the
+        board is reloaded rather than left missing a row.
+        """
+        board = leaderboard.TopK(lambda key, size: [], size=2)
+        board.boards[None] = []
+        board.offer(None, leaderboard.Entry(5, 1, 1, 'a'))
+        board.offer(None, leaderboard.Entry(3, 2, 2, 'b'))
+        board.offer(None, leaderboard.Entry(1, 1, 1, 'a'))
+        self.assertNotIn(None, board.boards)
+
+    def test_only_changes_that_show_are_published(self):
+        """
+        Entering or leaving the board is published at once, new ranks of
+        listed users at most once per interval, and changes below a full
+        board not at all.
+        """
+        board = leaderboard.TopK(lambda key, size: [], size=2,
+                                 publish_interval=30)
+        published = []
+        board.publish = published.append
+        board.boards[None] = [leaderboard.Entry(5, 1, 1, 'a')]
+        board.offer(None, leaderboard.Entry(3, 2, 2, 'b'), now=100)
+        self.assertEqual(published, [None])
+        board.offer(None, leaderboard.Entry(1, 3, 3, 'c'), now=101)
+        board.offer(None, leaderboard.Entry(6, 1, 1, 'a'), now=102)
+        self.assertEqual(published, [None])
+        board.publish_pending(now=131)
+        self.assertEqual(published, [None, None])
+        board.offer(7, leaderboard.Entry(1, 4, 1, 'a'), now=140)
+        board.offer(7, leaderboard.Entry(2, 4, 1, 'a'), now=141)
+        self.assertEqual(published, [None, None, 7])
+
+    def test_footer_board_costs_no_queries_when_warm(self):
+        """
+        Once the board is loaded, rendering it in base.html adds no queries.
+        """
+        make_thread(self.alice)
+        self.client.get(reverse('categories'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('about'))
+        self.assertEqual(len(queries), 0)
+        self.assertContains(response, 'alice')
+        response = self.client.get(reverse('leaderboard'))
+        self.assertContains(response, 'alice')
+
+
+class ImportForumTests(TestCase):
+    def write_dump(self, records):
+        handle, path = tempfile.mkstemp(suffix='.jsonl')
+        with os.fdopen(handle, 'w') as dump:
+            for record in records:
+                dump.write(json.dumps(record) + '\n')
+        self.addCleanup(os.remove, path)
+        return path
+
+    def dump_records(self):
+        records = [
+            {'type': 'user', 'id': 10, 'username': 'olduser'},
+            {'type': 'user', 'id': 11, 'username': 'otheruser'},
+            {'type': 'category', 'id': 3, 'name': 'Old Stuff'},
+            {'type': 'thread', 'id': 7, 'category': 3, 'author': 10,
+             'name': 'Legacy thread', 'created_date': '2015-01-01T10:00:00'},
+        ]
+        for i in range(5):
+            records.append({'type': 'post', 'id': 100 + i, 'thread': 7,
+                            'author': 11 if i % 2 else 10,
+                            'text': '**post {}**'.format(i), 'likes': 1,
+                            'created_date': '2015-01-0{}T10:00:00'.format(i + 1)})
+        records.append({'type': 'like', 'post': 100, 'user': 11})
+        return records
+
+    def test_import_recomputes_counters(self):
+        """
+        Imported rows keep their ids, text is rendered, and the counters are
+        recomputed at the end.
+        """
+        path = self.write_dump(self.dump_records())
+        call_command('import_forum', path, batch_size=3, workers=1,
+                     stdout=open(os.devnull, 'w'))
+        thread = Thread.objects.get(pk=7)
+        self.assertEqual(thread.slug, 'legacy-thread')
+        self.assertEqual(thread.num_posts, 5)
+        self.assertEqual(thread.most_recent_post.day, 5)
+        category = Category.objects.get(pk=3)
+        self.assertEqual((category.num_threads, category.num_posts), (1, 5))
+        self.assertIn('<strong>post 0</strong>', Post.objects.get(pk=100).text)
+        olduser = User.objects.get(pk=10)
+        # one thread, three posts with one like each
+        self.assertEqual(olduser.profile.rank, 5 + 3 + 3)
+        self.assertEqual(olduser.stats.num_posts, 3)
+        self.assertEqual(CategoryRank.objects.get(user_id=11).rank, 4)
+
+    def test_import_resumes_after_last_batch(self):
+        """
+        Running the same dump twice doesn't insert anything twice, and a dump
+        that grew is picked up where the previous run stopped.
+        """
+        records = self.dump_records()
+        path = self.write_dump(records[:6])
+        out = open(os.devnull, 'w')
+        call_command('import_forum', path, batch_size=4, no_render=True,
+                     stdout=out)
+        call_command('import_forum', path, batch_size=4, no_render=True,
+                     stdout=out)
+        with open(path, 'a') as dump:
+            for record in records[6:]:
+                dump.write(json.dumps(record) + '\n')
+        call_command('import_forum', path, batch_size=4, no_render=True,
+                     stdout=out)
+        self.assertEqual(Post.objects.count(), 5)
+        self.assertEqual(Thread.objects.get(pk=7).num_posts, 5)
+
+
+
+class ReconcileCountersTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.thread = make_thread(self.user)
+        self.out = open(os.devnull, 'w')
+        self.addCleanup(self.out.close)
+
+    def test_stale_instances_dont_lose_posts(self):
+        """
+        Two requests holding their own copy of the Thread both get counted.
+        """
+        first = Thread.objects.get(pk=self.thread.pk)
+        second = Thread.objects.get(pk=self.thread.pk)
+        Post(text='one', thread=first, author=self.user).new()
+        Post(text='two', thread=second, author=self.user).new()
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).num_posts, 3)
+        self.assertEqual(Category.objects.get().num_posts, 3)
+
+    def test_dry_run_reports_without_writing(self):
+        """
+        --dry-run lists the drift left behind by a delete but changes nothing.
+        """
+        Post(text='reply', thread=self.thread, author=self.user).new()
+        Post.objects.filter(text='reply').delete()
+        out = StringIO()
+        call_command('reconcile_counters', dry_run=True, stdout=out)
+        self.assertIn('num_posts: 2 should be 1', out.getvalue())
+        self.assertEqual(Thread.objects.get().num_posts, 2)
+
+    def test_conversations_are_reconciled_in_batches(self):
+        """
+        A full run reports and then fixes most_recent_pm drift, a batch of
+        conversations at a time.
+        """
+        other = User.objects.create_user('other', password='pass12345')
+        for owner, partner in [(self.user, other), (other, self.user)]:
+            Conversation.objects.create(belongs_to=owner, is_with=partner,
+                                        most_recent_pm=timezone.now())
+        out = StringIO()
+        call_command('reconcile_counters', dry_run=True, stdout=out)
+        self.assertIn('conversations: 2 checked, 2 values off',
+                      out.getvalue())
+        out = StringIO()
+        call_command('reconcile_counters', batch_size=1, stdout=out)
+        self.assertIn('conversations: 2 recomputed', out.getvalue())
+        self.assertFalse(Conversation.objects.filter(
+            most_recent_pm__isnull=False).exists())
+
+    def test_default_batches_fit_sqlite(self):
+        """
+        A full run with more users than one default batch binds no more
+        variables per statement than SQLite allows.
+        """
+        users = User.objects.bulk_create([
+            User(username='bulk{}'.format(i)) for i in range(600)])
+        users = User.objects.filter(username__startswith='bulk')
+        UserStats.objects.bulk_create([UserStats(user=u) for u in users])
+        Profile.objects.bulk_create([Profile(user=u) for u in users])
+        UserStats.objects.update(num_posts=7)
+        with sqlite_variable_limit():
+            call_command('reconcile_counters', stdout=self.out)
+        self.assertFalse(UserStats.objects.filter(num_posts=7).exists())
+
+    def test_incremental_only_revisits_touched_rows(self):
+        """
+        After a full run, an incremental run fixes rows touched by a delete
+        and leaves untouched rows alone.
+        """
+        call_command('reconcile_counters', stdout=self.out)
+        Post(text='reply', thread=self.thread, author=self.user).new()
+        Post.objects.filter(text='reply').delete()
+        # drift that no delete marked: incremental mode can't see it
+        Category.objects.update(num_threads=42)
+        call_command('reconcile_counters', incremental=True, stdout=self.out)
+        self.assertEqual(Thread.objects.get().num_posts, 1)
+        self.assertEqual(Category.objects.get().num_posts, 1)
+        self.assertEqual(UserStats.objects.get(user=self.user).num_posts, 1)
+        self.assertEqual(Profile.objects.get(user=self.user).rank, 6)
+        call_command('reconcile_counters', stdout=self.out)
+        self.assertEqual(Category.objects.get().num_threads, 1)
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.thread = make_thread(self.user)
+        Post(text='<p>second</p>', thread=self.thread, author=self.user).new()
+
+    def test_export_requires_staff(self):
+        self.client.login(username='poster', password='pass12345')
+        response = self.client.get(reverse('export_forum'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_jsonl_export_is_importable_format(self):
+        """
+        The JSONL export streams gzipped records, parents first.
+        """
+        self.user.is_staff = True
+        self.user.save()
+        self.client.login(username='poster', password='pass12345')
+        response = self.client.get(reverse('export_forum'),
+                                   {'category': 'test-cat'})
+        data = gzip.decompress(b''.join(response.streaming_content))
+        records = [json.loads(line) for line in data.decode().splitlines()]
+        self.assertEqual([r['type'] for r in records],
+                         ['category', 'user', 'thread', 'post', 'post'])
+        self.assertEqual(records[4]['text'], '<p>second</p>')
+
+    def test_jsonl_export_reimports_into_an_empty_database(self):
+        """
+        Users, threads, posts and likes come back with their ids.
+        """
+        liker = User.objects.create_user('liker', password='pass12345')
+        Post.objects.get(text='<p>second</p>').like(liker)
+
+        def snapshot():
+            return (list(User.objects.order_by('id')
+                         .values_list('id', 'username')),
+                    list(Thread.objects.order_by('id').values_list(
+                        'id', 'name', 'slug', 'author_id', 'num_posts')),
+                    list(Post.objects.order_by('id').values_list(
+                        'id', 'thread_id', 'author_id', 'text', 'likes')),
+                    list(Post.liked_by.through.objects.order_by('post_id')
+                         .values_list('post_id', 'user_id')))
+        before = snapshot()
+        handle, path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('export_forum', format='jsonl', output=path,
+                     stdout=open(os.devnull, 'w'))
+        dump = path[:-len('.gz')]
+        with gzip.open(path) as src, open(dump, 'wb') as out:
+            out.write(src.read())
+        self.addCleanup(os.remove, dump)
+        Category.objects.all().delete()
+        User.objects.all().delete()
+        call_command('import_forum', dump, no_render=True,
+                     stdout=open(os.devnull, 'w'))
+        self.assertEqual(snapshot(), before)
+
+    def test_html_export_writes_thread_pages(self):
+        """
+        The HTML export is a tar.gz with a page per thread.
+        """
+        handle, path = tempfile.mkstemp(suffix='.tar.gz')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        call_command('export_forum', format='html', output=path,
+                     stdout=open(os.devnull, 'w'))
+        with tarfile.open(path) as archive:
+            page = archive.extractfile('test-cat/test-thread.html').read()
+        self.assertIn(b'<p>second</p>', page)
+
+
+class DirtyFieldsTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.other = User.objects.create_user('other', password='pass12345')
+        self.thread = make_thread(self.user)
+
+    def run_session(self):
+        """ Log in and use the main write views. Returns the UPDATE
+        statements they ran, by table.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            self.client.login(username='poster', password='pass12345')
+            self.client.post(reverse('category_edit', args=['test-cat']),
+                             {'name': 'test cat'})
+            self.client.post(reverse('thread_edit',
+                                     args=['test-cat', 'test-thread']),
+                             {'name': 'renamed thread'})
+            self.client.post(reverse('thread', args=['test-cat', 'test-thread']),
+                             {'text': 'a reply'})
+            self.client.post(reverse('conversation', args=['poster', 'other']),
+                             {'text': 'hello'})
+        updates = {}
+        for query in queries.captured_queries:
+            if query['sql'].startswith('UPDATE'):
+                table = query['sql'].split('"')[1]
+                updates.setdefault(table, []).append(query['sql'])
+        return updates
+
+    def test_unchanged_saves_are_skipped(self):
+        """
+        Saving an instance with no changes runs no query; changing one field
+        writes only that column.
+        """
+        category = Category.objects.get()
+        with CaptureQueriesContext(connection) as queries:
+            category.save()
+        self.assertEqual(len(queries), 0)
+        category.name = 'other name'
+        with CaptureQueriesContext(connection) as queries:
+            category.save()
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('num_posts', queries[0]['sql'])
+
+    def test_main_views_run_fewer_updates(self):
+        """
+        The same session runs fewer UPDATEs than with full-row saves: login
+        no longer rewrites the Profile, an unchanged category_edit writes
+        nothing and thread_edit writes only the name.
+        """
+        from django.db import models
+        from forum_app.mixins import DirtyFieldsMixin
+        from unittest import mock
+        with mock.patch.object(DirtyFieldsMixin, 'save', models.Model.save):
+            full = self.run_session()
+        Thread.objects.filter(pk=self.thread.pk).update(name='test thread')
+        self.client.logout()
+        tracked = self.run_session()
+        full_count = sum(len(sql) for sql in full.values())
+        tracked_count = sum(len(sql) for sql in tracked.values())
+        self.assertLess(tracked_count, full_count)
+        for sql in tracked['forum_app_profile']:
+            self.assertNotIn('"picture"', sql)
+        self.assertEqual(len(tracked['forum_app_thread']), 2)
+        self.assertNotIn('"num_posts"', tracked['forum_app_thread'][0])
+        for sql in tracked['forum_app_conversation']:
+            assignments = sql.split(' SET ')[1].split(' WHERE ')[0]
+            self.assertEqual(re.findall(r'"(\w+)" =', assignments),
+                             ['most_recent_pm'], sql)
+
+
+class PostFragmentTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.viewer = User.objects.create_user('viewer', password='pass12345')
+        self.thread = make_thread(self.user)
+        self.url = reverse('thread', args=['test-cat', 'test-thread'])
+
+    def test_thread_page_queries_dont_grow_with_posts(self):
+        """
+        Authors, ranks and likes no longer cost a query per post.
+        """
+        self.client.login(username='viewer', password='pass12345')
+        self.client.get(self.url) # warm in-process caches
+        with CaptureQueriesContext(connection) as few:
+            self.client.get(self.url)
+        for i in range(20):
+            Post(text='post {}'.format(i), thread=self.thread,
+                 author=self.user).new()
+        with CaptureQueriesContext(connection) as many:
+            response = self.client.get(self.url)
+        self.assertEqual(len(few), len(many))
+        self.assertContains(response, 'post 19')
+        self.assertContains(response, 'class="thread-header"', count=1)
+
+    def test_viewer_parts_are_filled_per_request(self):
+        """
+        The cached fragment is shared, but like buttons and the PM link
+        depend on who is looking.
+        """
+        post = Post.objects.get()
+        self.client.login(username='viewer', password='pass12345')
+        response = self.client.get(self.url)
+        self.assertContains(response, '{}-like'.format(post.pk))
+        self.assertContains(response,
+                            reverse('conversation', args=['viewer', 'poster']))
+        post.liked_by.add(self.viewer)
+        response = self.client.get(self.url)
+        self.assertNotContains(response, '{}-like'.format(post.pk))
+        self.client.logout()
+        response = self.client.get(self.url)
+        self.assertNotContains(response, 'fa-envelope-o')
+
+    def test_like_changes_the_fragment_key(self):
+        """
+        A like renders a new fragment rather than serving the stale count.
+        """
+        self.client.get(self.url)
+        post = Post.objects.select_related('author__profile').get()
+        old_key = fragments.fragment_key(post)
+        post.like(self.viewer)
+        post = Post.objects.select_related('author__profile').get()
+        self.assertNotEqual(fragments.fragment_key(post), old_key)
+        response = self.client.get(self.url)
+        self.assertContains(response, '> 1</span>')
+
+
+class ReadMarkerTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.reader = User.objects.create_user('reader', password='pass12345')
+        self.thread = make_thread(self.user)
+        self.category = self.thread.category
+        self.list_url = reverse('threads', args=['test-cat'])
+        self.unread_url = reverse('thread_unread',
+                                  args=['test-cat', 'test-thread'])
+        self.client.login(username='reader', password='pass12345')
+
+    def test_reading_a_thread_clears_its_badge(self):
+        """
+        A new thread is unread until its page is viewed, and unread again
+        once someone replies.
+        """
+        self.assertContains(self.client.get(self.list_url), self.unread_url)
+        self.assertContains(self.client.get(reverse('categories')),
+                            'label-primary')
+        self.client.get(reverse('thread', args=['test-cat', 'test-thread']))
+        self.assertNotContains(self.client.get(self.list_url),
+                               self.unread_url)
+        Post(text='reply', thread=self.thread, author=self.user).new()
+        self.assertContains(self.client.get(self.list_url), self.unread_url)
+
+    def test_reading_every_thread_clears_the_category_badge(self):
+        """
+        The category tile is unread only while one of its threads is.
+        """
+        other = Thread(name='Other thread', category=self.category,
+                       author=self.user)
+        other.new()
+        Post(text='other', thread=other, author=self.user).new()
+        self.client.get(reverse('thread', args=['test-cat', 'test-thread']))
+        self.assertContains(self.client.get(reverse('categories')),
+                            'label-primary')
+        self.client.get(reverse('thread', args=['test-cat', other.slug]))
+        self.assertNotContains(self.client.get(reverse('categories')),
+                               'label-primary')
+        Post(text='reply', thread=other, author=self.user).new()
+        self.assertContains(self.client.get(reverse('categories')),
+                            'label-primary')
+
+    def test_mark_category_read(self):
+        """
+        Marking a category read clears every badge in it and drops the
+        per-thread markers it supersedes.
+        """
+        readmarkers.mark_thread_read(self.reader, self.thread, 0)
+        response = self.client.post(reverse('category_mark_read',
+                                            args=['test-cat']))
+        self.assertRedirects(response, self.list_url)
+        self.assertNotContains(self.client.get(self.list_url),
+                               self.unread_url)
+        self.assertNotContains(self.client.get(reverse('categories')),
+                               'label-primary')
+        self.assertFalse(ThreadRead.objects.exists())
+
+    def test_markers_only_move_forward(self):
+        post = Post.objects.get()
+        readmarkers.mark_thread_read(self.reader, self.thread, post.pk)
+        readmarkers.mark_thread_read(self.reader, self.thread, 0)
+        self.assertEqual(ThreadRead.objects.get().last_read_post_id, post.pk)
+
+    def test_jump_to_first_unread(self):
+        """
+        Redirects to the page holding the first unseen post, anchored on it.
+        """
+        posts = [Post(text='post {}'.format(i), thread=self.thread,
+                      author=self.user) for i in range(60)]
+        for post in posts:
+            post.new()
+        # read through the 55th post in the thread (initial post + 54)
+        readmarkers.mark_thread_read(self.reader, self.thread, posts[53].pk)
+        response = self.client.get(self.unread_url)
+        self.assertRedirects(response, '{}?page=2#post-{}'.format(
+            reverse('thread', args=['test-cat', 'test-thread']),
+            posts[54].pk))
+        readmarkers.mark_thread_read(self.reader, self.thread, posts[-1].pk)
+        response = self.client.get(self.unread_url)
+        self.assertRedirects(response, reverse(
+            'thread', args=['test-cat', 'test-thread']))
+
+
+class PermalinkTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.thread = make_thread(self.user)
+        self.thread_url = reverse('thread', args=['test-cat', 'test-thread'])
+
+    def test_permalink_redirects_to_the_posts_page(self):
+        posts = [Post(text='post {}'.format(i), thread=self.thread,
+                      author=self.user) for i in range(120)]
+        for post in posts:
+            post.new()
+        first = Post.objects.order_by('id')[0]
+        for post, page in ((first, 1), (posts[48], 1), (posts[49], 2),
+                           (posts[-1], 3)):
+            response = self.client.get(reverse('post_permalink',
+                                               args=[post.pk]))
+            self.assertRedirects(response, '{}?page={}#post-{}'.format(
+                self.thread_url, page, post.pk))
+
+    def test_position_breaks_ties_on_id(self):
+        """
+        Posts with the same timestamp keep the thread page's order.
+        """
+        first = Post.objects.get()
+        tied = Post(text='tied', thread=self.thread, author=self.user,
+                    created_date=first.created_date)
+        tied.new()
+        self.assertEqual(first.position(), 0)
+        self.assertEqual(tied.position(), 1)
+
+    def test_position_is_a_single_count(self):
+        post = Post.objects.get()
+        with CaptureQueriesContext(connection) as queries:
+            post.position()
+        self.assertEqual(len(queries), 1)
+        self.assertIn('COUNT', queries[0]['sql'])
+
+    def test_unknown_post_is_404(self):
+        response = self.client.get(reverse('post_permalink', args=[999]))
+        self.assertEqual(response.status_code, 404)
+
+
+class SimilarThreadsTests(TestCase):
+    def setUp(self):
+        similar.titles.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.thread = make_thread(self.user, thread_name='Best pizza in town?')
+        self.url = reverse('similar_threads', args=['test-cat'])
+
+    def suggestions(self, title, **params):
+        params['title'] = title
+        response = self.client.get(self.url, params)
+        threads = json.loads(response.content.decode())['threads']
+        return [thread['name'] for thread in threads]
+
+    def test_near_duplicates_are_suggested(self):
+        self.assertEqual(self.suggestions('best pizza in town'),
+                         ['Best pizza in town?'])
+        self.assertEqual(self.suggestions('Pizza: best in town'),
+                         ['Best pizza in town?'])
+        self.assertEqual(self.suggestions('Gardening tips'), [])
+        self.assertEqual(self.suggestions('best pizza in town',
+                                          exclude=self.thread.pk), [])
+
+    def test_index_follows_creates_renames_and_deletes(self):
+        self.suggestions('warm up') # load the category's index
+        other = make_thread(self.user, thread_name='Gardening tips')
+        self.assertEqual(self.suggestions('gardening tip'), ['Gardening tips'])
+        other.name = 'Growing tomatoes'
+        other.save()
+        self.assertEqual(self.suggestions('gardening tip'), [])
+        self.assertEqual(self.suggestions('growing tomato'),
+                         ['Growing tomatoes'])
+        other.delete()
+        self.assertEqual(self.suggestions('growing tomato'), [])
+
+    def test_load_all_builds_every_category_in_one_query(self):
+        make_thread(self.user, category_name='other cat',
+                    thread_name='Gardening tips')
+        with CaptureQueriesContext(connection) as queries:
+            similar.load_all()
+        self.assertEqual(len(queries), 1)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.suggestions('best pizza'),
+                             ['Best pizza in town?'])
+        self.assertEqual(len([q for q in queries
+                              if 'forum_app_thread' in q['sql']]), 0)
+
+
+class SlugRoutingTests(TestCase):
+    def setUp(self):
+        slugs.cache.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.thread = make_thread(self.user)
+        make_thread(self.user, category_name='other cat',
+                    thread_name='other thread')
+
+    def test_thread_must_belong_to_the_category(self):
+        url = reverse('thread', args=['other-cat', 'test-thread'])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        url = reverse('thread', args=['test-cat', 'test-thread'])
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_one_query_resolves_both_slugs(self):
+        with CaptureQueriesContext(connection) as queries:
+            thread = slugs.get_thread_or_404('test-cat', 'test-thread')
+            self.assertEqual(thread.category.slug, 'test-cat')
+        self.assertEqual(len(queries), 1)
+        # cached: the same single query, by primary key
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(
+                slugs.get_thread_or_404('test-cat', 'test-thread'), thread)
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('slug" =', queries[0]['sql'])
+
+    def test_stale_entries_fall_back_to_the_slug_query(self):
+        slugs.get_thread_or_404('test-cat', 'test-thread')
+        # a rename that sends no signals, e.g. from another worker
+        Thread.objects.filter(pk=self.thread.pk).update(slug='renamed')
+        with self.assertRaises(Http404):
+            slugs.get_thread_or_404('test-cat', 'test-thread')
+        self.assertEqual(slugs.get_thread_or_404('test-cat', 'renamed'),
+                         self.thread)
+
+    def test_saves_and_deletes_invalidate(self):
+        slugs.get_thread_or_404('test-cat', 'test-thread')
+        self.assertEqual(len(slugs.cache.entries), 1)
+        self.thread.name = 'renamed thread'
+        self.thread.save()
+        self.assertEqual(len(slugs.cache.entries), 0)
+        slugs.get_thread_or_404('test-cat', 'test-thread')
+        slugs.get_category_or_404('test-cat')
+        self.thread.category.delete()
+        self.assertEqual(len(slugs.cache.entries), 0)
+
+    def test_cache_is_bounded(self):
+        lru = slugs.SlugCache(size=2)
+        lru.set('a', (1, None))
+        lru.set('b', (2, None))
+        lru.get('a')
+        lru.set('c', (3, None))
+        self.assertEqual(list(lru.entries), ['a', 'c'])
+
+
+class ModerationTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.spammer = User.objects.create_user('spammer', password='x')
+        self.thread = make_thread(self.user)
+        self.spam_thread = make_thread(self.spammer, thread_name='buy now')
+        for i in range(3):
+            post = Post(text='spam {}'.format(i), thread=self.thread,
+                        author=self.spammer)
+            post.new()
+            post.like(self.user)
+        Post(text='reply', thread=self.spam_thread, author=self.user).new()
+
+    def assertNoDrift(self):
+        self.assertEqual(counters.thread_drift(), [])
+        self.assertEqual(counters.category_drift(), [])
+        self.assertEqual(counters.user_drift(), [])
+
+    def test_delete_posts_by_author(self):
+        out = StringIO()
+        call_command('moderate', 'delete-posts', '--author', 'spammer',
+                     '--batch-size', '2', stdout=out)
+        self.assertIn('Deleted 4 posts', out.getvalue())
+        self.assertFalse(Post.objects.filter(author=self.spammer).exists())
+        self.assertFalse(Post.liked_by.through.objects.exists())
+        # the reply keeps the spammer's thread alive
+        self.assertEqual(Thread.objects.count(), 2)
+        self.assertEqual(UserStats.objects.get(user=self.spammer).num_posts, 0)
+        self.assertNoDrift()
+
+    def test_delete_threads_removes_their_posts(self):
+        posts, threads = moderation.delete_threads(
+            moderation.select_threads(author=self.spammer), batch_size=1)
+        self.assertEqual((posts, threads), (2, 1))
+        self.assertEqual(list(Thread.objects.all()), [self.thread])
+        self.assertEqual(Category.objects.get().num_threads, 1)
+        self.assertNoDrift()
+
+    def test_moves_fix_counters(self):
+        target = Category.objects.create(name='other cat', slug='other-cat')
+        moderation.move_threads(Thread.objects.filter(pk=self.spam_thread.pk),
+                                target)
+        self.assertEqual(Category.objects.get(pk=target.pk).num_posts, 2)
+        self.assertNoDrift()
+        moderation.move_posts(moderation.select_posts(thread=self.spam_thread),
+                              self.thread)
+        self.assertFalse(Thread.objects.filter(pk=self.spam_thread.pk).exists())
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).num_posts, 6)
+        self.assertNoDrift()
+
+    def test_moving_posts_into_an_archived_thread_restores_it(self):
+        archive.archive_batch([self.thread.pk])
+        moderation.move_posts(moderation.select_posts(thread=self.spam_thread),
+                              Thread.objects.get(pk=self.thread.pk))
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertFalse(thread.archived)
+        self.assertFalse(ArchivedPost.objects.exists())
+        self.assertEqual(thread.num_posts, 6)
+        self.assertEqual(archive.thread_posts(thread).count(), 6)
+        self.assertNoDrift()
+
+    def test_command_needs_a_filter(self):
+        with self.assertRaises(CommandError):
+            call_command('moderate', 'delete-posts', stdout=StringIO())
+
+    def test_admin_bulk_delete_action(self):
+        User.objects.create_superuser('admin', 'a@example.com', 'pass12345')
+        self.client.login(username='admin', password='pass12345')
+        ids = list(Post.objects.filter(author=self.spammer)
+                   .values_list('id', flat=True))
+        response = self.client.post(reverse('admin:forum_app_post_changelist'),
+                                    {'action': 'bulk_delete_posts',
+                                     '_selected_action': ids})
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(Post.objects.filter(author=self.spammer).exists())
+        self.assertNoDrift()
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.reader = User.objects.create_user('reader', password='pass12345')
+        self.thread = make_thread(self.user)
+        reply = Post(text='old reply', thread=self.thread, author=self.reader)
+        reply.new()
+        reply.like(self.user)
+        make_thread(self.user, thread_name='fresh thread')
+        old = timezone.now() - timedelta(days=1000)
+        Post.objects.filter(thread=self.thread).update(created_date=old)
+        Thread.objects.filter(pk=self.thread.pk).update(most_recent_post=old)
+        self.url = reverse('thread', args=['test-cat', 'test-thread'])
+
+    def archive(self):
+        out = StringIO()
+        call_command('archive_threads', '--days', '365', stdout=out)
+        return out.getvalue()
+
+    def test_inactive_threads_move_out_of_the_post_table(self):
+        self.assertIn('Archived 1 threads', self.archive())
+        self.assertTrue(Thread.objects.get(pk=self.thread.pk).archived)
+        self.assertFalse(Post.objects.filter(thread=self.thread).exists())
+        self.assertEqual(ArchivedPost.objects.count(), 2)
+        # nothing left to do on a second run
+        self.assertIn('Archived 0 threads', self.archive())
+        # counters don't change, here or after a full recompute
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).num_posts, 2)
+        call_command('reconcile_counters', '--dry-run', stdout=StringIO())
+        self.assertEqual(counters.thread_drift(), [])
+        self.assertEqual(counters.user_drift(), [])
+
+    def test_archived_threads_render_read_only(self):
+        self.archive()
+        self.client.login(username='reader', password='pass12345')
+        response = self.client.get(self.url)
+        self.assertContains(response, 'old reply')
+        self.assertContains(response, 'has been archived')
+        self.assertNotContains(response, '-like">')
+        post = ArchivedPost.objects.get(text='old reply')
+        response = self.client.get(reverse('post_permalink', args=[post.pk]))
+        self.assertRedirects(response, '{}?page=1#post-{}'.format(
+            self.url, post.pk))
+
+    def test_reply_restores_the_thread(self):
+        self.archive()
+        self.client.login(username='reader', password='pass12345')
+        self.client.post(self.url, {'text': 'necro reply'})
+        thread = Thread.objects.get(pk=self.thread.pk)
+        self.assertFalse(thread.archived)
+        self.assertEqual(thread.num_posts, 3)
+        self.assertFalse(ArchivedPost.objects.exists())
+        liked = Post.objects.get(text='old reply')
+        self.assertEqual(list(liked.liked_by.all()), [self.user])
+        self.assertEqual(counters.thread_drift(), [])
+
+
+    def test_recompute_users_binds_each_id_once(self):
+        """
+        A batch of user ids up to SQLite's variable limit is recomputed,
+        archived posts included.
+        """
+        self.archive()
+        CategoryRank.objects.all().delete()
+        user_ids = [self.user.pk, self.reader.pk] + list(range(10000, 10997))
+        with sqlite_variable_limit():
+            counters.recompute_users(user_ids)
+        self.assertEqual(counters.user_drift(), [])
+        rank = CategoryRank.objects.get(user=self.reader)
+        self.assertEqual(rank.rank, 2)
+
+
+class PostEditTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.other = User.objects.create_user('other', password='pass12345')
+        self.thread = make_thread(self.user)
+        self.post = Post.objects.get(thread=self.thread)
+        self.edit_url = reverse('post_edit', args=[self.post.pk])
+        self.thread_url = reverse('thread', args=['test-cat', 'test-thread'])
+
+    def test_edit_keeps_place_and_counters(self):
+        reply = Post(text='reply', thread=self.thread, author=self.other)
+        reply.new()
+        self.client.login(username='poster', password='pass12345')
+        self.assertContains(self.client.get(self.thread_url), self.edit_url)
+        response = self.client.post(self.edit_url, {'text': 'fixed *typo*'})
+        self.assertRedirects(response, '{}?page=1#post-{}'.format(
+            self.thread_url, self.post.pk), fetch_redirect_response=False)
+        post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post.text, '<p>fixed <em>typo</em></p>')
+        self.assertEqual(post.edits, 1)
+        self.assertEqual(post.created_date, self.post.created_date)
+        self.assertEqual(post.position(), 0)
+        self.assertEqual(Thread.objects.get(pk=self.thread.pk).num_posts, 2)
+        # the cached fragment of the old text isn't served
+        response = self.client.get(self.thread_url)
+        self.assertContains(response, '<em>typo</em>')
+        self.assertContains(response, reverse('post_history',
+                                              args=[self.post.pk]))
+        self.assertEqual(counters.thread_drift(), [])
+
+    def test_only_author_or_staff_can_edit(self):
+        self.client.login(username='other', password='pass12345')
+        self.assertNotContains(self.client.get(self.thread_url),
+                               self.edit_url)
+        self.assertEqual(self.client.post(
+            self.edit_url, {'text': 'vandalism'}).status_code, 404)
+        self.assertEqual(Post.objects.get(pk=self.post.pk).edits, 0)
+
+    def test_every_revision_rebuilds(self):
+        texts = ['initial post']
+        for i in range(revisions.SNAPSHOT_EVERY + 3):
+            texts.append('<p>version {} of the post, with the same long '
+                         'tail of words each time</p>'.format(i))
+            self.post.edit(texts[-1], self.user)
+        rows = PostRevision.objects.filter(post_id=self.post.pk)
+        self.assertEqual(rows.count(), len(texts))
+        self.assertEqual(list(rows.filter(snapshot=True).order_by('number')
+                              .values_list('number', flat=True)),
+                         [0, revisions.SNAPSHOT_EVERY])
+        self.assertEqual([revision.text for revision in
+                          revisions.history(self.post.pk)], texts)
+        for number, text in enumerate(texts):
+            self.assertEqual(revisions.version(self.post.pk, number), text)
+        self.assertIsNone(revisions.version(self.post.pk, len(texts)))
+        stored, full = revisions.storage([self.post.pk])
+        self.assertLess(stored, full)
+        response = self.client.get(reverse('post_history',
+                                           args=[self.post.pk]))
+        self.assertContains(response, 'version 3 of the post')
+        self.assertContains(response, 'original')
+
+    def test_revisions_follow_the_post(self):
+        self.post.edit('<p>edited</p>', self.user)
+        self.thread.most_recent_post = timezone.now() - timedelta(days=800)
+        self.thread.save()
+        archive.archive_threads(Thread.objects.all())
+        archived = ArchivedPost.objects.get(pk=self.post.pk)
+        self.assertEqual(archived.edits, 1)
+        self.assertEqual(revisions.version(self.post.pk, 0), 'initial post')
+        archive.restore_thread(Thread.objects.get(pk=self.thread.pk))
+        moderation.delete_posts(Post.objects.all())
+        self.assertFalse(PostRevision.objects.exists())
+
+
+class InboxTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user('alice', password='pass12345')
+        self.bob = User.objects.create_user('bob', password='pass12345')
+        self.client.login(username='alice', password='pass12345')
+        self.url = reverse('conversation', args=['alice', 'bob'])
+        for i in range(3):
+            self.client.post(self.url, {'text': 'message {}'.format(i)})
+
+    def purge(self, *args):
+        out = StringIO()
+        call_command('purge_pms', '--batch-size', '2', *args, stdout=out)
+        return out.getvalue()
+
+    def test_delete_hides_until_a_new_message(self):
+        list_url = reverse('conversations', args=['alice'])
+        self.assertContains(self.client.get(list_url), '<td>3</td>')
+        response = self.client.get(reverse('delete_conversation',
+                                           args=['alice', 'bob']))
+        self.assertRedirects(response, list_url)
+        self.assertEqual(Pm.objects.count(), 6)
+        self.assertNotContains(self.client.get(list_url), self.url)
+        self.assertNotContains(self.client.get(self.url), 'message 0')
+        # bob still has his copy, and his reply brings it back for alice
+        self.client.login(username='bob', password='pass12345')
+        self.assertContains(self.client.get(
+            reverse('conversation', args=['bob', 'alice'])), 'message 0')
+        self.client.post(reverse('conversation', args=['bob', 'alice']),
+                         {'text': 'still there?'})
+        self.client.login(username='alice', password='pass12345')
+        self.assertContains(self.client.get(list_url), '<td>1</td>')
+        response = self.client.get(self.url)
+        self.assertContains(response, 'still there?')
+        self.assertNotContains(response, 'message 0')
+
+    def test_purge_deletes_cleared_messages(self):
+        conversation = Conversation.objects.get(belongs_to=self.alice)
+        inbox.hide(conversation)
+        self.assertIn('3 messages due', self.purge('--dry-run'))
+        self.assertIn('Deleted 3 messages', self.purge())
+        self.assertFalse(Pm.objects.filter(conversation=conversation)
+                         .exists())
+        self.assertFalse(Conversation.objects.filter(pk=conversation.pk)
+                         .exists())
+        self.assertEqual(Pm.objects.count(), 3)
+        self.assertIn('Deleted 0 messages', self.purge())
+
+    def test_purge_expired_messages(self):
+        old = timezone.now() - timedelta(days=40)
+        Pm.objects.filter(text__contains='message 0').update(
+            created_date=old)
+        self.assertIn('Deleted 2 messages', self.purge('--days', '30'))
+        self.assertEqual(Pm.objects.count(), 4)
+        # nothing expires without a retention period
+        Pm.objects.update(created_date=old)
+        self.assertIn('Deleted 0 messages', self.purge())
+
+    def test_purge_of_more_than_a_batch_fits_sqlite(self):
+        conversation = Conversation.objects.get(belongs_to=self.alice)
+        Pm.objects.bulk_create([
+            Pm(conversation=conversation, author=self.alice,
+               text='bulk {}'.format(i))
+            for i in range(inbox.BATCH_SIZE + 100)])
+        inbox.hide(conversation)
+        with sqlite_variable_limit():
+            deleted, reclaimed, conversations = inbox.purge()
+        self.assertEqual(deleted, inbox.BATCH_SIZE + 103)
+        self.assertEqual(conversations, 1)
+
+
+class TrendingTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.other = User.objects.create_user('other', password='pass12345')
+        self.old = make_thread(self.user, thread_name='old thread')
+        self.busy = make_thread(self.user, thread_name='busy thread')
+
+    def test_trend_is_the_log_of_the_decayed_sum(self):
+        posts = list(Post.objects.filter(thread=self.busy))
+        for i in range(3):
+            post = Post(text='reply', thread=self.busy, author=self.other)
+            post.new()
+            posts.append(post)
+        posts[0].like(self.other)
+        expected = trending.EMPTY
+        for post in posts:
+            expected = trending.add(expected,
+                                    trending.term(post.created_date))
+        trend = Thread.objects.get(pk=self.busy.pk).trend
+        # the like counts as of now, a moment after the posts
+        self.assertAlmostEqual(trend - expected, math.log(5.0 / 4), places=3)
+        self.assertAlmostEqual(trending.score(trend), 5.0, places=3)
+        category = Category.objects.get(pk=self.busy.category_id)
+        self.assertAlmostEqual(trending.score(category.trend), 6.0, places=3)
+
+    def test_a_single_bump_doesnt_make_a_thread_trend(self):
+        long_ago = timezone.now() - timedelta(days=30)
+        for i in range(5):
+            Post(text='old reply', thread=self.old, author=self.other,
+                 created_date=long_ago).new()
+        Post.objects.filter(thread=self.old).update(created_date=long_ago)
+        Thread.objects.filter(pk=self.old.pk).update(
+            trend=trending.term(long_ago, 6))
+        for i in range(2):
+            Post(text='reply', thread=self.busy, author=self.other).new()
+        # the spammer's bump puts the old thread on top by date only
+        Post(text='bump', thread=self.old, author=self.other).new()
+        self.assertEqual(
+            list(Thread.objects.order_by('-most_recent_post')
+                 .values_list('name', flat=True)),
+            ['old thread', 'busy thread'])
+        self.assertEqual(list(trending.threads(self.busy.category)
+                              .values_list('name', flat=True)),
+                         ['busy thread', 'old thread'])
+        response = self.client.get(reverse('threads', args=['test-cat']),
+                                   {'sort': 'trending'})
+        content = response.content.decode()
+        self.assertLess(content.index('busy thread'),
+                        content.index('old thread'))
+        self.assertContains(self.client.get(reverse('trending')),
+                            'busy thread')
+
+    def test_top_threads_read_the_index(self):
+        sql = str(trending.threads(self.busy.category)[:10].query)
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql.replace(
+                '= {}'.format(self.busy.category_id),
+                '= {}'.format(int(self.busy.category_id))))
+            plan = ' '.join(str(row) for row in cursor.fetchall())
+        self.assertIn('category_id_trend', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('poster', password='pass12345')
+        self.staff = User.objects.create_user('staff', password='pass12345',
+                                              is_staff=True)
+        self.thread = make_thread(self.user)
+        self.category = self.thread.category
+        post = Post(text='reply', thread=self.thread, author=self.staff)
+        post.new()
+        post.like(self.user)
+        self.today = timezone.localdate()
+
+    def totals(self, category_id):
+        row = DailyActivity.objects.get(day=self.today,
+                                        category_id=category_id)
+        return row.posts, row.threads, row.users, row.likes
+
+    def test_write_paths_keep_rollups(self):
+        self.assertEqual(self.totals(self.category.pk), (2, 1, 0, 1))
+        self.assertEqual(self.totals(0), (2, 1, 2, 1))
+
+    def test_catch_up_recounts_from_raw_tables(self):
+        # an import writes around the write paths
+        Post.objects.create(text='imported', thread=self.thread,
+                            author=self.user,
+                            created_date=timezone.now() - timedelta(days=3))
+        DailyActivity.objects.filter(category_id=0).update(posts=99)
+        out = StringIO()
+        call_command('rollup_activity', stdout=out)
+        self.assertIn('Rolled up', out.getvalue())
+        self.assertEqual(self.totals(self.category.pk), (2, 1, 0, 1))
+        self.assertEqual(self.totals(0), (2, 1, 2, 1))
+        earlier = self.today - timedelta(days=3)
+        self.assertEqual(DailyActivity.objects.get(
+            day=earlier, category_id=self.category.pk).posts, 1)
+        # the next run starts from the watermark, today
+        self.assertEqual(rollups.catch_up(), 1)
+
+    def test_month_reads_only_rollup_rows(self):
+        start, end = rollups.month_bounds(self.today.strftime('%Y-%m'))
+        with CaptureQueriesContext(connection) as queries:
+            days = rollups.activity(self.category.pk, start, end)
+        self.assertEqual(len(queries), 1)
+        self.assertIn('dailyactivity', queries[0]['sql'])
+        self.assertEqual(days[0]['day'], start)
+        self.assertEqual(days[-1]['day'], end)
+        self.assertEqual(sum(day['posts'] for day in days), 2)
+
+    def test_stats_views_are_staff_only(self):
+        url = reverse('stats_data')
+        self.client.login(username='poster', password='pass12345')
+        self.assertEqual(self.client.get(url).status_code, 302)
+        self.client.login(username='staff', password='pass12345')
+        data = json.loads(self.client.get(url, {
+            'category': self.category.slug}).content.decode())
+        self.assertEqual(data['category'], self.category.slug)
+        today = [day for day in data['days']
+                 if day['day'] == self.today.isoformat()]
+        self.assertEqual(today[0]['posts'], 2)
+        self.assertEqual(self.client.get(url, {'month': 'nope'}).status_code,
+                         404)
+        self.assertContains(self.client.get(reverse('stats')), 'Whole forum')
+
+
+class StartupTests(TestCase):
+
+    def test_views_import_leaves_write_path_libraries_out(self):
+        script = ('import django; django.setup(); import sys; '
+                  'import forum_app.views; '
+                  'print(" ".join(m for m in ("markdown", "bleach", '
+                  '"forum_app.export") if m in sys.modules))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='forum_project.settings')
+        out = subprocess.check_output([sys.executable, '-c', script], env=env,
+                                      universal_newlines=True)
+        self.assertEqual(out.strip(), '')
+
+    def test_startup_within_budget(self):
+        seconds, unused = warmup.startup_times()
+        self.assertLess(seconds, warmup.STARTUP_BUDGET)
+
+    def test_warm_up(self):
+        make_thread(User.objects.create_user(username='warm',
+                                             password='pass12345'))
+        leaderboard.boards.clear()
+        steps = [name for name, seconds in warmup.warm_up()]
+        self.assertEqual(steps, ['imports', 'templates', 'urls', 'caches',
+                                 'database'])
+        self.assertEqual(warmup.compile_templates(), [])
+        self.assertIn(None, leaderboard.boards.boards)
+
+
+class SitemapTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.user = User.objects.create_user(username='crawled',
+                                             password='pass12345')
+
+    def tearDown(self):
+        for name in os.listdir(self.root):
+            os.remove(os.path.join(self.root, name))
+        os.rmdir(self.root)
+
+    def build(self, **kwargs):
+        return sitemap.build(self.root, 'http://testserver', shard_size=2,
+                             **kwargs)
+
+    def read(self, name):
+        with gzip.open(os.path.join(self.root, name), 'rt') as f:
+            return f.read()
+
+    def test_incremental_shards(self):
+        threads = [make_thread(self.user, thread_name='thread {}'.format(n))
+                   for n in range(3)]
+        first = sitemap.shard_name(threads[0].pk // 2)
+        last = sitemap.shard_name(threads[2].pk // 2)
+        written = self.build()
+        self.assertIn(sitemap.CATEGORIES, written)
+        self.assertIn(first, written)
+        self.assertIn(last, written)
+        with open(os.path.join(self.root, sitemap.INDEX)) as f:
+            self.assertIn('http://testserver/' + last, f.read())
+        url = 'http://testserver' + reverse(
+            'thread', args=[threads[2].category.slug, threads[2].slug])
+        self.assertIn('<loc>{}</loc>'.format(url), self.read(last))
+        self.assertEqual(self.build(), [])
+
+        Post(text='more', thread=threads[2], author=self.user).new()
+        self.assertEqual(self.build(), [sitemap.CATEGORIES, last])
+        threads[2].delete()
+        self.assertIn(last, self.build())
+        if sitemap.shard_name(threads[1].pk // 2) == last:
+            self.assertNotIn(url, self.read(last))
+        else:
+            self.assertFalse(os.path.exists(os.path.join(self.root, last)))
+        self.assertEqual(len(self.build(full=True)),
+                         1 + len(set(t.pk // 2 for t in threads[:2])))
+
+    def test_slug_edits_rewrite_the_shards(self):
+        thread = make_thread(self.user)
+        shard = sitemap.shard_name(thread.pk // 2)
+        self.build()
+        category = Category.objects.get(pk=thread.category_id)
+        category.name = 'renamed cat'
+        category.save()
+        self.assertEqual(self.build(), [])
+        category.slug = 'renamed-cat'
+        category.save()
+        self.assertEqual(self.build(), [sitemap.CATEGORIES, shard])
+        self.assertIn('/renamed-cat/', self.read(shard))
+        thread = Thread.objects.get(pk=thread.pk)
+        thread.slug = 'renamed-thread'
+        thread.save()
+        self.assertEqual(self.build(), [shard])
+        self.assertIn('/renamed-thread/', self.read(shard))
+
+    def test_served_from_root(self):
+        make_thread(self.user)
+        self.build()
+        with self.settings(SITEMAP_ROOT=self.root):
+            response = self.client.get('/sitemap.xml')
+            self.assertContains(response, sitemap.CATEGORIES)
+            self.assertEqual(
+                self.client.get('/' + sitemap.CATEGORIES).status_code, 200)
+
+
+class MediaTests(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.storage = media.HashedFileStorage(location=self.root)
+        self.name = self.storage.save('profile_pics/me.png',
+                                      ContentFile(b'0123456789'))
+        self.url = '/media/' + self.name
+
+    def tearDown(self):
+        self.storage.delete(self.name)
+        os.rmdir(os.path.join(self.root, 'profile_pics'))
+        os.rmdir(self.root)
+
+    def get(self, url=None, **headers):
+        with self.settings(MEDIA_ROOT=self.root):
+            return self.client.get(url or self.url, **headers)
+
+    def test_hashed_names(self):
+        self.assertRegex(self.name, r'^profile_pics/me\.[0-9a-f]{12}\.png$')
+        self.assertEqual(self.storage.save('profile_pics/me.png',
+                                           ContentFile(b'0123456789')),
+                         self.name)
+
+    def test_file_response(self):
+        response = self.get()
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Content-Type'], 'image/png')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+                         .status_code, 304)
+        self.assertEqual(
+            self.get(HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            .status_code, 304)
+
+    def test_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=2-4')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-4/10')
+        self.assertEqual(b''.join(response.streaming_content), b'234')
+        response = self.get(HTTP_RANGE='bytes=-3')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        self.assertEqual(self.get(HTTP_RANGE='bytes=10-').status_code, 416)
+        response = self.get(HTTP_RANGE='bytes=2-4', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_accel(self):
+        with self.settings(MEDIA_ACCEL='x-accel-redirect'):
+            response = self.get()
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected-media/' + self.name)
+        self.assertEqual(response.content, b'')
+        with self.settings(MEDIA_ACCEL='x-sendfile'):
+            response = self.get()
+        self.assertEqual(response['X-Sendfile'],
+                         os.path.join(self.root, self.name))
+
+    def test_only_media_dirs(self):
+        with open(os.path.join(self.root, 'secret.txt'), 'w') as f:
+            f.write('secret')
+        try:
+            for url in ['/media/secret.txt', '/media/profile_pics/',
+                        '/media/profile_pics/../secret.txt',
+                        '/media/profile_pics/missing.png']:
+                self.assertEqual(self.get(url).status_code, 404)
+        finally:
+            os.remove(os.path.join(self.root, 'secret.txt'))
+
+
+class ViewCountTests(TestCase):
+
+    def setUp(self):
+        viewcounts.buffer.take()
+        viewcounts.buffer.seen.clear()
+        viewcounts.buffer.failures = 0
+        self.user = User.objects.create_user(username='viewer',
+                                             password='pass12345')
+        self.threads = [make_thread(self.user, thread_name='viewed {}'
+                                    .format(n)) for n in range(3)]
+
+    def test_duplicates_suppressed_within_window(self):
+        views = viewcounts.ViewBuffer(window=60, size=10)
+        self.assertTrue(views.record(1, 'a', now=0))
+        self.assertFalse(views.record(1, 'a', now=30))
+        self.assertTrue(views.record(1, 'b', now=30))
+        self.assertTrue(views.record(2, 'a', now=30))
+        self.assertTrue(views.record(1, 'a', now=61))
+        self.assertEqual(views.take(), {1: 3, 2: 1})
+        self.assertFalse(views.due(now=views.flushed + 3600))
+
+    def test_flush_is_one_update(self):
+        for n, thread in enumerate(self.threads):
+            for viewer in range(n + 1):
+                viewcounts.buffer.record(thread.pk, viewer)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(viewcounts.flush(), 3)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(list(Thread.objects.filter(pk__in=[
+            t.pk for t in self.threads]).order_by('pk')
+            .values_list('views', flat=True)), [1, 2, 3])
+        self.assertEqual(viewcounts.flush(), 0)
+
+    def test_flush_of_many_threads_fits_sqlite(self):
+        thread_ids = [t.pk for t in self.threads] + list(
+            range(100000, 100000 + 2 * viewcounts.FLUSH_BATCH))
+        for thread_id in thread_ids:
+            viewcounts.buffer.record(thread_id, 'viewer')
+        with sqlite_variable_limit():
+            self.assertEqual(viewcounts.flush(), len(thread_ids))
+        self.assertEqual(Thread.objects.filter(pk__in=thread_ids[:3],
+                                               views=1).count(), 3)
+
+    def test_failing_flushes_give_up(self):
+        from unittest import mock
+        from django.db import OperationalError
+        viewcounts.buffer.record(self.threads[0].pk, 'viewer')
+        with mock.patch.object(viewcounts, 'add_views',
+                               side_effect=OperationalError('locked')):
+            with self.assertLogs('forum_app.viewcounts', 'WARNING'):
+                for n in range(viewcounts.MAX_FLUSH_FAILURES - 1):
+                    viewcounts.flush()
+                    self.assertTrue(viewcounts.buffer.counts)
+                viewcounts.flush()
+        self.assertEqual(viewcounts.buffer.counts, {})
+
+    def test_thread_page_counts_once(self):
+        thread = self.threads[0]
+        url = reverse('thread', args=[thread.category.slug, thread.slug])
+        self.client.login(username='viewer', password='pass12345')
+        self.client.get(url)
+        self.client.get(url)
+        viewcounts.flush()
+        thread.refresh_from_db()
+        self.assertEqual(thread.views, 1)
+        response = self.client.get(reverse('threads',
+                                           args=[thread.category.slug]))
+        self.assertContains(response, '<td>1</td>')
+
+
+class RateLimitTests(TestCase):
+
+    def setUp(self):
+        caches[ratelimit.RATELIMIT_CACHE].clear()
+        self.flooder = User.objects.create_user(username='flooder',
+                                                password='pass12345')
+        self.other = User.objects.create_user(username='other',
+                                              password='pass12345')
+        thread = make_thread(self.flooder)
+        self.post = Post.objects.filter(thread=thread).first()
+
+    def like(self, client, user):
+        return client.post(reverse('like_post'),
+                           {'user_pk': user.pk, 'post_pk': self.post.pk})
+
+    def test_token_bucket(self):
+        for n in range(3):
+            self.assertEqual(ratelimit.take('t', 'me', '3/m', now=100), 0)
+        self.assertAlmostEqual(ratelimit.take('t', 'me', '3/m', now=100), 20)
+        self.assertAlmostEqual(ratelimit.take('t', 'me', '3/m', now=110), 10)
+        self.assertEqual(ratelimit.take('t', 'me', '3/m', now=120), 0)
+        self.assertEqual(ratelimit.take('t', 'you', '3/m', now=120), 0)
+        self.assertRaises(ValueError, ratelimit.parse_rate, '3/week')
+
+    def test_flooding_client_does_not_slow_others(self):
+        flood, other = self.client_class(), self.client_class()
+        flood.login(username='flooder', password='pass12345')
+        other.login(username='other', password='pass12345')
+        with self.settings(RATE_LIMITS={'like_post': '5/m'}):
+            statuses = [self.like(flood, self.flooder).status_code
+                        for n in range(20)]
+            self.assertEqual(statuses, [200] * 5 + [429] * 15)
+            response = self.like(flood, self.flooder)
+            self.assertEqual(int(response['Retry-After']), 12)
+            self.assertEqual([self.like(other, self.other).status_code
+                              for n in range(5)], [200] * 5)
+            # reads of limited pages are not limited
+            self.assertEqual(flood.get(reverse('categories')).status_code,
+                             200)
+
+    def test_decorator(self):
+        view = ratelimit.rate_limit('1/h')(lambda request: HttpResponse())
+        request = RequestFactory().post('/')
+        request.user = self.other
+        self.assertEqual(view(request).status_code, 200)
+        self.assertEqual(view(request).status_code, 429)
+        request = RequestFactory().get('/')
+        request.user = self.other
+        self.assertEqual(view(request).status_code, 200)
+
+    def test_visitors_behind_a_trusted_proxy_get_their_own_buckets(self):
+        def visitor(remote, forwarded=None, real=None):
+            request = RequestFactory().post('/', REMOTE_ADDR=remote)
+            if forwarded is not None:
+                request.META['HTTP_X_FORWARDED_FOR'] = forwarded
+            if real is not None:
+                request.META['HTTP_X_REAL_IP'] = real
+            return ratelimit.client(request)
+        with self.settings(TRUSTED_PROXIES=['10.0.0.1', '10.0.0.2']):
+            self.assertEqual(visitor('10.0.0.1', '1.2.3.4'), 'a1.2.3.4')
+            self.assertEqual(visitor('10.0.0.1', '6.6.6.6, 5.6.7.8, 10.0.0.2'),
+                             'a5.6.7.8')
+            self.assertEqual(visitor('10.0.0.1', real='1.2.3.4'), 'a1.2.3.4')
+            self.assertEqual(visitor('10.0.0.1'), 'a10.0.0.1')
+            # only trusted proxies may name the client
+            self.assertEqual(visitor('9.9.9.9', '1.2.3.4'), 'a9.9.9.9')
+        self.assertEqual(visitor('10.0.0.1', '1.2.3.4'), 'a10.0.0.1')
+
+    def test_check_is_cheap(self):
+        started = time.time()
+        for n in range(1000):
+            ratelimit.take('cheap', n % 10, '1000/s')
+        self.assertLess(time.time() - started, 0.2)
+
+
+class LoadTestTests(TestCase):
+
+    def test_summary(self):
+        results = ([('thread', 200, n / 1000.0) for n in range(1, 101)] +
+                   [('thread POST', 302, 0.5), ('thread POST', 500, 0.1),
+                    ('thread POST', 429, 0.001), ('search POST', 0, 1.0)])
+        summary = loadtest.summarize(results, 2.0,
+                                     ['read', 'post', 'read'])
+        self.assertEqual(summary['throughput'], 52.0)
+        self.assertEqual(summary['journeys'], {'read': 2, 'post': 1})
+        thread = summary['urls']['thread']
+        self.assertEqual((thread['p50'], thread['p95'], thread['p99']),
+                         (50.0, 95.0, 99.0))
+        self.assertEqual(summary['urls']['thread POST']['errors'], 1)
+        self.assertEqual(summary['urls']['thread POST']['rate_limited'], 1)
+        self.assertEqual(summary['urls']['search POST']['errors'], 1)
+        faster = loadtest.summarize(results[:100], 1.0)
+        lines = loadtest.compare(summary, faster)
+        self.assertIn('+92.3%', lines[0])
+        self.assertTrue(any(line.startswith('search POST') and
+                            'only in the old run' in line for line in lines))
+
+    def test_run_against_local_server(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='forum_project.settings')
+        try:
+            out = subprocess.check_output(
+                [sys.executable, 'manage.py', 'loadtest', '--duration', '2',
+                 '--clients', '4', '--workers', '2', '--write-ratio', '0.5',
+                 '--users', '4', '--categories', '1', '--threads', '3',
+                 '--save', path],
+                cwd=os.path.dirname(os.path.dirname(
+                    os.path.abspath(__file__))),
+                env=env, universal_newlines=True)
+            summary = loadtest.load(path)
+        finally:
+            os.remove(path)
+        # write endpoints may report SQLite lock contention; that belongs
+        # in the report, so only the reads have to be error free
+        self.assertIn('requests/s', out)
+        self.assertIn('journeys:', out)
+        self.assertGreater(summary['requests'], 0)
+        for name in loadtest.JOURNEYS:
+            self.assertGreater(summary['journeys'].get(name, 0), 0, name)
+        self.assertIn('categories', summary['urls'])
+        for name, row in summary['urls'].items():
+            if ' ' not in name:
+                self.assertEqual(row['errors'], 0, name)
+
+
+def bus_worker(path, commands, results):
+    """ A stand-in WSGI worker: its own bus mapping, a leaderboard and a
+    slug cache, driven by 'commands' until None.
+    """
+    bus.bus = bus.Bus(path)
+    board = leaderboard.TopK(
+        lambda key, size: [leaderboard.Entry(1, 1, 1, 'first')],
+        channel='test-board')
+    lru = slugs.SlugCache(channel='test-slugs')
+    for command in iter(commands.get, None):
+        if command == 'load':
+            board.get(None)
+            lru.set(('category', 'cat'), (1, None))
+        elif command == 'rank':
+            board.offer(None, leaderboard.Entry(5, 2, 2, 'second'))
+        elif command == 'rename':
+            lru.discard(('category', 'cat'))
+            lru.publish()
+        elif command == 'request':
+            bus.bus.check()
+        results.put((None in board.boards, len(lru.entries)))
+    return
+
+
+class InvalidationBusTests(TestCase):
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_publish_reaches_other_processes_only(self):
+        one, two = bus.Bus(self.path), bus.Bus(self.path)
+        seen_one, seen_two = [], []
+        one.watch('cache', 3, seen_one.append)
+        two.watch('cache', 3, seen_two.append)
+        two.watch('cache', 4, seen_two.append)
+        self.assertEqual(two.check(), 0)
+        self.assertEqual(two.check(), 0)
+        one.publish('cache', 3)
+        self.assertEqual(one.check(), 0)
+        self.assertEqual(two.check(), 1)
+        self.assertEqual(two.check(), 0)
+        self.assertEqual(seen_one, [])
+        self.assertEqual(seen_two, [3])
+        two.publish('cache', 4)
+        two.publish('cache', 4)
+        self.assertEqual(one.check(), 0)
+        self.assertEqual(two.check(), 0)
+
+    def test_workers_stay_coherent(self):
+        context = multiprocessing.get_context('fork')
+        workers = []
+        for n in range(3):
+            commands, results = context.Queue(), context.Queue()
+            process = context.Process(target=bus_worker,
+                                      args=(self.path, commands, results))
+            process.start()
+            workers.append((process, commands, results))
+
+        def send(command, only=None):
+            states = []
+            for n, (process, commands, results) in enumerate(workers):
+                if only is None or n == only:
+                    commands.put(command)
+                    states.append(results.get(timeout=10))
+            return states
+
+        try:
+            self.assertEqual(send('load'), [(True, 1)] * 3)
+            send('rank', only=0)
+            # the worker that made the change patched its own board
+            self.assertEqual(send('request'),
+                             [(True, 1), (False, 1), (False, 1)])
+            self.assertEqual(send('load'), [(True, 1)] * 3)
+            self.assertEqual(send('request'), [(True, 1)] * 3)
+            send('rename', only=2)
+            self.assertEqual(send('request'),
+                             [(True, 0), (True, 0), (True, 0)])
+        finally:
+            for process, commands, results in workers:
+                commands.put(None)
+                process.join(10)
+        self.assertEqual([process.exitcode for process, c, r in workers],
+                         [0, 0, 0])
+
+    def test_middleware_checks_the_bus(self):
+        seen = []
+        bus.bus.watch('test-middleware', None, seen.append)
+        bus.Bus(bus.default_path()).publish('test-middleware')
+        self.client.get(reverse('categories'))
+        self.assertEqual(seen, [None])
@@ -0,0 +1,124 @@
+""" Trending order for threads and categories.
+
+A thread's trending score is the sum over its posts and likes of
+
+    weight * exp(-(now - t) / TAU)
+
+so activity counts less the older it is, halving every TRENDING_HALF_LIFE
+hours. Storing that sum would mean rewriting every row as time passes.
+Instead Thread.trend and Category.trend hold
+
+    log(sum of weight * exp((t - EPOCH) / TAU))
+
+which is the score at any time plus the same term for every row, so it
+orders rows exactly like the score does, never changes by itself and fits
+an ordinary index. Adding an event at time t is one log-add-exp:
+
+    trend = max(trend, x) + ln(1 + exp(-|trend - x|)),
+    x = log(weight) + (t - EPOCH) / TAU
+
+done in the database as part of the UPDATE that bumps the counters (see
+added()), so concurrent posts and likes can't lose each other's increments
+and nothing has to be recomputed periodically. An
+empty row holds EMPTY, which stands in for log(0).
+
+Dislikes don't take anything away; a score that can only grow keeps the
+arithmetic exact, and the decay does the rest.
+"""
+from datetime import datetime
+import math
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.db.models import Case, F, Func, Value, When
+from django.db.models import FloatField
+from django.dispatch import receiver
+from django.utils import timezone
+
+TRENDING_HALF_LIFE = getattr(settings, 'TRENDING_HALF_LIFE', 24)
+TAU = TRENDING_HALF_LIFE * 3600 / math.log(2)
+EPOCH = datetime(2017, 1, 1, tzinfo=timezone.utc)
+EMPTY = -1e9
+
+POST_WEIGHT = 1.0
+LIKE_WEIGHT = 1.0
+
+
+def term(when, weight=1.0):
+    """ The log-space value of an event of 'weight' at 'when'.
+    """
+    if timezone.is_naive(when):
+        when = timezone.make_aware(when, timezone.utc)
+    return math.log(weight) + (when - EPOCH).total_seconds() / TAU
+
+
+def add(trend, x):
+    """ log(exp(trend) + exp(x)), without overflow.
+    """
+    return max(trend, x) + math.log1p(math.exp(-abs(trend - x)))
+
+
+def score(trend, now=None):
+    """ The decayed score 'trend' stands for at 'now'.
+    """
+    if now is None:
+        now = timezone.now()
+    return math.exp(trend - term(now))
+
+
+def added(when, weight):
+    """ SQL expression for the trend with an event of 'weight' at 'when'
+    added, for an UPDATE of Thread or Category.
+    """
+    x = Value(term(when, weight), output_field=FloatField())
+    larger = Case(When(trend__gt=x, then=F('trend')), default=x,
+                  output_field=FloatField())
+    difference = Func(F('trend') - x, function='ABS',
+                      output_field=FloatField())
+    decayed = Func(Value(-1.0) * difference, function='EXP',
+                   output_field=FloatField())
+    return larger + Func(Value(1.0) + decayed, function='LN',
+                         output_field=FloatField())
+
+
+def post_liked(post):
+    """ Count a like of 'post' towards its thread and category.
+    """
+    from forum_app.models import Category, Thread
+    expression = added(timezone.now(), LIKE_WEIGHT)
+    Thread.objects.filter(pk=post.thread_id).update(trend=expression)
+    Category.objects.filter(pk=post.thread.category_id).update(
+        trend=expression)
+    return
+
+
+def threads(category=None):
+    """ Threads, site-wide or of 'category', most trending first. Backed by
+    the (trend) and (category, trend) indexes.
+    """
+    from forum_app.models import Thread
+    rows = Thread.objects.all()
+    if category is not None:
+        rows = rows.filter(category=category)
+    return rows.order_by('-trend', '-id')
+
+
+def _ln(x):
+    return math.log(x) if x > 0 else None
+
+
+def _exp(x):
+    try:
+        return math.exp(x)
+    except OverflowError:
+        return None
+
+
+@receiver(connection_created)
+def add_sqlite_functions(sender, connection, **kwargs):
+    """ SQLite only has LN and EXP when built with its math functions.
+    """
+    if connection.vendor == 'sqlite':
+        connection.connection.create_function('LN', 1, _ln)
+        connection.connection.create_function('EXP', 1, _exp)
+    return
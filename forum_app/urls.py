@@ -23,15 +23,34 @@ urlpatterns =[
     url(r'^$', views.category_list, name='categories'),
     url(r'^add-category/$', views.category_add,
         name='category_add'),
+    url(r'^post/(?P<post_id>[0-9]+)/$', views.post_permalink,
+        name='post_permalink'),
+    url(r'^post/(?P<post_id>[0-9]+)/edit/$', views.post_edit,
+        name='post_edit'),
+    url(r'^post/(?P<post_id>[0-9]+)/history/$', views.post_history,
+        name='post_history'),
     url(r'^like-post/$', views.like_post, name='like_post'),
+    url(r'^leaderboard/$', views.leaderboard, name='leaderboard'),
+    url(r'^trending/$', views.trending_threads, name='trending'),
+    url(r'^export/$', views.export_forum, name='export_forum'),
+    url(r'^stats/$', views.stats, name='stats'),
+    url(r'^stats/data/$', views.stats_data, name='stats_data'),
     url(r'^topic/(?P<category_slug>[\w\-]+)/$', views.thread_list, 
         name='threads'),
     url(r'^topic/(?P<category_slug>[\w\-]+)/edit/$', views.category_edit,
         name='category_edit'),
     url(r'^topic/(?P<category_slug>[\w\-]+)/add-thread/$', views.thread_add,
         name='thread_add'),
+    url(r'^topic/(?P<category_slug>[\w\-]+)/leaderboard/$', views.leaderboard,
+        name='category_leaderboard'),
+    url(r'^topic/(?P<category_slug>[\w\-]+)/similar/$',
+        views.similar_threads, name='similar_threads'),
+    url(r'^topic/(?P<category_slug>[\w\-]+)/mark-read/$',
+        views.category_mark_read, name='category_mark_read'),
     url(r'^topic/(?P<category_slug>[\w\-]+)/(?P<thread_slug>[\w\-]+)/$',
         views.thread, name='thread'),
     url(r'^topic/(?P<category_slug>[\w\-]+)/(?P<thread_slug>[\w\-]+)/edit/$', 
         views.thread_edit, name='thread_edit'),
+    url(r'^topic/(?P<category_slug>[\w\-]+)/(?P<thread_slug>[\w\-]+)/unread/$',
+        views.thread_unread, name='thread_unread'),
 ]
\ No newline at end of file
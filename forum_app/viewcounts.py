@@ -0,0 +1,164 @@
+""" Buffered thread view counts.
+
+Adding 1 to Thread.views on every thread page would turn each read into a
+write, and on SQLite every write takes the database lock. Instead each
+worker counts views in memory and adds them to the database every
+VIEW_FLUSH_INTERVAL seconds, with one UPDATE per FLUSH_BATCH threads:
+
+    UPDATE thread SET views = views + CASE id WHEN 1 THEN 3 WHEN 7 ...
+    WHERE id IN (1, 7, ...)
+
+The flush runs on the first view after the interval is up and when the
+process exits. A flush that fails is logged and puts its counts back for
+the next one; after MAX_FLUSH_FAILURES failures in a row the counts are
+dropped instead, so a flush that can never succeed doesn't let the buffer
+grow forever.
+
+A viewer (user, else session, else address) is counted once per thread per
+VIEW_DEDUP_WINDOW seconds. The viewers seen are kept per worker, in a
+bounded LRU, so the counts are approximate: a viewer whose requests land on
+several workers can be counted once by each.
+"""
+from collections import OrderedDict
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db.models import Case, F, IntegerField, Value, When
+
+VIEW_FLUSH_INTERVAL = getattr(settings, 'VIEW_FLUSH_INTERVAL', 5)
+VIEW_DEDUP_WINDOW = getattr(settings, 'VIEW_DEDUP_WINDOW', 30 * 60)
+# (viewer, thread) pairs remembered per worker
+DEDUP_SIZE = 100000
+# threads per UPDATE: 3 variables each (id and count in the CASE, id in the
+# IN list), under the 999 SQLite binds per statement
+FLUSH_BATCH = 300
+MAX_FLUSH_FAILURES = 3
+
+logger = logging.getLogger(__name__)
+
+
+class ViewBuffer(object):
+    """ Pending view counts per thread id, and the recent (viewer, thread)
+    pairs for duplicate suppression.
+    """
+    def __init__(self, window=VIEW_DEDUP_WINDOW, size=DEDUP_SIZE):
+        self.window = window
+        self.size = size
+        self.counts = {}
+        self.seen = OrderedDict()
+        self.flushed = time.time()
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, thread_id, viewer, now=None):
+        """ Count a view of 'thread_id' by 'viewer' unless the viewer was
+        counted for it within the window. Returns whether it was counted.
+        """
+        if now is None:
+            now = time.time()
+        key = (viewer, thread_id)
+        with self.lock:
+            # oldest first: drop what fell out of the window or the bound
+            while self.seen:
+                when = next(iter(self.seen.values()))
+                if when > now - self.window and len(self.seen) < self.size:
+                    break
+                self.seen.popitem(last=False)
+            if key in self.seen:
+                return False
+            self.seen[key] = now
+            self.counts[thread_id] = self.counts.get(thread_id, 0) + 1
+        return True
+
+    def due(self, interval=VIEW_FLUSH_INTERVAL, now=None):
+        if now is None:
+            now = time.time()
+        return bool(self.counts) and now - self.flushed >= interval
+
+    def take(self):
+        """ The pending counts, leaving none.
+        """
+        with self.lock:
+            counts, self.counts = self.counts, {}
+            self.flushed = time.time()
+        return counts
+
+    def restore(self, counts):
+        with self.lock:
+            for thread_id, n in counts.items():
+                self.counts[thread_id] = self.counts.get(thread_id, 0) + n
+
+
+buffer = ViewBuffer()
+
+
+def add_views(counts):
+    """ Add {thread id: views} to Thread.views in one UPDATE.
+    """
+    from forum_app.models import Thread
+    added = Case(*[When(id=thread_id, then=Value(n))
+                   for thread_id, n in counts.items()],
+                 default=Value(0), output_field=IntegerField())
+    Thread.objects.filter(id__in=list(counts)).update(
+        views=F('views') + added)
+    return
+
+
+def flush():
+    """ Write the pending counts, FLUSH_BATCH threads per UPDATE. Returns
+    how many threads were updated; on a database error the counts not yet
+    written are kept for the next flush, unless that was the
+    MAX_FLUSH_FAILURES-th failure in a row.
+    """
+    counts = buffer.take()
+    ids = sorted(counts)
+    for start in range(0, len(ids), FLUSH_BATCH):
+        try:
+            add_views(dict((thread_id, counts[thread_id])
+                           for thread_id in ids[start:start + FLUSH_BATCH]))
+        except DatabaseError:
+            buffer.failures += 1
+            left = dict((thread_id, counts[thread_id])
+                        for thread_id in ids[start:])
+            if buffer.failures >= MAX_FLUSH_FAILURES:
+                logger.exception('View count flush failed %d times, '
+                                 'dropping views of %d threads',
+                                 buffer.failures, len(left))
+                buffer.failures = 0
+            else:
+                logger.warning('View count flush failed, keeping views of '
+                               '%d threads', len(left), exc_info=True)
+                buffer.restore(left)
+            return start
+    buffer.failures = 0
+    return len(ids)
+
+
+def viewer(request):
+    if request.user.is_authenticated:
+        return 'user:{}'.format(request.user.pk)
+    if request.session.session_key:
+        return 'session:' + request.session.session_key
+    return 'addr:' + request.META.get('REMOTE_ADDR', '')
+
+
+def thread_viewed(request, thread):
+    """ Count a view of 'thread' for the request, flushing if it's time.
+    """
+    buffer.record(thread.pk, viewer(request))
+    if buffer.due():
+        flush()
+    return
+
+
+@atexit.register
+def flush_on_exit():
+    try:
+        flush()
+    except Exception:
+        # the database may already be gone at exit
+        pass
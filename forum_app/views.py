@@ -2,21 +2,51 @@ from django.shortcuts import render, get_object_or_404, redirect
 from django.utils import timezone
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login, logout
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.views.decorators.http import require_safe
 from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.core.mail import send_mail, mail_admins
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
-from markdown import markdown
-import bleach
 
 from forum_app.models import Category, Thread, Post, User, Profile, Conversation, Pm
+from forum_app.models import UserStats
+from forum_app.paginators import CountedPaginator, cursor_page, prefix_range
+from forum_app.paginators import POSTS_PER_PAGE
+from forum_app import leaderboard as leaderboards
+from forum_app import fragments
+from forum_app import readmarkers
+from forum_app import similar
+from forum_app import slugs
+from forum_app import archive
+from forum_app import markup
+from forum_app import inbox
+from forum_app import trending
+from forum_app import rollups
+from forum_app import revisions
+from forum_app import media
+from forum_app import viewcounts
 from forum_app.forms import UserForm, ProfileForm, CategoryForm, ThreadForm
 from forum_app.forms import PostForm, PmForm, ContactForm
 
+TRENDING_THREADS = 50
+
+
+def post_url(post, category_slug=None, thread_slug=None):
+    """ URL of the thread page 'post' is on, anchored on the post. Pass the
+    slugs if known, otherwise post.thread.category is used.
+    """
+    if thread_slug is None:
+        category_slug = post.thread.category.slug
+        thread_slug = post.thread.slug
+    return '{}?page={}#post-{}'.format(
+        reverse('thread', args=[category_slug, thread_slug]),
+        post.position() // POSTS_PER_PAGE + 1, post.pk)
+
 
 def category_list(request):
     """ View to get all of the Category objects and pass them to a template
@@ -24,30 +54,56 @@ def category_list(request):
     ARGs:
         request object
     RET rendered HTML page with context:
-        categories - a list of Categories objects.
+        categories - a list of Categories objects, with .unread set for
+                     logged in users
+        sort - 'trending' or '' (most recent activity first)
     """
-    categories = Category.objects.all().order_by('-most_recent_post')
-    context = {'categories':categories}
+    sort = request.GET.get('sort', '')
+    if sort == 'trending':
+        categories = Category.objects.all().order_by('-trend', '-id')
+    else:
+        sort = ''
+        categories = Category.objects.all().order_by('-most_recent_post')
+    categories = readmarkers.annotate_categories(request.user, categories)
+    context = {'categories':categories, 'sort':sort}
     return render(request, 'forum/category_list.html', context)
 
+def trending_threads(request):
+    """ Site-wide list of the threads with the most recent activity,
+    weighted so that a single bump doesn't count for much (see trending.py).
+    ARGs:
+        request object
+    RET:
+        threads - the TRENDING_THREADS most trending Thread objects
+    """
+    threads = trending.threads().select_related('category', 'author')
+    context = {'threads': threads[:TRENDING_THREADS]}
+    return render(request, 'forum/trending.html', context)
+
 def thread_list(request, category_slug):
     """ View to get all the Thread objects that belong to a specific Category.
     ARGs:
         category_slug - unique identifier for category
     RET:
-        threads - a list of Thread objects
+        threads - a list of Thread objects, with .unread set for logged in
+                  users
         category - a Category object
+        sort - 'trending' or '' (most recent activity first)
     """
     context = {}
-    category = get_object_or_404(Category, slug=category_slug)
-    if 'query' in request.GET:
-        query = bleach.clean(request.GET.get('query'))
-        context['query'] = query
-        thread_list = category.thread_set.filter(category=category,name__contains=query).order_by(
-                      '-most_recent_post','created_date')
+    category = slugs.get_category_or_404(category_slug)
+    sort = request.GET.get('sort', '')
+    if sort == 'trending':
+        thread_list = trending.threads(category)
     else:
+        sort = ''
         thread_list = category.thread_set.all().order_by('-most_recent_post',
               'created_date')
+    context['sort'] = sort
+    if 'query' in request.GET:
+        query = markup.clean(request.GET.get('query'))
+        context['query'] = query
+        thread_list = thread_list.filter(name__contains=query)
     paginator = Paginator(thread_list, 100) # show 10 threads per page
     if 'page' in request.GET:
         page = request.GET.get('page')
@@ -57,6 +113,8 @@ def thread_list(request, category_slug):
             threads = paginator.page(1) # default to first page
     else:
         threads = paginator.page(1)
+    threads.object_list = readmarkers.annotate_threads(request.user, category,
+                                                       threads)
     context['paginator'] = paginator
     context['threads'] = threads
     context['category'] = category
@@ -74,13 +132,13 @@ def thread(request, category_slug, thread_slug):
         form - the PostForm object to be rendered
     """
     context = {}
-    thread = get_object_or_404(Thread, slug=thread_slug)
-    category = get_object_or_404(Category, slug=category_slug)
+    thread = slugs.get_thread_or_404(category_slug, thread_slug)
+    category = thread.category
     if request.method == 'POST':
         form = PostForm(request.POST, request.FILES)
         if form.is_valid():
             post = form.save(commit=False)
-            post.text = markdown(bleach.clean(post.text).replace('&gt;','>'))
+            post.text = markup.render_markdown(post.text)
             post.thread = thread
             post.author = request.user
             post.new()
@@ -93,10 +151,12 @@ def thread(request, category_slug, thread_slug):
     else:
         form = PostForm()
         context['form'] = form
+        viewcounts.thread_viewed(request, thread)
 
-    post_list = thread.post_set.all().order_by('created_date')
+    # (created_date, id) so a post's page matches Post.position()
+    post_list = archive.thread_posts(thread).select_related('author__profile')
     initial_post = post_list[0]
-    paginator = Paginator(post_list, 50) # show 10 posts per page
+    paginator = Paginator(post_list, POSTS_PER_PAGE)
     if 'page' in request.GET:
         page = request.GET.get('page')
         try:
@@ -109,6 +169,21 @@ def thread(request, category_slug, thread_slug):
             posts = paginator.page(paginator.num_pages)
     else:
         posts = paginator.page(paginator.num_pages)
+    # one query for which of these posts the viewer already rated, instead
+    # of post.liked_by.all per post in the template
+    liked_ids = set()
+    if thread.archived:
+        # read-only: render as if every post was already rated
+        liked_ids = set(post.pk for post in posts)
+    elif request.user.is_authenticated:
+        liked_ids = set(Post.liked_by.through.objects.filter(
+            user=request.user, post_id__in=[post.pk for post in posts])
+            .values_list('post_id', flat=True))
+    context['post_html'] = fragments.render_posts(
+        posts, request.user, thread, initial_post.pk, liked_ids)
+    if request.user.is_authenticated and not thread.archived:
+        readmarkers.mark_thread_read(request.user, thread,
+                                     max(post.pk for post in posts))
     context['paginator'] = paginator
     context['posts'] = posts
     context['initial_post'] = initial_post
@@ -116,6 +191,92 @@ def thread(request, category_slug, thread_slug):
     context['category'] = category
     return render(request, 'forum/thread.html', context)
 
+@login_required
+def thread_unread(request, category_slug, thread_slug):
+    """ Redirect to the first post of a Thread the user hasn't read yet,
+    on the page it is on, or to the last page if everything has been read.
+    ARGs:
+        thread_slug - thread we want to show
+        category_slug - parent category for this thread
+    RET:
+        redirect to the thread page
+    """
+    thread = slugs.get_thread_or_404(category_slug, thread_slug)
+    post = readmarkers.first_unread(request.user, thread)
+    if post is None:
+        return redirect('thread', category_slug, thread_slug)
+    return redirect(post_url(post, category_slug, thread_slug))
+
+def post_permalink(request, post_id):
+    """ Stable link to a Post. Redirects to the thread page the post is on
+    now, anchored on the post.
+    ARGs:
+        post_id - pk of the Post
+    RET:
+        redirect to the thread page
+    """
+    post = archive.get_post(post_id)
+    if post is None:
+        raise Http404
+    return redirect(post_url(post))
+
+@login_required
+def post_edit(request, post_id):
+    """ View to edit a Post. Only its author and staff can edit it, and
+    not while its thread is archived. The old text is kept as a revision.
+    ARGs:
+        post_id - pk of the Post
+    RET:
+        form - PostForm filled with the current text
+    or
+        redirect to the post
+    """
+    post = get_object_or_404(Post.objects.select_related('thread__category'),
+                             pk=post_id)
+    if request.user != post.author and not request.user.is_staff:
+        raise Http404
+    if request.method == 'POST':
+        form = PostForm(request.POST)
+        if form.is_valid():
+            text = markup.render_edit(form.cleaned_data['text'])
+            if text != post.text:
+                post.edit(text, request.user)
+            return redirect(post_url(post))
+    else:
+        form = PostForm(instance=post)
+    context = {'form': form, 'post': post, 'thread': post.thread,
+               'category': post.thread.category}
+    return render(request, 'forum/post_edit.html', context)
+
+def post_history(request, post_id):
+    """ Every revision of a Post, newest first.
+    ARGs:
+        post_id - pk of the Post
+    RET:
+        revisions - PostRevision objects with their text rebuilt
+    """
+    post = archive.get_post(post_id)
+    if post is None:
+        raise Http404
+    context = {'post': post, 'thread': post.thread,
+               'category': post.thread.category,
+               'revisions': list(reversed(revisions.history(post.pk)))}
+    return render(request, 'forum/post_history.html', context)
+
+@login_required
+def category_mark_read(request, category_slug):
+    """ POST only. Mark everything in a Category as read for the user.
+    ARGs:
+        category_slug - category to mark
+    RET:
+        redirect to the category's thread list
+    """
+    category = slugs.get_category_or_404(category_slug)
+    if request.method != 'POST':
+        raise Http404
+    readmarkers.mark_category_read(request.user, category, timezone.now())
+    return redirect('threads', category.slug)
+
 @login_required
 def category_edit(request, category_slug):
     """ View to display and handle CategoryForm. This will allow the user to
@@ -180,8 +341,8 @@ def thread_edit(request, category_slug, thread_slug):
         HttpRedirect to a URL
     """
     # Is the user trying to edit an existing Thread?
-    thread = get_object_or_404(Thread, slug=thread_slug)
-    category = get_object_or_404(Category, slug=category_slug)
+    thread = slugs.get_thread_or_404(category_slug, thread_slug)
+    category = thread.category
     # if POST, then commit changes to existing Thread
     if request.method == 'POST':
         form = ThreadForm(request.POST, request.FILES, instance=thread)
@@ -204,9 +365,10 @@ def thread_add(request, category_slug):
     ENFORCE that NO thread can be named "add-thread".
     """
     context = {}
-    category = get_object_or_404(Category, slug=category_slug)
+    category = slugs.get_category_or_404(category_slug)
     context['category'] = category
-    banned_thread_names = ['add-thread', 'add thread']
+    banned_thread_names = ['add-thread', 'add thread', 'leaderboard',
+                           'mark-read', 'similar']
     if request.method == 'POST':
         thread_form = ThreadForm(request.POST, request.FILES)
         post_form = PostForm(request.POST, request.FILES)
@@ -222,7 +384,7 @@ def thread_add(request, category_slug):
             if post_form.is_valid():
                 thread.new()
                 post = post_form.save(commit=False)
-                post.text = markdown(bleach.clean(post.text))
+                post.text = markup.render_markdown(post.text)
                 post.thread = thread
                 post.author = request.user
                 post.new()
@@ -246,6 +408,30 @@ def thread_add(request, category_slug):
         context['post_form'] = post_form
     return render(request, 'forum/thread_add.html', context)
 
+def similar_threads(request, category_slug):
+    """ Ajax GET endpoint suggesting existing Threads in a Category whose
+    titles look like the one being typed, to head off duplicates.
+    ARGs:
+        category_slug - category the new thread goes in
+        GET['title'] - title typed so far
+        GET['exclude'] - optional pk of a thread to leave out (when renaming)
+    RET:
+        json object - 'threads', a list of {name, url, score}, best first
+    """
+    category = slugs.get_category_or_404(category_slug)
+    title = request.GET.get('title', '')[:200]
+    try:
+        exclude = int(request.GET.get('exclude', ''))
+    except ValueError:
+        exclude = None
+    threads = []
+    for score, pk, name, slug in similar.similar_threads(
+            category.pk, title, exclude=exclude):
+        threads.append({'name': name, 'score': round(score, 2),
+                        'url': reverse('thread', args=[category.slug, slug])})
+    return HttpResponse(json.dumps({'threads': threads}),
+           content_type='application/json')
+
 def search_bar(request):
     """ View to handle Ajax POST requests. A JS function is connected to the
     keyup signal from the search bar. Each keypress triggers the JS function
@@ -267,8 +453,9 @@ def search_bar(request):
         # Category ajax search
         ###########################################################
         if search_type == 'category':
-            categories = Category.objects.filter(name__contains=search_text).order_by(
-                               '-most_recent_post')
+            categories = readmarkers.annotate_categories(request.user,
+                Category.objects.filter(name__contains=search_text).order_by(
+                               '-most_recent_post'))
             context = {'categories':categories, 'object':search_type}
         ###########################################################
         # Thread ajax search
@@ -276,7 +463,7 @@ def search_bar(request):
         elif search_type == 'thread':
             cat_slug = request.POST['search_category']
             cat = get_object_or_404(Category, slug=cat_slug)
-            query = bleach.clean(search_text)
+            query = markup.clean(search_text)
             context['query'] = query
             thread_list = Thread.objects.filter(category=cat,name__contains=query).order_by(
                              '-most_recent_post','created_date')
@@ -289,16 +476,25 @@ def search_bar(request):
                     threads = paginator.page(1) # defualt to first page
             else:
                 threads = paginator.page(1)
+            threads.object_list = readmarkers.annotate_threads(
+                request.user, cat, threads)
             context['paginator'] = paginator
             context['threads'] = threads
             context['object'] = search_type
             context['category'] = cat
         ###########################################################
+        # User ajax search (username prefix)
+        ###########################################################
+        elif search_type == 'user':
+            profile_list = user_directory(search_text).order_by(
+                               'user__username')[:50]
+            context = {'profile_list':profile_list, 'object':search_type}
+        ###########################################################
         # Post ajax search ( currently NOT in use )
         ###########################################################
         elif search_type == 'post':
             results = Post.objects.filter(text__contains=search_text).order_by(
-                           '-most_recent_post','created_date')
+                           '-created_date', '-id')[:50]
             context = {'results':results, 'object':search_type}
         else:
             results = ''
@@ -386,6 +582,21 @@ def profile(request, username):
         return redirect(reverse('categories'))
     # If a User exists, then get associated Profile object.
     profile = Profile.objects.get(user=user)
+    # Totals are precomputed, so they cost one primary key lookup no matter
+    # how much this user has posted.
+    stats, created = UserStats.objects.get_or_create(user=user)
+    # Recent activity walks the (author, created_date) index and uses the
+    # stored post count instead of a COUNT(*) over Post.
+    post_list = (Post.objects.filter(author=user)
+                 .select_related('thread__category')
+                 .order_by('-created_date'))
+    paginator = CountedPaginator(post_list, 20, stats.num_posts)
+    try:
+        recent_posts = paginator.page(request.GET.get('page', 1))
+    except PageNotAnInteger:
+        recent_posts = paginator.page(1)
+    except EmptyPage:
+        recent_posts = paginator.page(paginator.num_pages)
     # now that we have the User and Profile object in question, get the Form.
     if request.method == 'POST':
         profile_form = ProfileForm(request.POST, request.FILES,
@@ -400,16 +611,73 @@ def profile(request, username):
     context['profile_form'] = profile_form
     context['selecteduser'] = user
     context['profile'] = profile
+    context['stats'] = stats
+    context['paginator'] = paginator
+    context['recent_posts'] = recent_posts
     # we pass User, Profile, & ProfileForm objects to the template.
     return render(request, 'forum/profile.html', context)
 
+# sort keys for the user directory. 'joined' uses user_id, which grows with
+# date_joined and is already indexed, unlike date_joined itself.
+PROFILE_SORTS = {
+    'rank': ['rank', 'id'],
+    'joined': ['user_id'],
+}
+
+def user_directory(query=None):
+    """ Profiles joined to their User in a single query. 'query' is a
+    username prefix, matched with an indexed range on auth_user.username.
+    """
+    profiles = Profile.objects.select_related('user')
+    if query:
+        profiles = profiles.filter(**prefix_range('user__username', query))
+    return profiles
+
 @login_required
 def profile_list(request):
-    profile_list = Profile.objects.all()
-    context = {'profile_list':profile_list}
+    """ Paginated user directory. Uses cursor pagination so every page is
+    one index range scan, however many users there are.
+    ARGs:
+        GET['sort'] - 'rank' (default) or 'joined'
+        GET['after'] - cursor returned by the previous page
+        GET['query'] - optional username prefix
+    RET:
+        profile_list - Profile objects for this page, with user loaded
+        next_cursor - cursor for the next page, or None
+    """
+    context = {}
+    sort = request.GET.get('sort', 'rank')
+    if sort not in PROFILE_SORTS:
+        sort = 'rank'
+    query = request.GET.get('query', '')
+    profile_list, next_cursor = cursor_page(
+        user_directory(query), PROFILE_SORTS[sort],
+        request.GET.get('after'), 50)
+    context['profile_list'] = profile_list
+    context['next_cursor'] = next_cursor
+    context['sort'] = sort
+    context['query'] = query
     return render(request, 'forum/profile_list.html', context)
 
 
+def leaderboard(request, category_slug=None):
+    """ View to show the highest ranked users, site-wide or within one
+    Category. Served from the in-process top-K boards, so a warm board costs
+    no queries beyond the Category lookup.
+    ARGs:
+        category_slug - optional, limit the board to this Category
+    RET:
+        entries - leaderboard Entry objects, highest rank first
+        category - the Category, or None for the site-wide board
+    """
+    context = {}
+    category = None
+    if category_slug is not None:
+        category = get_object_or_404(Category, slug=category_slug)
+    context['entries'] = leaderboards.top(category and category.pk)
+    context['category'] = category
+    return render(request, 'forum/leaderboard.html', context)
+
 @login_required
 def conversations(request, username):
     """ View to get all the Conversation objects that belong to a specific User.
@@ -425,7 +693,7 @@ def conversations(request, username):
     user = get_object_or_404(User, username=username)
     if request.user != user:
         raise Http404
-    conversation_list = Conversation.objects.filter(belongs_to=user).order_by('-most_recent_pm','-pk')
+    conversation_list = inbox.conversations(user).order_by('-most_recent_pm','-pk')
     paginator = Paginator(conversation_list, 100) # show 10 conversations per page
     if 'page' in request.GET:
         page = request.GET.get('page')
@@ -470,13 +738,12 @@ def conversation(request, username, is_with):
             conversation1, created1= Conversation.objects.get_or_create(belongs_to=user, is_with=is_with)
             conversation2, created2= Conversation.objects.get_or_create(belongs_to=is_with, is_with=user)
             pm = form.save(commit=False)
-            text = markdown(bleach.clean(pm.text).replace('&gt;','>'))
+            text = markup.render_markdown(pm.text)
             pm.text = text
             pm.conversation = conversation1
             pm.author = request.user
             pm.save() # change to new() ??
-            pm2 = Pm.objects.create(conversation=conversation2,author=request.user,text=text)
-            pm2.save()
+            Pm.objects.create(conversation=conversation2,author=request.user,text=text)
             return redirect('conversation', user, is_with.username)
         else:
             #TODO render template again, but pass errors to be displayed
@@ -493,7 +760,7 @@ def conversation(request, username, is_with):
     # If a conversation already exists, show it rather than just a blank form
     ######################################################
     if conversation1: # only if convo object existed do we bother getting pages
-        pm_list = Pm.objects.filter(conversation=conversation1)
+        pm_list = inbox.messages(conversation1)
         paginator = Paginator(pm_list, 50)
         if 'page' in request.GET:
             page = request.GET.get('page')
@@ -513,9 +780,14 @@ def conversation(request, username, is_with):
 
 @login_required
 def delete_conversation(request, username, is_with):
-    """ 
+    """ Delete a Conversation for the logged in User. Only hides it; the
+    messages are deleted later by the purge_pms command.
+    ARGs:
+        username - owner of the Conversation (must be logged in user)
+        is_with - the other User of the Conversation
+    RET:
+        redirect to the User's conversations
     """
-    print("In delete_conversation()")
     user = get_object_or_404(User, username=username)
     is_with = get_object_or_404(User, username=is_with)
     if request.user != user:
@@ -526,7 +798,7 @@ def delete_conversation(request, username, is_with):
     except Conversation.DoesNotExist:
         pass
     else:
-        conversation.delete()
+        inbox.hide(conversation)
     finally:
         return redirect('conversations',username=str(username))
 
@@ -549,7 +821,6 @@ def like_post(request):
             post.like(user)
         elif the_type == 'dislike':
             post.dislike(user)
-        post.save()
 
     response_data['post_pk'] = post.pk
     response_data['likes'] = post.likes
@@ -582,8 +853,111 @@ def contact(request):
     context['form'] = form
     return render(request, 'forum/contact.html', context)
 
+@staff_member_required
+def export_forum(request):
+    """ Staff only. Streams a compressed export of a thread, a category or
+    the whole forum; see forum_app/export.py.
+    ARGs:
+        GET['category'] - optional category slug
+        GET['thread'] - optional thread slug (needs category)
+        GET['format'] - 'jsonl' (default) or 'html'
+    RET:
+        .jsonl.gz or .tar.gz attachment, written as it is generated
+    """
+    # tarfile/gzip/process pools are only needed here; keep them out of
+    # every worker's start-up
+    from forum_app import export
+    category = thread = None
+    if request.GET.get('category'):
+        category = get_object_or_404(Category, slug=request.GET['category'])
+        if request.GET.get('thread'):
+            thread = get_object_or_404(Thread, slug=request.GET['thread'],
+                                       category=category)
+    fmt = request.GET.get('format', 'jsonl')
+    if fmt not in export.FORMATS:
+        raise Http404
+    threads = export.select_threads(category, thread)
+    response = StreamingHttpResponse(export.export(threads, fmt),
+                                     content_type='application/gzip')
+    response['Content-Disposition'] = 'attachment; filename="{}"'.format(
+        export.filename(fmt, category, thread))
+    return response
 
 
+def _activity(request):
+    """ (category or None, first day, last day, rows) for the stats views,
+    from GET['category'] (slug) and GET['month'] (YYYY-MM).
+    """
+    category = None
+    if request.GET.get('category'):
+        category = get_object_or_404(Category, slug=request.GET['category'])
+    try:
+        start, end = rollups.month_bounds(request.GET.get('month'))
+    except ValueError:
+        raise Http404
+    rows = rollups.activity(category.pk if category else 0, start, end)
+    return category, start, end, rows
 
-
-
+@staff_member_required
+def stats(request):
+    """ Staff only. Posts, new threads, new users and likes per day for a
+    month, site-wide or for one category, from the daily rollups.
+    ARGs:
+        GET['category'] - optional category slug
+        GET['month'] - optional YYYY-MM, default this month
+    RET:
+        days - one dict per day of the month
+        categories - every Category, for the picker
+    """
+    category, start, end, rows = _activity(request)
+    peak = max([row['posts'] for row in rows] + [1])
+    for row in rows:
+        row['width'] = 100 * row['posts'] // peak
+    context = {'category': category, 'days': rows, 'month': start,
+               'previous': (start - timedelta(days=1)).strftime('%Y-%m'),
+               'next': (end + timedelta(days=1)).strftime('%Y-%m'),
+               'categories': Category.objects.order_by('name')}
+    return render(request, 'forum/stats.html', context)
+
+@staff_member_required
+def stats_data(request):
+    """ Staff only. The data of the stats page as JSON, for charts.
+    ARGs:
+        GET['category'] - optional category slug
+        GET['month'] - optional YYYY-MM, default this month
+    RET:
+        {"category": slug or null, "start": "YYYY-MM-DD", "end": ...,
+         "days": [{"day": "YYYY-MM-DD", "posts": n, "threads": n,
+                   "users": n, "likes": n}, ...]}
+    """
+    category, start, end, rows = _activity(request)
+    for row in rows:
+        row['day'] = row['day'].isoformat()
+    response_data = {'category': category.slug if category else None,
+                     'start': start.isoformat(), 'end': end.isoformat(),
+                     'days': rows}
+    return HttpResponse(json.dumps(response_data),
+                        content_type="application/json")
+
+def sitemap_file(request, path):
+    """ Fallback for serving the sitemap files written by build_sitemap;
+    the web server should serve SITEMAP_ROOT at the site root itself.
+    ARGs:
+        path - file name, sitemap*.xml or sitemap*.xml.gz
+    RET:
+        the file, or 404
+    """
+    from django.views.static import serve
+    return serve(request, path, document_root=settings.SITEMAP_ROOT)
+
+@require_safe
+def media_file(request, path):
+    """ An uploaded file (profile picture, category image). Hands the file
+    to the front-end server when settings.MEDIA_ACCEL is set, otherwise
+    sends it with range and conditional request support.
+    ARGs:
+        path - file path under MEDIA_ROOT
+    RET:
+        the file, a 206/304/416 response, or 404
+    """
+    return media.serve(request, path)
@@ -0,0 +1,186 @@
+""" Opt-in warm-up of a worker process before it takes traffic.
+
+Without it the first requests a fresh worker serves pay for compiling
+templates, building the URL resolver, importing the write-path libraries,
+connecting to the database and loading the in-process caches, so every
+rolling restart shows up as a latency spike. forum_project/wsgi.py calls
+warm_up() when FORUM_WARMUP=1 is set.
+
+It has to run in each worker process. With a pre-forking server that loads
+the app in the master (gunicorn --preload), call warm_up() from a post-fork
+hook instead, or the workers would share the master's database connection.
+
+startup_times() measures importing the WSGI module in a fresh interpreter;
+the tests hold it to STARTUP_BUDGET, and the startup_report command prints
+it with the slowest imports.
+"""
+import os
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+
+# seconds to import forum_project.wsgi (and so django.setup()) from scratch
+STARTUP_BUDGET = 1.5
+
+# pages requested through the WSGI app during warm-up
+WARMUP_URLS = getattr(settings, 'WARMUP_URLS', ['/forum/'])
+
+
+def warm_imports():
+    """ Import what the write paths and less used views import lazily.
+    """
+    from forum_app import markup
+    from forum_app import export
+    markup.render_markdown('*warm*')
+    markup.clean('<b>warm</b>')
+    return
+
+
+def template_names():
+    """ Names of every .html template the engine can find.
+    """
+    from django.template.utils import get_app_template_dirs
+    dirs = []
+    for engine in settings.TEMPLATES:
+        dirs.extend(engine.get('DIRS', []))
+    dirs.extend(get_app_template_dirs('templates'))
+    names = set()
+    for root in dirs:
+        for path, subdirs, files in os.walk(root):
+            for name in files:
+                if name.endswith('.html'):
+                    names.add(os.path.relpath(os.path.join(path, name), root)
+                              .replace(os.sep, '/'))
+    return sorted(names)
+
+
+def compile_templates():
+    """ Load (and so compile) every template. With the cached loader
+    (DEBUG off) they stay compiled for the life of the process.
+    """
+    from django.template import TemplateSyntaxError
+    from django.template.loader import get_template
+    failed = []
+    for name in template_names():
+        try:
+            get_template(name)
+        except TemplateSyntaxError:
+            # templates meant to be included only in some contexts, or
+            # needing tag libraries of apps that aren't installed
+            failed.append(name)
+    return failed
+
+
+def prime_urls():
+    from django.urls import get_resolver, reverse
+    resolver = get_resolver()
+    resolver.resolve('/forum/')
+    reverse('categories')
+    return
+
+
+def prime_caches():
+    from forum_app import leaderboard, similar
+    leaderboard.top()
+    similar.load_all()
+    return
+
+
+def self_requests(application):
+    """ Run WARMUP_URLS through the WSGI app, which also warms middleware,
+    context processors and the rendering path of those views.
+    """
+    from wsgiref.util import setup_testing_defaults
+    hosts = [host.lstrip('.') for host in settings.ALLOWED_HOSTS
+             if host != '*']
+    statuses = []
+    for url in WARMUP_URLS:
+        environ = {'PATH_INFO': url, 'REQUEST_METHOD': 'GET'}
+        if hosts:
+            environ['HTTP_HOST'] = hosts[0]
+        setup_testing_defaults(environ)
+        result = []
+        response = application(environ,
+                               lambda status, headers, *args:
+                               result.append(status))
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+        statuses.append((url, result[0] if result else None))
+    return statuses
+
+
+def connect_database():
+    from django.db import connections
+    for conn in connections.all():
+        conn.ensure_connection()
+    return
+
+
+def warm_up(application=None, log=None):
+    """ Run every warm-up step; returns [(step, seconds)]. The database is
+    connected last, since a self-request closes its connection at the end.
+    """
+    steps = [('imports', warm_imports),
+             ('templates', compile_templates),
+             ('urls', prime_urls),
+             ('caches', prime_caches)]
+    if application is not None:
+        steps.append(('requests', lambda: self_requests(application)))
+    steps.append(('database', connect_database))
+    timings = []
+    for name, step in steps:
+        started = time.time()
+        step()
+        timings.append((name, time.time() - started))
+        if log is not None:
+            log('warm-up {:<10} {:7.1f} ms'.format(name,
+                                                   timings[-1][1] * 1000))
+    return timings
+
+
+STARTUP_SCRIPT = ("import time; started = time.time(); "
+                  "import forum_project.wsgi; "
+                  "print(time.time() - started)")
+
+
+def startup_times(importtime=False):
+    """ Import forum_project.wsgi in a fresh interpreter. Returns (seconds,
+    lines of -X importtime output, or [] without 'importtime').
+    """
+    env = dict(os.environ)
+    env.pop('FORUM_WARMUP', None)
+    env['DJANGO_SETTINGS_MODULE'] = 'forum_project.settings'
+    command = [sys.executable]
+    if importtime:
+        command += ['-X', 'importtime']
+    command += ['-c', STARTUP_SCRIPT]
+    process = subprocess.Popen(command, cwd=settings.BASE_DIR, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+    out, err = process.communicate()
+    if process.returncode:
+        raise RuntimeError('importing forum_project.wsgi failed:\n' + err)
+    lines = [line for line in err.splitlines()
+             if line.startswith('import time:')]
+    return float(out.strip().splitlines()[-1]), lines
+
+
+def slowest_imports(lines, n=20):
+    """ (microseconds, package) for the 'n' top-level packages that took
+    longest to import, summing the self time of their modules in
+    -X importtime output.
+    """
+    totals = {}
+    for line in lines[1:]:
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        package = parts[2].strip().split('.')[0]
+        totals[package] = totals.get(package, 0) + int(parts[0])
+    rows = sorted(((us, package) for package, us in totals.items()),
+                  reverse=True)
+    return rows[:n]
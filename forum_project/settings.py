@@ -27,7 +27,8 @@ MEDIA_DIR = os.path.join(BASE_DIR, 'media')
 SECRET_KEY = 'ge^*-#4nv6(xtnrwwk8sh#%d!2ywk5_2%7jaovr(b*-$k&!=$t'
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+# Set DJANGO_DEBUG=0 in production.
+DEBUG = os.environ.get('DJANGO_DEBUG', '1') != '0'
 
 ALLOWED_HOSTS = ['127.0.0.1','jd666.pythonanywhere.com']
 
@@ -36,7 +37,9 @@ ADMINS = [('Jack','john.dituro@gmail.com'),]
 SERVER_EMAIL = 'jdituro@masonlive.gmu.edu'
 EMAIL_HOST = 'smtp.office365.com'
 EMAIL_HOST_USER = 'jdituro@masonlive.gmu.edu'
-EMAIL_HOST_PASSWORD = os.environ['MY_SECRET_EMAIL_PASS']
+# unset (development, tests, management commands) just means mail can't be
+# sent
+EMAIL_HOST_PASSWORD = os.environ.get('MY_SECRET_EMAIL_PASS', '')
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
 
@@ -59,8 +62,10 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'forum_app.middleware.RateLimitMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'forum_app.middleware.InvalidationMiddleware',
 ]
 
 ROOT_URLCONF = 'forum_project.urls'
@@ -83,6 +88,17 @@ TEMPLATES = [
     },
 ]
 
+# Outside of DEBUG, compile each template once per process instead of on
+# every render.
+if not DEBUG:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]
+
 WSGI_APPLICATION = 'forum_project.wsgi.application'
 
 
@@ -97,6 +113,62 @@ DATABASES = {
 }
 
 
+# Cache used for rendered post fragments (see forum_app/fragments.py)
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'forum',
+        'OPTIONS': {'MAX_ENTRIES': 20000},
+    },
+    # token buckets of the rate limits (see forum_app/ratelimit.py); use a
+    # shared backend to make the limits host-wide instead of per worker
+    'ratelimit': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'ratelimit',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+}
+RATELIMIT_CACHE = 'ratelimit'
+
+# Requests per client (user, or address for visitors) to these URL names,
+# other than GET and HEAD: 'N/s', 'N/m', 'N/h' or 'N/d'
+RATE_LIMITS = {
+    'thread': '10/m',
+    'thread_add': '3/m',
+    'conversation': '20/m',
+    'like_post': '60/m',
+    'search': '60/m',
+}
+
+# Addresses of the reverse proxies in front of the app. Requests from them
+# are limited by the client address in X-Forwarded-For / X-Real-IP
+TRUSTED_PROXIES = []
+
+# Threads with no new post for this many days are moved to the archive
+# tables by the archive_threads command (see forum_app/archive.py)
+ARCHIVE_AFTER_DAYS = 730
+
+# Private messages older than this many days are deleted by the purge_pms
+# command (see forum_app/inbox.py); None keeps them until their
+# conversation is deleted
+PM_RETENTION_DAYS = None
+
+# Hours for a post or like to lose half its weight in the trending order
+# (see forum_app/trending.py)
+TRENDING_HALF_LIFE = 24
+
+# File shared by the workers of this host to invalidate each other's
+# in-process caches (see forum_app/bus.py); None puts it in the temp dir
+INVALIDATION_BUS_PATH = os.environ.get('INVALIDATION_BUS_PATH')
+
+# Where the build_sitemap command writes the sitemap files, served from the
+# site root (see forum_app/sitemap.py), and the scheme and host their URLs
+# start with
+SITEMAP_ROOT = os.path.join(BASE_DIR, 'sitemaps')
+SITEMAP_BASE_URL = os.environ.get('SITEMAP_BASE_URL',
+                                  'https://jd666.pythonanywhere.com')
+
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -132,6 +204,13 @@ USE_TZ = True
 
 MEDIA_ROOT = MEDIA_DIR
 MEDIA_URL = '/media/'
+# Uploads get content-hashed names, cached for a year (see forum_app/media.py)
+DEFAULT_FILE_STORAGE = 'forum_app.media.HashedFileStorage'
+# 'x-accel-redirect' (nginx) or 'x-sendfile' (Apache, lighttpd) hands media
+# files to the front-end server; unset, Django sends them itself
+MEDIA_ACCEL = os.environ.get('MEDIA_ACCEL') or None
+# nginx internal location aliased to MEDIA_ROOT, for x-accel-redirect
+MEDIA_ACCEL_PREFIX = '/protected-media/'
 
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/1.11/howto/static-files/
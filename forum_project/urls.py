@@ -18,7 +18,6 @@ from django.contrib import admin
 from django.conf import settings
 import django.contrib.auth.views
 from django.http import HttpResponseRedirect
-from django.conf.urls.static import static
 from django.core.urlresolvers import reverse
 
 from forum_app import views
@@ -37,4 +36,8 @@ urlpatterns = [
         django.contrib.auth.views.password_change_done, 
         {'template_name':'registration/change_password_done.html'}, 
         name='password_change_done'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+    url(r'^(?P<path>sitemap[\w\-]*\.xml(?:\.gz)?)$', views.sitemap_file,
+        name='sitemap'),
+    url(r'^{}(?P<path>.+)$'.format(settings.MEDIA_URL.lstrip('/')),
+        views.media_file, name='media'),
+]
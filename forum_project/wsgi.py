@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "forum_project.settings")
 
 application = get_wsgi_application()
+
+# Opt-in: compile templates, fill caches and connect to the database before
+# the worker takes traffic (see forum_app/warmup.py). This has to happen in
+# each worker, so don't combine it with a server that preloads the app in a
+# master process.
+if os.environ.get('FORUM_WARMUP') == '1':
+    from forum_app.warmup import warm_up
+    warm_up(application)